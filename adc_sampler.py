@@ -0,0 +1,168 @@
+"""
+Samples A/D channels at a steady rate in a thread of its own.  Sampling
+from a main loop that also schedules logging and watches threads gives a
+sample rate that wanders with everything else the loop does; here scans are
+scheduled on absolute deadlines from the monotonic clock, so the rate does
+not drift, and a known effective sample rate makes the averaging filters
+downstream reject noise predictably.
+
+Each group of 'oversample' scans is averaged into one output sample
+(oversampling and decimation), which lowers the A/D noise and the rate the
+consumers of the samples have to keep up with.  Output samples are written
+in place into preallocated arrays, so no objects are created per sample.
+"""
+from __future__ import division
+import time
+import threading
+from array import array
+import clock
+
+# Number of channels on the MCP3008
+ADC_CHANNELS = 8
+
+
+class ADCSampler(threading.Thread):
+
+    def __init__(self, scan, channels, rate=100.0, oversample=5, call_backs=(), buffer_len=256,
+                 metrics=None):
+        """'scan' is a function that converts the A/D channels and returns a sequence
+            of counts indexed on channel number, e.g. the 'scan()' method of an
+            adc_scanner.MCP3008Scanner.
+        'channels' is a list of the channels to sample.
+        'rate' is the number of scans per second.
+        'oversample' is the number of scans averaged into each output sample, so
+            output samples are produced at 'rate' / 'oversample' per second.
+        'call_backs' is a list of functions called after each output sample with
+            the time of the sample (clock.monotonic()), e.g. BTUMeter.sample.
+        'buffer_len' is the number of output samples kept for each channel.
+        'metrics' if not None, is a metrics.Metrics object that records the time taken
+            by each scan in milliseconds and the number of overruns.
+        A first scan is done, so 'read_adc()' has values before the thread starts.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scan = scan
+        self.channels = sorted(set(channels))
+        self.period = 1.0 / rate
+        self.oversample = oversample
+        self.output_rate = rate / oversample     # effective sample rate
+        self.call_backs = list(call_backs)
+        self.buffer_len = buffer_len
+
+        self.sums = array('d', [0.0] * ADC_CHANNELS)     # scan totals of the current group
+        self.values = array('d', [0.0] * ADC_CHANNELS)   # newest output sample of each channel
+        # ring buffer of output samples, one row of ADC_CHANNELS values per sample
+        self.samples = array('d', [0.0] * (buffer_len * ADC_CHANNELS))
+        self.times = array('d', [0.0] * buffer_len)
+        self.count = 0          # number of output samples ever produced
+        self.group_scans = 0    # number of scans in the current group
+        self.overruns = 0       # number of times the thread fell behind and skipped scans
+
+        self.scan_hist = None
+        if metrics:
+            self.scan_hist = metrics.histogram('adc_scan_ms')
+            metrics.gauge('adc_overruns', lambda: self.overruns)
+
+        counts = scan()
+        for ch in self.channels:
+            self.values[ch] = counts[ch]
+
+    def read_adc(self, ch):
+        """Returns the newest output sample of channel 'ch'.  The value is an average
+        of A/D counts, so it has a fractional part.
+        """
+        return self.values[ch]
+
+    def recent(self, ch, n=None):
+        """Returns a list of the last 'n' (time, value) output samples of channel 'ch',
+        oldest first.  If 'n' is None, all of the samples in the buffer are returned.
+        """
+        count = self.count
+        n = min(n or self.buffer_len, self.buffer_len, count)
+        result = []
+        for i in range(count - n, count):
+            ix = i % self.buffer_len
+            result.append((self.times[ix], self.samples[ix * ADC_CHANNELS + ch]))
+        return result
+
+    def scan_once(self, deadline):
+        """Does the scan due at the clock.monotonic() time 'deadline'.  When it
+        completes a group of 'oversample' scans, stores the output sample and calls
+        the call backs.  run() calls this on each deadline; a script that runs on
+        an asyncio event loop can call it from a coroutine instead.
+        """
+        if self.scan_hist:
+            start = clock.monotonic()
+            counts = self.scan()
+            self.scan_hist.add((clock.monotonic() - start) * 1000.0)
+        else:
+            counts = self.scan()
+        # local names for the attributes used on every scan
+        channels = self.channels
+        sums = self.sums
+        for ch in channels:
+            sums[ch] += counts[ch]
+        self.group_scans += 1
+
+        if self.group_scans == self.oversample:
+            values = self.values
+            samples = self.samples
+            oversample = self.oversample
+            ix = self.count % self.buffer_len
+            row = ix * ADC_CHANNELS
+            for ch in channels:
+                val = sums[ch] / oversample
+                values[ch] = val
+                samples[row + ch] = val
+                sums[ch] = 0.0
+            # each output sample is time-stamped at the middle of its group of scans
+            ts = deadline - (oversample - 1) * self.period / 2.0
+            self.times[ix] = ts
+            self.count += 1
+            self.group_scans = 0
+            for call_back in self.call_backs:
+                call_back(ts)
+
+    def next_deadline(self, deadline):
+        """Returns the deadline of the scan after the one due at 'deadline', and the
+        number of seconds to sleep until it.  Deadlines are advanced by the period
+        rather than measured from the end of a scan, so the time spent scanning does
+        not slow the rate.
+        """
+        deadline += self.period
+        delay = deadline - clock.monotonic()
+        if delay < -self.period:
+            # More than a scan behind, e.g. the thread was starved of CPU.  Drop
+            # the missed scans instead of running them back to back.
+            self.overruns += 1
+            deadline = clock.monotonic()
+        return deadline, delay
+
+    def run(self):
+        deadline = clock.monotonic()
+        while True:
+            self.scan_once(deadline)
+            deadline, delay = self.next_deadline(deadline)
+            if delay > 0.0:
+                time.sleep(delay)
+
+if __name__ == '__main__':
+
+    # Test routine, sampling a simulated channel with a noisy sine wave
+    import math
+    import random
+
+    def scan():
+        t = clock.monotonic()
+        return [500.0 + 100.0 * math.sin(t) + random.gauss(0.0, 10.0)] + [0] * 7
+
+    def show(ts):
+        if sampler.count % 20 == 0:
+            print('%.3f  %.1f  overruns: %d' % (ts, sampler.read_adc(0), sampler.overruns))
+
+    sampler = ADCSampler(scan, [0], rate=200.0, oversample=10, call_backs=[show])
+    sampler.start()
+    start = clock.monotonic()
+    time.sleep(5.0)
+    print('Output rate: %.2f per second, expected %.2f' % (sampler.count / (clock.monotonic() - start),
+                                                          sampler.output_rate))
@@ -0,0 +1,116 @@
+"""
+Reads a set of MCP3008 A/D channels in one pass.  Each BTU loop needs two
+channels, and several loops can share one MCP3008.  Instead of one SPI
+transaction per 'read_adc()' call, all active channels are converted in one
+SPI_IOC_MESSAGE ioctl holding one 3-byte transfer per channel, with the chip
+select released between them as the MCP3008 requires.  The per-scan Python
+and system call overhead is then paid once, no matter how many loops there
+are, and a channel shared by several loops is only read once.
+
+If the spidev device can't be opened directly, the channels are read one at
+a time through the Adafruit SPI object.
+"""
+import os
+import ctypes
+import ctypes.util
+import clock
+
+# Number of bytes in one MCP3008 conversion frame
+FRAME_LEN = 3
+
+
+class spi_ioc_transfer(ctypes.Structure):
+    """One transfer of a Linux SPI_IOC_MESSAGE ioctl (linux/spi/spidev.h)."""
+    _fields_ = [
+        ('tx_buf', ctypes.c_uint64),
+        ('rx_buf', ctypes.c_uint64),
+        ('len', ctypes.c_uint32),
+        ('speed_hz', ctypes.c_uint32),
+        ('delay_usecs', ctypes.c_uint16),
+        ('bits_per_word', ctypes.c_uint8),
+        ('cs_change', ctypes.c_uint8),
+        ('tx_nbits', ctypes.c_uint8),
+        ('rx_nbits', ctypes.c_uint8),
+        ('word_delay_usecs', ctypes.c_uint8),
+        ('pad', ctypes.c_uint8),
+    ]
+
+def spi_ioc_message(n):
+    """Returns the ioctl request number for an SPI message of 'n' transfers.
+    """
+    size = n * ctypes.sizeof(spi_ioc_transfer)
+    return (1 << 30) | (size << 16) | (ord('k') << 8)
+
+
+class MCP3008Scanner:
+
+    def __init__(self, channels, spi_port=0, spi_device=0, speed_hz=1000000, spi=None, capture=None):
+        """'channels' is a list of the MCP3008 channels (0 - 7) to read; duplicates are
+        read once.
+        'spi_port' and 'spi_device' identify the /dev/spidev<port>.<device> device.
+        'speed_hz' is the SPI clock rate; the MCP3008 allows 1.35 MHz at 2.7 V.
+        'spi' is an Adafruit_GPIO.SPI.SpiDev object (or any object with a
+            'transfer(list)' method) used if the spidev device can't be opened.
+        'capture' if not None, is a capture.CaptureWriter that records the counts of
+            every scan.
+        A first scan is done, so 'read_adc()' has values right away.
+        """
+        self.channels = sorted(set(channels))
+        self.counts = [0] * 8          # latest A/D count of each channel
+        self.spi = spi
+        self.fd = None
+        self.capture = capture
+
+        # command frame for each channel: start bit, single-ended + channel, padding
+        self.frames = [[1, (8 + ch) << 4, 0] for ch in self.channels]
+
+        try:
+            self.fd = os.open('/dev/spidev%d.%d' % (spi_port, spi_device), os.O_RDWR)
+        except OSError:
+            if spi is None:
+                raise
+
+        if self.fd is not None:
+            n = len(self.channels)
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.request = spi_ioc_message(n)
+            self.tx = ctypes.create_string_buffer(bytes(bytearray(sum(self.frames, []))), n * FRAME_LEN)
+            self.rx = ctypes.create_string_buffer(n * FRAME_LEN)
+            self.xfers = (spi_ioc_transfer * n)()
+            for i, xfer in enumerate(self.xfers):
+                xfer.tx_buf = ctypes.addressof(self.tx) + i * FRAME_LEN
+                xfer.rx_buf = ctypes.addressof(self.rx) + i * FRAME_LEN
+                xfer.len = FRAME_LEN
+                xfer.speed_hz = speed_hz
+                xfer.bits_per_word = 8
+                # release chip select between conversions, but not after the last
+                xfer.cs_change = 1 if i < n - 1 else 0
+
+        self.scan()
+
+    def scan(self):
+        """Converts all of the channels, storing the results for 'read_adc()'.
+        Returns the list of counts indexed on channel number.
+        """
+        counts = self.counts
+        if self.fd is not None:
+            if self.libc.ioctl(self.fd, self.request, self.xfers) < 0:
+                errno = ctypes.get_errno()
+                raise IOError(errno, os.strerror(errno))
+            raw = bytearray(self.rx.raw)
+            for i, ch in enumerate(self.channels):
+                counts[ch] = ((raw[i * FRAME_LEN + 1] & 3) << 8) | raw[i * FRAME_LEN + 2]
+        else:
+            for ch, frame in zip(self.channels, self.frames):
+                r = self.spi.transfer(frame)
+                counts[ch] = ((r[1] & 3) << 8) | r[2]
+        if self.capture:
+            ts = clock.monotonic()
+            for ch in self.channels:
+                self.capture.adc(ts, ch, counts[ch])
+        return counts
+
+    def read_adc(self, ch):
+        """Returns the A/D count of channel 'ch' from the last scan.
+        """
+        return self.counts[ch]
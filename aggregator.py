@@ -0,0 +1,159 @@
+"""
+Keeps short time buckets (1 second by default) of quantities that change
+within a log interval, so that a sensor can post a summary of what happened
+during the interval, such as the peak flow and the temperature range, instead
+of just the values at the moment of posting.  The buckets are held in a ring
+of preallocated arrays, so memory use is fixed no matter how much data
+arrives.
+
+Two kinds of quantity are kept:
+    sums     totals per bucket, e.g. pulses or heat
+    stats    count, minimum, total and maximum per bucket, e.g. temperatures
+
+Buckets are numbered by the time, from clock.monotonic(), divided by the
+bucket width.  Each bucket is reported in exactly one period: a summary
+covers the whole buckets from the end of the last period up to, but not
+including, the bucket the new period ends in.
+"""
+from __future__ import division
+import threading
+from array import array
+
+
+class Aggregator:
+
+    def __init__(self, sums=(), stats=(), width=1.0, size=600):
+        """'sums' is a list of the names of quantities totaled in each bucket.
+        'stats' is a list of the names of quantities whose min, mean and max are kept.
+        'width' is the length of a bucket in seconds.
+        'size' is the number of buckets kept; it must cover a log interval.
+        """
+        self.sum_names = list(sums)
+        self.stat_names = list(stats)
+        self.width = width
+        self.size = size
+        zeros = [0.0] * size
+        self.ids = array('d', [-1.0] * size)     # bucket number held in each slot
+        self.sums = dict((name, array('d', zeros)) for name in self.sum_names)
+        self.counts = dict((name, array('d', zeros)) for name in self.stat_names)
+        self.mins = dict((name, array('d', zeros)) for name in self.stat_names)
+        self.maxs = dict((name, array('d', zeros)) for name in self.stat_names)
+        self.totals = dict((name, array('d', zeros)) for name in self.stat_names)
+        self.lock = threading.Lock()
+
+    def _slot(self, ts):
+        """Returns the slot index of the bucket holding time 'ts', clearing the slot if
+        it held an older bucket, or None if the bucket is too old to be kept.
+        """
+        bucket = float(int(ts // self.width))
+        ix = int(bucket) % self.size
+        held = self.ids[ix]
+        if held != bucket:
+            if held > bucket:
+                return None
+            self.ids[ix] = bucket
+            for arr in self.sums.values():
+                arr[ix] = 0.0
+            for name in self.stat_names:
+                self.counts[name][ix] = 0.0
+                self.totals[name][ix] = 0.0
+        return ix
+
+    def add(self, ts, name, val):
+        """Adds 'val' to the sum 'name' in the bucket holding time 'ts'.
+        """
+        with self.lock:
+            ix = self._slot(ts)
+            if ix is not None:
+                self.sums[name][ix] += val
+
+    def sample(self, ts, name, val):
+        """Adds the reading 'val' to the statistics 'name' in the bucket holding time 'ts'.
+        """
+        with self.lock:
+            ix = self._slot(ts)
+            if ix is None:
+                return
+            if self.counts[name][ix]:
+                if val < self.mins[name][ix]:
+                    self.mins[name][ix] = val
+                if val > self.maxs[name][ix]:
+                    self.maxs[name][ix] = val
+            else:
+                self.mins[name][ix] = self.maxs[name][ix] = val
+            self.counts[name][ix] += 1
+            self.totals[name][ix] += val
+
+    def _slots(self, start, end):
+        """Returns a list of (bucket number, slot index) of the buckets held from the
+        one holding time 'start' up to, not including, the one holding time 'end'.
+        """
+        first = int(start // self.width)
+        last = int(end // self.width)
+        first = max(first, last - self.size)
+        result = []
+        for bucket in range(first, last):
+            ix = bucket % self.size
+            if self.ids[ix] == bucket:
+                result.append((bucket, ix))
+        return result
+
+    def summary(self, start, end):
+        """Returns a list of (name, value) pairs summarizing the buckets from time
+        'start' to 'end' (see _slots()).  For each sum, '<name>_total' and '<name>_max',
+        the largest bucket total; for each stat, '<name>_min', '<name>_mean' and
+        '<name>_max'.  Stats with no readings are left out.
+        """
+        result = []
+        with self.lock:
+            slots = self._slots(start, end)
+            for name in self.sum_names:
+                vals = [self.sums[name][ix] for _, ix in slots]
+                result.append(('%s_total' % name, sum(vals)))
+                result.append(('%s_max' % name, max(vals) if vals else 0.0))
+            for name in self.stat_names:
+                used = [ix for _, ix in slots if self.counts[name][ix]]
+                if not used:
+                    continue
+                n = sum(self.counts[name][ix] for ix in used)
+                result.append(('%s_min' % name, min(self.mins[name][ix] for ix in used)))
+                result.append(('%s_mean' % name, sum(self.totals[name][ix] for ix in used) / n))
+                result.append(('%s_max' % name, max(self.maxs[name][ix] for ix in used)))
+        return result
+
+    def series(self, start, end):
+        """Returns a dictionary holding the buckets from time 'start' to 'end' (see
+        _slots()): 'bucket' is the list of bucket start times, each sum has a list of
+        bucket totals, and each stat has lists '<name>_min', '<name>_mean' and
+        '<name>_max', with None for buckets without readings.
+        """
+        with self.lock:
+            slots = self._slots(start, end)
+            result = {'bucket': [bucket * self.width for bucket, _ in slots]}
+            for name in self.sum_names:
+                result[name] = [self.sums[name][ix] for _, ix in slots]
+            for name in self.stat_names:
+                mins, means, maxs = [], [], []
+                for _, ix in slots:
+                    n = self.counts[name][ix]
+                    mins.append(self.mins[name][ix] if n else None)
+                    means.append(self.totals[name][ix] / n if n else None)
+                    maxs.append(self.maxs[name][ix] if n else None)
+                result['%s_min' % name] = mins
+                result['%s_mean' % name] = means
+                result['%s_max' % name] = maxs
+        return result
+
+
+if __name__ == '__main__':
+
+    # Test routine and usage example
+    agg = Aggregator(sums=['pulse'], stats=['temp'], width=1.0, size=10)
+    for i in range(50):
+        ts = 100.0 + i * 0.1
+        agg.sample(ts, 'temp', 120.0 + i)
+        if i % 3 == 0:
+            agg.add(ts, 'pulse', 1)
+    for name, val in agg.summary(100.0, 105.0):
+        print('%s: %s' % (name, val))
+    print(agg.series(100.0, 105.0))
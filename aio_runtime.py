@@ -0,0 +1,421 @@
+"""
+Pieces for running a sensor script on one asyncio event loop, under Python
+3.7 or later, in place of the threads the other scripts start: one for the
+edge events, one for the A/D sampling, one for the MQTT poster and a main
+thread that sleeps until a post is due.  Each of those is a coroutine here,
+so the script has one thread doing the work, and a Pi Zero spends less
+memory on thread stacks and less time switching between threads.
+
+    every()             posts on the wall clock multiples of an interval,
+                            like scheduler.Scheduler.every()
+    EdgeSource          watches kernel edge events, like input_change.EdgeInputChange
+    run_adc_sampler()   drives an adc_sampler.ADCSampler on its deadlines
+    AsyncMQTTPoster     publishes over one persistent connection, like the
+                            persistent mode of mqtt_poster.MQTTposter
+
+Polling the pins every few milliseconds is the one job that can't wait its
+turn on the loop, so it stays off it: an input_change.InputChange thread
+hands its transitions to the loop through a LoopDispatcher, or the pins are
+sampled in another process by an rt_sampler.RTInputChange, whose wake-up
+pipe run_rt_sampler() reads from the loop.  The checkpoint threads, which
+only wake to write files, are kept as well.
+
+Call backs run on the loop, so they must not block; an exception in one
+ends the coroutine that called it, which the script treats like a stopped
+thread.
+"""
+import asyncio
+import socket
+import time
+import traceback
+try:
+    import Queue
+except ImportError:
+    # Python 3
+    import queue as Queue
+import paho.mqtt.client as mqtt
+import clock
+import input_change
+import mqtt_poster
+import payload_codec
+import scheduler
+import spool
+
+
+async def every(interval, func, align=True):
+    """Calls 'func(ts)' every 'interval' seconds.  If 'align' is True, the calls
+    happen when the Unix time is a multiple of 'interval', and 'ts' is that Unix
+    time; otherwise the first call is 'interval' seconds from now, and 'ts' is the
+    Unix time of the call.  Never returns.
+    """
+    if align:
+        due = scheduler.next_boundary(interval)
+    else:
+        due = clock.monotonic() + interval
+    while True:
+        await asyncio.sleep(due - clock.monotonic())
+        if align:
+            # Unix time of the boundary this run is for
+            ts = round(time.time() / interval) * interval
+            func(ts)
+            due = scheduler.boundary_after(ts, interval)
+        else:
+            func(time.time())
+            due += interval
+            now = clock.monotonic()
+            if due < now:
+                # the job took longer than its interval; skip the missed runs
+                due = now
+
+
+def watch(thread, loop):
+    """Returns a future that is done when 'thread' stops, for any reason, so the
+    script can wait on its off-loop threads along with its coroutines.  Its result
+    is the thread.  Must be called before the thread is started.
+    """
+    stopped = loop.create_future()
+    target = thread.run
+    def run():
+        try:
+            target()
+        finally:
+            try:
+                loop.call_soon_threadsafe(stopped.set_result, thread)
+            except RuntimeError:
+                # the loop has already closed
+                pass
+    thread.run = run
+    return stopped
+
+
+class LoopDispatcher:
+
+    def __init__(self, call_back, loop):
+        """Runs the call back of a detector thread, e.g. an input_change.InputChange,
+        on the event loop 'loop'.  Pass 'put' to the detector as its call back, and
+        run 'run()' on the loop, which calls 'call_back' with the same arguments, in
+        order.  Make it on the loop.
+        """
+        self.call_back = call_back
+        self.loop = loop
+        self.events = asyncio.Queue()
+
+    def put(self, *args):
+        """Called from the detector thread.  Only queues the call, so it never
+        waits on the loop.
+        """
+        self.loop.call_soon_threadsafe(self.events.put_nowait, args)
+
+    async def run(self):
+        while True:
+            args = await self.events.get()
+            self.call_back(*args)
+
+
+class EdgeSource:
+
+    def __init__(self, pins, call_back, pull_up=False, debounce=10.0, gpio=None, timestamps=False,
+                 capture=None, metrics=None):
+        """Detects changes in a set of input pins from the kernel's edge events, in
+        the same way as input_change.EdgeInputChange, and calls 'call_back' from the
+        event loop.  The parameters are those of EdgeInputChange.  The GPIO module
+        calls back from its own event thread; each edge is passed to the loop, and
+        the debounce timing is done with loop timers.
+        """
+        self.pins = list(pins)
+        self.call_back = call_back
+        self.debounce = debounce / 1000.0  # seconds a level must be held to be accepted
+        self.gpio = gpio or input_change.GPIO
+        self.timestamps = timestamps
+        self.capture = capture
+        self.call_back_hist = metrics.histogram('callback_ms') if metrics else None
+
+        input_change.setup_pins(self.gpio, self.pins, pull_up)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # (pin, level, timestamp) of each edge, put by the GPIO module's event thread
+        events = asyncio.Queue()
+
+        def edge(pin):
+            """Called from the GPIO module's event thread at each edge. Keep it short.
+            """
+            event = (pin, self.gpio.input(pin), clock.monotonic())
+            loop.call_soon_threadsafe(events.put_nowait, event)
+            if self.capture:
+                self.capture.edge(event[2], pin, event[1])
+
+        # these dictionaries are keyed on pin number
+        cur_state = {}
+        pending = {}      # (level, timestamp, timer) of the last edge not yet accepted
+        settled = []      # (pin, timestamp) of levels held for the debounce time
+        for pin in self.pins:
+            cur_state[pin] = bool(self.gpio.input(pin))
+            self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=edge)
+
+        def accept(pin, level, ts):
+            if level != cur_state[pin]:
+                cur_state[pin] = level
+                if self.capture:
+                    self.capture.transition(ts, pin, level)
+                start = clock.monotonic()
+                if self.timestamps:
+                    self.call_back(pin, level, ts)
+                else:
+                    self.call_back(pin, level)
+                if self.call_back_hist:
+                    self.call_back_hist.add((clock.monotonic() - start) * 1000.0)
+
+        def settle(pin, ts):
+            # The timer only queues the pin, so the call back runs in this
+            # coroutine, and an error in it stops the coroutine.
+            settled.append((pin, ts))
+            events.put_nowait(None)
+
+        while True:
+            event = await events.get()
+            if event is not None:
+                pin, level, ts = event
+                if pin in pending:
+                    prev_level, prev_ts, timer = pending.pop(pin)
+                    timer.cancel()
+                    if ts - prev_ts >= self.debounce:
+                        # previous level was held long enough
+                        accept(pin, prev_level, prev_ts)
+                # clock.monotonic() is the clock of the loop's timers
+                pending[pin] = (bool(level), ts, loop.call_at(ts + self.debounce, settle, pin, ts))
+
+            # accept any levels that have been stable for the debounce time, unless
+            # an edge that came in meanwhile has replaced them
+            while settled:
+                pin, ts = settled.pop(0)
+                if pin in pending and pending[pin][1] == ts:
+                    level, ts, _ = pending.pop(pin)
+                    accept(pin, level, ts)
+
+
+async def run_adc_sampler(sampler):
+    """Samples the A/D channels on the deadlines of the adc_sampler.ADCSampler
+    'sampler', which must not be started as a thread, calling its call backs after
+    each output sample.  Never returns.
+    """
+    deadline = clock.monotonic()
+    while True:
+        sampler.scan_once(deadline)
+        deadline, delay = sampler.next_deadline(deadline)
+        # always yield, so other coroutines run even when the sampling falls behind
+        await asyncio.sleep(max(delay, 0.0))
+
+
+async def run_rt_sampler(detector):
+    """Starts the sampling process of the rt_sampler.RTInputChange 'detector', if it
+    isn't already, and calls its call back from the loop for each transition.  The
+    detector must not be started as a thread.  Returns 'detector' when the sampling
+    process stops.
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    detector.start_sampling()
+    loop.add_reader(detector.wake_r, wake.set)
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(wake.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+            if not detector.process.is_alive():
+                # the sampling process stopped, so this coroutine stops too
+                return detector
+            wake.clear()
+            detector.drain()
+    finally:
+        loop.remove_reader(detector.wake_r)
+
+
+class AsyncMQTTPoster:
+
+    def __init__(self, host='localhost', port=1883, max_inflight=20, keepalive=60, spool_dir=None,
+                 metrics=None):
+        """Publishes to an MQTT broker from the event loop.  The parameters are those
+        of mqtt_poster.MQTTposter.  One connection is kept open and up to
+        'max_inflight' QoS 1 messages are in flight at once, as in MQTTposter's
+        persistent mode, with the same mqtt_poster.InflightWindow to track them and
+        resend the unacknowledged ones on a new connection if the broker goes away.  The Client's socket is watched by
+        the loop instead of a network thread, once the connection has been opened in
+        the loop's default executor, where a slow broker can't hold up the loop.
+        Make it on the loop.
+        """
+        self.host = host
+        self.port = port
+        self.max_inflight = max_inflight
+        self.keepalive = keepalive
+        if spool_dir:
+            self.q = spool.Spool(spool_dir)
+        else:
+            self.q = Queue.Queue()
+        # set when there is something for run() to do
+        self.wake = asyncio.Event()
+
+        self.latency_hist = None
+        self.retries = None
+        if metrics:
+            self.latency_hist = metrics.histogram('mqtt_latency_ms')
+            self.retries = metrics.counter('mqtt_retries')
+            if spool_dir:
+                metrics.gauge('mqtt_spool_bytes', self.q.size_bytes)
+            else:
+                metrics.gauge('mqtt_queue', self.q.qsize)
+
+    def publish(self, topic, payload):
+        """Put a message in the queue to publish.
+        'topic' is the topic of the message and 'payload' is the payload.
+        """
+        self.q.put((topic, payload))
+        self.wake.set()
+
+    def publish_readings(self, topic, ts, readings, trailing_newline=False):
+        """Put a message of readings in the queue to publish, in the Mini-Monitor text
+        format.  'readings' is a list of (sensor ID, value) pairs, all time-stamped with
+        the Unix time 'ts'.  If 'trailing_newline' is True, the last line of the text
+        ends with a newline too.
+        """
+        self.publish(topic, payload_codec.text_payload(ts, readings, trailing_newline))
+
+    def _make_client(self, acked, lost):
+        """Returns a new Client.  The IDs of acknowledged messages are appended to
+        'acked', and the disconnect reason to 'lost'.
+        """
+        client = mqtt.Client()
+        client.max_inflight_messages_set(self.max_inflight)
+
+        def on_publish(c, userdata, mid):
+            acked.append(mid)
+            self.wake.set()
+
+        def on_disconnect(c, userdata, rc):
+            lost.append(rc)
+            self.wake.set()
+
+        client.on_publish = on_publish
+        client.on_disconnect = on_disconnect
+        return client
+
+    def _watch_socket(self, client, loop):
+        """Has 'loop' read and write the socket of the connected 'client'.  Called on
+        the loop after the connect, as the loop's methods aren't safe to call from the
+        executor thread that connects.
+        """
+        client.on_socket_close = lambda c, userdata, sock: loop.remove_reader(sock)
+        client.on_socket_register_write = lambda c, userdata, sock: loop.add_writer(sock, c.loop_write)
+        client.on_socket_unregister_write = lambda c, userdata, sock: loop.remove_writer(sock)
+        sock = client.socket()
+        loop.add_reader(sock, client.loop_read)
+        if client.want_write():
+            loop.add_writer(sock, client.loop_write)
+
+    async def run(self):
+        """Publishes the items in the queue.  Never returns.
+        """
+        loop = asyncio.get_running_loop()
+        window = mqtt_poster.InflightWindow(self.q, self.max_inflight, self.latency_hist, self.retries)
+        retry_wait = 1  # seconds
+
+        while True:
+
+            # A new Client is made for each connection, so messages it has not
+            # delivered are not also resent by the Client itself.
+            acked = []                         # message IDs acknowledged by the broker
+            lost = []                          # set if the connection is lost
+            client = self._make_client(acked, lost)
+            try:
+                await loop.run_in_executor(None, client.connect, self.host, self.port, self.keepalive)
+            except socket.error:
+                # couldn't connect to MQTT broker, try again after short wait
+                if self.retries:
+                    self.retries.add()
+                await asyncio.sleep(retry_wait)
+                retry_wait = min(30, retry_wait * 2)
+                continue
+            self._watch_socket(client, loop)
+            # send the messages not acknowledged on the old connection again
+            window.reconnected()
+
+            while not lost:
+                self.wake.clear()
+
+                if acked:
+                    # the broker is accepting messages, so reset the wait used after failures
+                    retry_wait = 1
+                window.acknowledge(acked)
+                del acked[:]
+
+                # fill the window of in-flight messages
+                window.fill(client)
+
+                # keepalive pings, and the check for a broker that stopped answering
+                if client.loop_misc() != mqtt.MQTT_ERR_SUCCESS:
+                    break
+                try:
+                    await asyncio.wait_for(self.wake.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+            # connection was lost; start over with a new one
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+            await asyncio.sleep(retry_wait)
+            retry_wait = min(30, retry_wait * 2)
+
+
+def print_stopped(stopped):
+    """Prints what stopped each of the finished tasks and futures in 'stopped', the
+    done set returned by asyncio.wait().
+    """
+    for task in stopped:
+        if task.cancelled():
+            continue
+        exc = task.exception()
+        if exc is not None:
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+        elif task.result() is not None:
+            print('%s stopped' % task.result())
+
+
+if __name__ == '__main__':
+
+    # Test routine and usage example: a FakeBroker receives readings posted on the
+    # 2 second marks, while edges on a simulated pin are counted.
+    import fake_broker
+    import fake_gpio
+    import threading
+
+    def toggle(gpio, pin, hz):
+        while True:
+            time.sleep(0.5 / hz)
+            gpio.set_input(pin, not gpio.input(pin))
+
+    async def main():
+        broker = fake_broker.FakeBroker()
+        broker.start()
+        gpio = fake_gpio.FakeGPIO()
+        counts = {16: 0}
+
+        def chg(pin, state):
+            if not state:
+                counts[pin] += 1
+
+        source = EdgeSource([16], chg, gpio=gpio)
+        poster = AsyncMQTTPoster(port=broker.port)
+        post = lambda ts: poster.publish_readings('readings/final/test', ts, [('test_16_pulse', counts[16])])
+        tasks = [asyncio.ensure_future(coro) for coro in (source.run(), poster.run(), every(2, post))]
+        toggler = threading.Thread(target=toggle, args=(gpio, 16, 10.0))
+        toggler.daemon = True
+        toggler.start()
+        done, _ = await asyncio.wait(tasks, timeout=7.0)
+        print_stopped(done)
+        for topic, payload in broker.messages:
+            print('%s  %s' % (topic, payload.decode('utf-8').strip()))
+
+    asyncio.run(main())
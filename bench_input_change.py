@@ -0,0 +1,213 @@
+#!/usr/bin/python
+"""Benchmark of the pulse detection done by input_change.InputChange.  The pins
+are driven by a simulated GPIO module that produces square waves with a given
+frequency, duty cycle and contact bounce, computed from the clock at each read,
+so the true time of every edge is known.  Each combination of the swept
+settings is run in its own process for a fixed time, and one JSON object per
+combination is printed (or written to --out) holding:
+
+    expected         number of pulses (falling edges) the pins produced
+    counted          number of pulses passed to the call back
+    missed, extra    pulses the detector missed or counted that were not there
+    latency_ms       percentiles (p50, p90, p99, max) of the time from each true
+                         falling edge to the call back for it
+    cpu_per_wall     CPU seconds used by the process per second of run time,
+                         which includes the simulated pin reads
+
+Usage example, sweeping the pulse frequency for two read gaps:
+    bench_input_change.py --freq 5 10 15 20 30 --read-gap 1 3 --duration 5
+
+LEAD_TIME is longer than the idle delay used, so with --idle-gap the first
+pulse of each pin starts from the idle rate.
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+import clock
+import fake_gpio
+import input_change
+
+# First pin (BCM) driven by the simulated signal; further pins follow it.
+FIRST_PIN = 16
+
+# Seconds the pins are held high before the square waves start, so the detector
+# has read its starting state.
+LEAD_TIME = 1.0
+
+# Length of each level of a contact bounce, in seconds
+BOUNCE_STEP = 0.0005
+
+
+class SignalGPIO(fake_gpio.FakeGPIO):
+    """Simulated GPIO module where each input pin carries a square wave of
+    'freq' Hz that is high for 'duty' of each cycle.  For 'bounce' seconds after
+    each edge, the level chatters between the old and new levels.  The pins are
+    high before 'start' and after 'stop', and each pin's wave lags the one
+    before it by a fraction of a cycle.
+    """
+
+    def __init__(self, pins, freq, duty, bounce, start, stop):
+        fake_gpio.FakeGPIO.__init__(self)
+        self.pins = pins
+        self.period = 1.0 / freq
+        self.high_time = duty * self.period
+        self.bounce = bounce
+        self.start = start
+        self.stop = stop
+        # phase offset of each pin's wave
+        self.offsets = [self.period * i / (len(pins) + 1) for i in range(len(pins))]
+
+    def level(self, i, t):
+        """Returns the level of the i-th pin at time 't'.
+        """
+        t -= self.start + self.offsets[i]
+        if t < 0.0 or t >= self.stop - self.start:
+            return 1
+        phase = t % self.period
+        if phase < self.high_time:
+            since_edge, new_level = phase, 1
+        else:
+            since_edge, new_level = phase - self.high_time, 0
+        if since_edge < self.bounce and int(since_edge / BOUNCE_STEP) % 2 == 0:
+            # chattering; the old level shows
+            return 1 - new_level
+        return new_level
+
+    def falling_edges(self, i):
+        """Returns the list of times the i-th pin falls from high to low.
+        """
+        edges = []
+        t = self.start + self.offsets[i] + self.high_time
+        while t < self.start + self.offsets[i] + (self.stop - self.start):
+            edges.append(t)
+            t += self.period
+        return edges
+
+    def input(self, pin):
+        return self.level(self.pins.index(pin), clock.monotonic())
+
+    def input_levels(self):
+        t = clock.monotonic()
+        levels = 0
+        for i, pin in enumerate(self.pins):
+            if self.level(i, t):
+                levels |= 1 << pin
+        return levels
+
+
+def percentile(sorted_vals, pct):
+    """Returns the 'pct' percentile of the sorted list 'sorted_vals'.
+    """
+    if not sorted_vals:
+        return None
+    ix = min(len(sorted_vals) - 1, int(round(pct / 100.0 * (len(sorted_vals) - 1))))
+    return sorted_vals[ix]
+
+
+def run_case(case, results):
+    """Runs one benchmark case (a dictionary of settings) and puts the result
+    dictionary on the 'results' queue.  Runs in its own process.
+    """
+    pins = list(range(FIRST_PIN, FIRST_PIN + case['pins']))
+    start = clock.monotonic() + LEAD_TIME
+    stop = start + case['duration']
+    gpio = SignalGPIO(pins, case['freq'], case['duty'], case['bounce'] / 1000.0, start, stop)
+
+    calls = []
+    def chg(pin, state, ts):
+        if not state:
+            calls.append((pin, clock.monotonic()))
+
+    detector = input_change.InputChange(pins, chg, read_gap=case['read_gap'], buffer_len=case['buffer_len'],
+                                        gpio=gpio, timestamps=True, dispatch=case['dispatch'],
+                                        idle_gap=case['idle_gap'], idle_after=0.5)
+    cpu_start = sum(os.times()[:2])
+    wall_start = clock.monotonic()
+    detector.start()
+    # let the detector settle on the final high level
+    time.sleep(stop - clock.monotonic() + 0.1 + case['read_gap'] * case['buffer_len'] / 1000.0)
+    wall = clock.monotonic() - wall_start
+    cpu = sum(os.times()[:2]) - cpu_start
+
+    expected = counted = missed = extra = 0
+    latencies = []
+    for i, pin in enumerate(pins):
+        edges = gpio.falling_edges(i)
+        call_times = [ts for p, ts in calls if p == pin]
+        expected += len(edges)
+        counted += len(call_times)
+        # match each call back to the latest true edge before it
+        ix = 0
+        matched = 0
+        last_edge = None
+        for ts in call_times:
+            while ix < len(edges) and edges[ix] <= ts:
+                ix += 1
+            if ix and edges[ix - 1] != last_edge:
+                last_edge = edges[ix - 1]
+                latencies.append(ts - last_edge)
+                matched += 1
+        missed += len(edges) - matched
+        extra += len(call_times) - matched
+
+    latencies.sort()
+    result = dict(case)
+    result.update({
+        'expected': expected,
+        'counted': counted,
+        'missed': missed,
+        'extra': extra,
+        'latency_ms': dict((name, round(percentile(latencies, pct) * 1000.0, 3) if latencies else None)
+                           for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))),
+        'cpu_per_wall': round(cpu / wall, 4),
+    })
+    results.put(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of InputChange pulse detection.')
+    parser.add_argument('--freq', type=float, nargs='+', default=[5.0, 10.0, 15.0, 20.0],
+                        help='pulse frequencies, Hz')
+    parser.add_argument('--duty', type=float, nargs='+', default=[0.5],
+                        help='fractions of each cycle the signal is high')
+    parser.add_argument('--bounce', type=float, nargs='+', default=[0.0],
+                        help='milliseconds of contact bounce after each edge')
+    parser.add_argument('--read-gap', type=float, nargs='+', default=[3.0],
+                        help='InputChange read_gap values, milliseconds')
+    parser.add_argument('--buffer-len', type=int, nargs='+', default=[8],
+                        help='InputChange buffer_len values')
+    parser.add_argument('--pins', type=int, nargs='+', default=[1],
+                        help='numbers of pins driven at once')
+    parser.add_argument('--idle-gap', type=float, nargs='+', default=[None],
+                        help='InputChange idle_gap values, milliseconds')
+    parser.add_argument('--dispatch', action='store_true',
+                        help='run the call back in the InputChange dispatch thread')
+    parser.add_argument('--duration', type=float, default=3.0,
+                        help='seconds each case runs')
+    parser.add_argument('--out', help='file to write the results to, one JSON object per line')
+    args = parser.parse_args()
+
+    fout = open(args.out, 'w') if args.out else sys.stdout
+    results = multiprocessing.Queue()
+    for freq, duty, bounce, read_gap, buffer_len, pins, idle_gap in itertools.product(
+            args.freq, args.duty, args.bounce, args.read_gap, args.buffer_len, args.pins, args.idle_gap):
+        case = {'freq': freq, 'duty': duty, 'bounce': bounce, 'read_gap': read_gap,
+                'buffer_len': buffer_len, 'pins': pins, 'idle_gap': idle_gap, 'dispatch': args.dispatch,
+                'duration': args.duration}
+        # a new process for each case, so detector threads from earlier cases
+        # don't share the CPU
+        proc = multiprocessing.Process(target=run_case, args=(case, results))
+        proc.start()
+        result = results.get()
+        proc.join()
+        fout.write(json.dumps(result, sort_keys=True) + '\n')
+        fout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 """Script to implement a BTU meter that uses a pulse output flow meter
 and two thermistors to measure hydronic heat flow.  Results are posted
-to the mini-monitor MQTT broker.
+to the mini-monitor MQTT broker.  The BTU meter logic is in the BTUMeter
+class in 'sensors.py'.  Several loops can be measured, sharing one MCP3008;
+see the BTU_LOOPS setting.
 
 This version does not use a Calibrate button to null out any error in the
 measured delta-T.  If you need that feature, see 'btu_meter_calib_button.py'.
@@ -14,40 +16,31 @@ the script if an error occurs.
 This script must be run with sudo because it writes to the /var/local 
 directory.
 """
-import time
+from __future__ import print_function
 import sys
-import os
 import argparse
-import shutil
 import RPi.GPIO as GPIO
 import input_change
 import mqtt_poster
-import thermistor
-
-# Import SPI library (for hardware SPI) and MCP3008 library.
+import payload_codec
+import sensors
+import capture
+import scheduler
+import metrics
+import adc_scanner
+
+# Import SPI library (for hardware SPI).
 import Adafruit_GPIO.SPI as SPI
-import Adafruit_MCP3008
 
-# GPIO Pins (BCM numbering) and ADC channels used by the BTU METER
-PIN_PULSE_IN = 13      # the pulse input pin
+# GPIO Pins (BCM numbering) used by the BTU METER.  The flow pulse input pin
+# and the MCP3008 channels used by the hot and cold thermistors of each loop
+# are given by the BTU_LOOPS setting, which defaults to one loop on pin 13,
+# channels 0 and 1: [(13, 0, 1)]
 PIN_DEBUG = 5          # a pin used to output a debug signal
-ADC_CH_THOT = 0        # the MCP3008 ADC channel used for the hot thermistor
-ADC_CH_TCOLD = 1       # the MCP3008 ADC channel used for the cold thermistor
 
 # Eliminate GPIO warnings
 GPIO.setwarnings(False)
 
-# Count at which pulse counter rolls to zero
-PULSE_ROLLOVER = 1000000
-
-# Value at which the heat count rolls over.  This is a sum of the delta-Ts
-# that are present when pulses occur.
-HEAT_ROLLOVER = 1000000.0
-
-# Number of A/D readings to average together to get the 
-# current temperature reading.
-BUF_LEN_TEMP = 100
-
 # process command line arguments
 parser = argparse.ArgumentParser(description='BTU Meter Script.')
 parser.add_argument("-d", "--debug", help="Set Debug mode", action="store_true")
@@ -63,114 +56,110 @@ debug_pin = PIN_DEBUG if args.debug else None
 sys.path.insert(0, '/boot/pi_logger')
 import settings
 
-# make a base sensor id
-base_sensor_id = '%s_%2d_btu' % (settings.LOGGER_ID, PIN_PULSE_IN)
+# flag to determine if the flow pin is watched with kernel edge events instead
+# of polling.  Edge detection allows higher pulse rates.
+edge_detect = getattr(settings, 'BTU_EDGE_DETECT', False)
+
+# flag to determine if the MQTT poster keeps one connection open to the broker
+# instead of connecting for each message.
+mqtt_persistent = getattr(settings, 'MQTT_PERSISTENT', False)
 
-# get logging interval in seconds
-log_interval = getattr(settings, 'BTU_LOG_INTERVAL', 10 * 60)
+# directory to queue MQTT messages in, so they survive a restart of this
+# script.  If None, messages are queued in memory.
+mqtt_spool_dir = getattr(settings, 'MQTT_SPOOL_DIR', None)
 
-# get the minimum delta-T required to tally energy flow (deg F)
-min_delta_T = getattr(settings, 'BTU_MIN_DELTA_T', 0.0)
+# If the CAPTURE_PATH setting is present, the raw pin levels, transitions and
+# A/D counts are recorded to that file, for study with 'replay.py'.
+capture_writer = capture.writer_from_settings(settings)
 
-# flag to determine if both transitions are counted
-count_both = getattr(settings, 'BTU_BOTH_EDGES', False)
+# If the METRICS_INTERVAL setting is present, timing measurements of this script
+# are posted to the metrics topic every METRICS_INTERVAL seconds.
+run_metrics, metrics_interval = metrics.metrics_from_settings(settings, 'btu_meter')
 
-# Calibration value to add to the Hot Temperature reading
-calibrate_hot = getattr(settings, 'CALIBRATE_ADJ_HOT', 0.0)
+def chg_detected(pin_num, new_state, ts):
+    """This is called when any of watched input pins change state.
+    """
+    pin_meters[pin_num].chg_detected(pin_num, new_state, ts)
 
-# Calibration value to add to the Cold Temperature reading
-calibrate_cold = getattr(settings, 'CALIBRATE_ADJ_COLD', 0.0)
+# Make the Input Pin Change Detector for the flow pins, before any other thread
+# is started, as with RT_SAMPLER set it forks the sampling process here.  The
+# INPUT_IDLE_GAP and RT_SAMPLER settings also pick the detector (see
+# input_change.detector_from_settings).
+# I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
+pins = sensors.pins_from_settings(settings, ['btu'])
+chg_detect = input_change.detector_from_settings(settings, pins, chg_detected, edge_detect,
+                                                 debug_pin=debug_pin, capture=capture_writer,
+                                                 metrics=run_metrics)
+
+# The scheduler runs the posting of readings and watches the worker threads.
+sched = scheduler.Scheduler()
 
 # start up the object that posts to the MQTT broker
-poster = mqtt_poster.MQTTposter()
+poster = mqtt_poster.MQTTposter(persistent=mqtt_persistent, spool_dir=mqtt_spool_dir,
+                                metrics=run_metrics)
+sched.watch(poster)
 poster.start()
 
-# make a thermistor object to convert A/D readings into temperature.
-# Using a 4.99 K divider resistor and a 10-bit A/D converter with max
-# value of 1023.
-therm = thermistor.Thermistor('BAPI 10K-3', appliedV=1023.0, dividerR=4990.0)
-
-# Initialize pulse count and heat count
-pulse_count = 0
-heat_count = 0.0
+# Readings go out as Mini-Monitor text messages, or batched into packed messages
+# if the PAYLOAD_FORMAT setting is 'packed' (see payload_codec.py).
+readings_poster = payload_codec.poster_from_settings(settings, poster)
 
 # Set up MCP3008 A/D converter.  We are using the hardware SPI port
-# on the Raspberry Pi (to save CPU cycles).
+# on the Raspberry Pi (to save CPU cycles).  All of the channels used by
+# the loops are read in one batch by the scanner.
 SPI_PORT   = 0
 SPI_DEVICE = 0
-mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE))
-
-# Initialize arrays to hold hot and cold thermistor A/D readings.
-# These arrays are used to calculate a current reading that is
-# an average of recent readings.  The raw A/D counts are stored
-# in the array to elimnate the CPU time needed to convert each into
-# a temperature.  Variation between the readings is small, so the
-# non-linearity of the count-->temperature function is not important.
-ad_hot = [mcp.read_adc(ADC_CH_THOT)] * BUF_LEN_TEMP
-ad_cold = [mcp.read_adc(ADC_CH_TCOLD)] * BUF_LEN_TEMP
-
-def current_temps():
-    """Returns the current hot and cold temperatures, averaging the values
-    in the reading buffer.  Always applies the calibration value.
-    """
-    thot = sum(ad_hot)/float(BUF_LEN_TEMP)
-    thot = therm.TfromV(thot) + calibrate_hot
-    tcold = sum(ad_cold)/float(BUF_LEN_TEMP)
-    tcold = therm.TfromV(tcold) + calibrate_cold
-    return thot, tcold
+loops = sensors.btu_loops_from_settings(settings)
+channels = [ch for loop in loops for ch in loop[1:3]]
+scanner = adc_scanner.MCP3008Scanner(channels, SPI_PORT, SPI_DEVICE,
+                                     spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE, max_speed_hz=1000000),
+                                     capture=capture_writer)
 
-def chg_detected(pin_num, new_state):
-    """This is called when any of watched input pins change state.
-    """
-    global pulse_count, heat_count
-
-    if pin_num == PIN_PULSE_IN:
-        if new_state == False or count_both:
-            # get current temperatures
-            thot, tcold = current_temps()
-            delta_T = thot - tcold
-            # enforce minimum delta-T
-            if abs(delta_T) < min_delta_T:
-                delta_T = 0.0
-
-            pulse_count += 1
-            pulse_count = pulse_count % PULSE_ROLLOVER
-            heat_count += delta_T
-            heat_count = heat_count % HEAT_ROLLOVER
+# The A/D channels are sampled at a steady rate in a thread of their own,
+# which passes each temperature sample to the meters.
+sampler = sensors.btu_sampler_from_settings(settings, scanner, run_metrics)
+
+# make a BTU meter for each loop; their settings come from the settings file.
+meters = sensors.btu_meters_from_settings(settings, sampler.read_adc)
+sampler.call_backs = [meter.sample for meter in meters]
+sched.watch(sampler)
+sampler.start()
+
+# Find the meter using each flow pin
+pin_meters = dict((meter.pin, meter) for meter in meters)
 
 # Start up the Input Pin Change Detector
-# I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
-chg_detect = input_change.InputChange([PIN_PULSE_IN], chg_detected, pull_up=False, debug_pin=debug_pin)
+sched.watch(chg_detect)
 chg_detect.start()
 
-# determine time to log count
-next_log_ts = time.time() + log_interval
-
-# index into temperature reading buffer arrays
-ix = 0
-
-while True:
-
-    if not chg_detect.isAlive() or not poster.isAlive():
-        # important thread is not running.  Exit with an error.
-        sys.exit(1)
-    
-    # Read temperatures and update buffer index
-    ad_hot[ix] = mcp.read_adc(ADC_CH_THOT)
-    ad_cold[ix] = mcp.read_adc(ADC_CH_TCOLD)
-    ix = (ix + 1) % BUF_LEN_TEMP
-
-    # Check to see if it is time to log
-    ts = time.time()
-    if ts > next_log_ts:
-        post_str = ''
-        ts = int(ts)
-        thot, tcold = current_temps()
-        for id, val in (('heat', heat_count), ('pulse', pulse_count), ('thot', thot), ('tcold', tcold)):
-            post_str += '%s\t%s_%s\t%s\n' % (ts, base_sensor_id, id, val)
-        poster.publish('readings/final/btu_meter', post_str)
-        if args.debug:
-            print pulse_count, heat_count, current_temps()
-        next_log_ts += log_interval
+# The capture file is written by a thread of its own.
+if capture_writer:
+    capture_writer.start()
 
-    time.sleep(0.05)
+def post_readings(ts):
+    """Posts the readings of all the loops, time-stamped with the Unix time 'ts'.
+    """
+    for meter in meters:
+        meter.post(readings_poster, ts)
+        if args.debug:
+            print(meter.debug_info())
+
+# Post on the wall clock multiples of the log interval, e.g. on the 10 minute
+# marks.  All loops use the same log interval.
+sched.every(meters[0].log_interval, post_readings)
+
+# Post the timing measurements, if turned on.
+if run_metrics:
+    sched.every(metrics_interval, lambda ts: run_metrics.post(poster, ts, settings.LOGGER_ID))
+
+# Sampling is done by the sampler thread, so the main thread sleeps until a post
+# is due or a worker thread stops.  If an important thread stops, save the counts
+# and exit with an error.
+sched.run()
+for meter in meters:
+    meter.save()
+if readings_poster is not poster:
+    readings_poster.flush()
+if capture_writer:
+    capture_writer.close()
+sys.exit(1)
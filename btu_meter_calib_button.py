@@ -9,6 +9,7 @@ the script if an error occurs.
 This script must be run with sudo because it writes to the /var/local 
 directory.
 """
+from __future__ import print_function
 import time
 import sys
 import os
@@ -18,6 +19,9 @@ import RPi.GPIO as GPIO
 import input_change
 import mqtt_poster
 import thermistor
+import sample_filter
+import counters
+import scheduler
 
 # Import SPI library (for hardware SPI) and MCP3008 library.
 import Adafruit_GPIO.SPI as SPI
@@ -79,18 +83,42 @@ min_delta_T = getattr(settings, 'BTU_MIN_DELTA_T', 0.2)
 # flag to determine if both transitions are counted
 count_both = getattr(settings, 'BTU_BOTH_EDGES', False)
 
+# type of filter used to average temperature readings: 'average' for a
+# running average of the last BUF_LEN_TEMP readings, or 'ema' for an
+# exponential moving average.
+temp_filter = getattr(settings, 'BTU_TEMP_FILTER', 'average')
+
+# number of readings to take the median of before averaging, to reject
+# noise spikes.  1 disables the median filter.
+temp_median = getattr(settings, 'BTU_TEMP_MEDIAN', 1)
+
+# flag to determine if the MQTT poster keeps one connection open to the broker
+# instead of connecting for each message.
+mqtt_persistent = getattr(settings, 'MQTT_PERSISTENT', False)
+
+# directory to queue MQTT messages in, so they survive a restart of this
+# script.  If None, messages are queued in memory.
+mqtt_spool_dir = getattr(settings, 'MQTT_SPOOL_DIR', None)
+
+# The scheduler runs the temperature sampling and the posting of readings, and
+# watches the worker threads.
+sched = scheduler.Scheduler()
+
 # start up the object that posts to the MQTT broker
-poster = mqtt_poster.MQTTposter()
+poster = mqtt_poster.MQTTposter(persistent=mqtt_persistent, spool_dir=mqtt_spool_dir)
+sched.watch(poster)
 poster.start()
 
 # make a thermistor object to convert A/D readings into temperature.
 # Using a 4.99 K divider resistor and a 10-bit A/D converter with max
-# value of 1023.
-therm = thermistor.Thermistor('BAPI 10K-3', appliedV=1023.0, dividerR=4990.0)
+# value of 1023.  A lookup table is used for the conversion, as it is done
+# every time a flow pulse occurs.
+therm = thermistor.Thermistor('BAPI 10K-3', appliedV=1023.0, dividerR=4990.0, lookup=True)
 
-# Initialize pulse count and heat count
-pulse_count = 0
-heat_count = 0.0
+# Initialize pulse count and heat count.  They are kept in a counter registry,
+# so the posting thread always reads them as a consistent pair.
+counts = counters.CounterRegistry(['pulse', 'heat'])
+PULSE, HEAT = counts.index('pulse'), counts.index('heat')
 
 # Set up MCP3008 A/D converter.  We are using the hardware SPI port
 # on the Raspberry Pi (to save CPU cycles).
@@ -98,14 +126,14 @@ SPI_PORT   = 0
 SPI_DEVICE = 0
 mcp = Adafruit_MCP3008.MCP3008(spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE))
 
-# Initialize arrays to hold hot and cold thermistor A/D readings.
-# These arrays are used to calculate a current reading that is
+# Initialize filters to hold hot and cold thermistor A/D readings.
+# These filters are used to calculate a current reading that is
 # an average of recent readings.  The raw A/D counts are stored
-# in the array to elimnate the CPU time needed to convert each into
+# in the filter to elimnate the CPU time needed to convert each into
 # a temperature.  Variation between the readings is small, so the
 # non-linearity of the count-->temperature function is not important.
-ad_hot = [mcp.read_adc(ADC_CH_THOT)] * BUF_LEN_TEMP
-ad_cold = [mcp.read_adc(ADC_CH_TCOLD)] * BUF_LEN_TEMP
+ad_hot = sample_filter.make_filter(temp_filter, BUF_LEN_TEMP, mcp.read_adc(ADC_CH_THOT), temp_median)
+ad_cold = sample_filter.make_filter(temp_filter, BUF_LEN_TEMP, mcp.read_adc(ADC_CH_TCOLD), temp_median)
 
 # read in the temperature calibration coefficients if the file exists
 if os.path.exists(PATH_CALIBRATE):
@@ -118,14 +146,14 @@ else:
 
 def current_temps(include_calibration=True):
     """Returns the current hot and cold temperatures, averaging the values
-    in the reading buffer.  If 'include_calibration' is True, apply the
+    in the reading filters.  If 'include_calibration' is True, apply the
     calibration values.
     """
-    thot = sum(ad_hot)/float(BUF_LEN_TEMP)
+    thot = ad_hot.value()
     thot = therm.TfromV(thot)
     if include_calibration:
         thot += calibrate_hot
-    tcold = sum(ad_cold)/float(BUF_LEN_TEMP)
+    tcold = ad_cold.value()
     tcold = therm.TfromV(tcold)
     if include_calibration:
         tcold += calibrate_cold
@@ -134,7 +162,6 @@ def current_temps(include_calibration=True):
 def chg_detected(pin_num, new_state):
     """This is called when any of watched input pins change state.
     """
-    global pulse_count, heat_count
     global calibrate_hot, calibrate_cold
 
     if pin_num == PIN_PULSE_IN:
@@ -146,16 +173,14 @@ def chg_detected(pin_num, new_state):
             if abs(delta_T) < min_delta_T:
                 delta_T = 0.0
 
-            pulse_count += 1
-            pulse_count = pulse_count % PULSE_ROLLOVER
-            heat_count += delta_T
-            heat_count = heat_count % HEAT_ROLLOVER
+            counts.add_pair(PULSE, 1, HEAT, delta_T)
 
     elif pin_num == PIN_CALIBRATE:
         if new_state == False:
             # Calibrate button was pressed
             # Check a second later to see if it is still pressed.
-            # Note that this interrupts pulse counting.
+            # This runs in the call back dispatch thread, so flow pulses keep
+            # being detected and are queued until this finishes.
             time.sleep(1.0)
             if GPIO.input(PIN_CALIBRATE)==False:
                 # blink LED to indicate that calibrate function will occur
@@ -176,37 +201,41 @@ def chg_detected(pin_num, new_state):
 
 # Start up the Input Pin Change Detector
 # I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
-chg_detect = input_change.InputChange([PIN_PULSE_IN, PIN_CALIBRATE], chg_detected, pull_up=False, debug_pin=debug_pin)
+# The call backs are dispatched to a separate thread, as the Calibrate button
+# handler sleeps and writes files.
+chg_detect = input_change.InputChange([PIN_PULSE_IN, PIN_CALIBRATE], chg_detected, pull_up=False,
+                                      debug_pin=debug_pin, dispatch=True)
+sched.watch(chg_detect)
+sched.watch(chg_detect.dispatcher)
 chg_detect.start()
 
-# determine time to log count
-next_log_ts = time.time() + log_interval
-
-# index into temperature reading buffer arrays
-ix = 0
-
-while True:
-
-    if not chg_detect.isAlive() or not poster.isAlive():
-        # important thread is not running.  Exit with an error.
-        sys.exit(1)
-    
-    # Read temperatures and update buffer index
-    ad_hot[ix] = mcp.read_adc(ADC_CH_THOT)
-    ad_cold[ix] = mcp.read_adc(ADC_CH_TCOLD)
-    ix = (ix + 1) % BUF_LEN_TEMP
-
-    # Check to see if it is time to log
-    ts = time.time()
-    if ts > next_log_ts:
-        post_str = ''
-        ts = int(ts)
-        thot, tcold = current_temps()
-        for id, val in (('heat', heat_count), ('pulse', pulse_count), ('thot', thot), ('tcold', tcold)):
-            post_str += '%s\t%s_%s\t%s\n' % (ts, base_sensor_id, id, val)
-        poster.publish('readings/final/btu_meter', post_str)
-        if args.debug:
-            print pulse_count, heat_count, current_temps()
-        next_log_ts += log_interval
-
-    time.sleep(0.05)
+def read_temps(ts):
+    """Reads temperatures into the filters.
+    """
+    ad_hot.add(mcp.read_adc(ADC_CH_THOT))
+    ad_cold.add(mcp.read_adc(ADC_CH_TCOLD))
+
+def post_readings(ts):
+    """Posts the readings, time-stamped with the Unix time 'ts'.
+    """
+    post_str = ''
+    ts = int(ts)
+    thot, tcold = current_temps()
+    pulse_count, heat_count = counts.snapshot()
+    pulse_count = counters.wrap(pulse_count, PULSE_ROLLOVER)
+    heat_count = counters.wrap(heat_count, HEAT_ROLLOVER)
+    for id, val in (('heat', heat_count), ('pulse', pulse_count), ('thot', thot), ('tcold', tcold)):
+        post_str += '%s\t%s_%s\t%s\n' % (ts, base_sensor_id, id, val)
+    poster.publish('readings/final/btu_meter', post_str)
+    if args.debug:
+        print(pulse_count, heat_count, current_temps(),
+              chg_detect.dispatcher.overflows, chg_detect.dispatcher.max_latency)
+
+# Take temperature readings every 50 ms, and post on the wall clock multiples
+# of the log interval, e.g. on the 10 minute marks.
+sched.every(0.05, read_temps, align=False)
+sched.every(log_interval, post_readings)
+
+# Run until an important thread stops, then exit with an error.
+sched.run()
+sys.exit(1)
@@ -0,0 +1,266 @@
+"""
+Capture files, which record the raw input pin levels, the debounced pin
+transitions and the A/D counts seen by a sensor script, so that a problem
+seen in the field (missed pulses, odd heat totals, noisy thermistors) can be
+studied later by replaying the file through the sensor logic; see 'replay.py'.
+
+A capture file is a 16 byte header followed by 16 byte records, so any record
+can be found by its index and the file can be memory-mapped:
+
+    header:   8s   magic, 'PICAPT01'
+              d    Unix time minus clock.monotonic() at the start of the capture,
+                       which converts record times to Unix times
+    record:   d    time, from clock.monotonic()
+              B    record kind, one of the constants below
+              B    pin number (BCM) or A/D channel
+              H    unused, zero
+              I    value: the level bitmask, pin state or A/D count
+
+Records from different threads are written in the order they are captured,
+so records are only in approximate time order.
+
+Each run of a script writes a new file, named with its start time, so the
+records leading up to a crash are still there after the supervisor restarts
+the script.  The records are written to the file by a thread of their own,
+so a slow SD card write never holds up the thread sampling the pins.
+"""
+import os
+import glob
+import time
+import mmap
+import heapq
+import errno
+import fcntl
+import select
+import struct
+import threading
+import clock
+
+HEADER = struct.Struct('<8sd')
+RECORD = struct.Struct('<dBBHI')
+MAGIC = b'PICAPT01'
+
+# Record kinds
+LEVELS = 1        # raw pin levels read by InputChange; value is a bitmask, bit N = pin N
+EDGE = 2          # raw edge event seen by EdgeInputChange; value is the pin level
+TRANSITION = 3    # debounced transition passed to the call back; value is the new state
+ADC = 4           # A/D count read by an adc_scanner.MCP3008Scanner; 'pin' is the channel
+
+kind_names = {LEVELS: 'levels', EDGE: 'edge', TRANSITION: 'transition', ADC: 'adc'}
+
+
+class CaptureWriter(threading.Thread):
+
+    def __init__(self, path, max_bytes=100000000, flush_interval=5.0, keep_files=5):
+        """Writes records to a new capture file named from 'path' with the start time
+        added, e.g. 'capture_20170714_093000.dat' for 'capture.dat'.  The file name is
+        in 'path' after construction.
+        'max_bytes' is the largest the file is allowed to grow to; records past that
+            are dropped and counted in 'dropped'.
+        'flush_interval' is the most seconds that records are held in memory before
+            being written to the file.
+        'keep_files' is the number of capture files kept, counting the new one; the
+            oldest files of earlier runs are removed.
+        The records are written by this thread, so start it.  The other methods can
+        be called from any thread, and add() only copies the record into memory.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.max_records = (max_bytes - HEADER.size) // RECORD.size
+        self.flush_interval = flush_interval
+        self.count = 0          # number of records captured
+        self.dropped = 0        # number of records dropped because the file was full
+        self.blocks = []        # full blocks of records waiting to be written
+        self.buf = bytearray(RECORD.size * 1024)
+        self.buf_ix = 0
+        self.lock = threading.Lock()            # guards the records held in memory
+        self.write_lock = threading.Lock()      # guards the file
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        self.path = new_capture_path(path, keep_files)
+        self.fout = open(self.path, 'wb')
+        self.fout.write(HEADER.pack(MAGIC, time.time() - clock.monotonic()))
+        self.fout.flush()
+
+    def add(self, ts, kind, pin, value):
+        """Adds a record of 'kind' for 'pin' with 'value', captured at time 'ts'.
+        """
+        with self.lock:
+            if self.count >= self.max_records:
+                self.dropped += 1
+                return
+            RECORD.pack_into(self.buf, self.buf_ix, ts, kind, pin, 0, value)
+            self.buf_ix += RECORD.size
+            self.count += 1
+            if self.buf_ix == len(self.buf):
+                # hand the full block to the thread and start another
+                self.blocks.append(self.buf)
+                self.buf = bytearray(len(self.buf))
+                self.buf_ix = 0
+                try:
+                    os.write(self.wake_w, b'x')
+                except OSError:
+                    # the pipe is full, so the thread has wake-ups waiting already
+                    pass
+
+    def levels(self, ts, levels):
+        self.add(ts, LEVELS, 0, levels)
+
+    def edge(self, ts, pin, level):
+        self.add(ts, EDGE, pin, level)
+
+    def transition(self, ts, pin, state):
+        self.add(ts, TRANSITION, pin, state)
+
+    def adc(self, ts, ch, count):
+        self.add(ts, ADC, ch, count)
+
+    def run(self):
+        # write the records every 'flush_interval' seconds, or when a block fills
+        while True:
+            try:
+                readable, _, _ = select.select([self.wake_r], [], [], self.flush_interval)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if readable:
+                os.read(self.wake_r, 4096)
+            self.flush()
+
+    def flush(self):
+        """Writes any records held in memory to the file.
+        """
+        with self.write_lock:
+            with self.lock:
+                blocks = self.blocks
+                blocks.append(self.buf[:self.buf_ix])
+                self.blocks = []
+                self.buf_ix = 0
+            if self.fout.closed:
+                return
+            for block in blocks:
+                self.fout.write(block)
+            self.fout.flush()
+
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            self.fout.close()
+
+
+def new_capture_path(path, keep_files=5):
+    """Returns the name of a new capture file for 'path', with the current time
+    added to it, and removes the oldest capture files made for 'path' before, so
+    that at most 'keep_files' - 1 of them are left.
+    """
+    root, ext = os.path.splitext(path)
+    old_paths = sorted(glob.glob('%s_????????_??????*%s' % (root, ext)))
+    for old_path in old_paths[:max(0, len(old_paths) - keep_files + 1)]:
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+    new_path = '%s_%s%s' % (root, time.strftime('%Y%m%d_%H%M%S'), ext)
+    n = 1
+    while os.path.exists(new_path):
+        # more than one start in a second
+        new_path = '%s_%s_%d%s' % (root, time.strftime('%Y%m%d_%H%M%S'), n, ext)
+        n += 1
+    return new_path
+
+
+class CaptureReader:
+
+    def __init__(self, path):
+        """Reads the capture file at 'path' through a memory map.  The object is a
+        sequence of (time, kind, pin, value) records; 'wall_offset' converts the
+        record times to Unix times.  A partly written last record is ignored.
+        """
+        self.fin = open(path, 'rb')
+        size = os.fstat(self.fin.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError('%s is not a capture file' % path)
+        self.mm = mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.wall_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        self.count = (size - HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('capture record index out of range')
+        ts, kind, pin, _, value = RECORD.unpack_from(self.mm, HEADER.size + i * RECORD.size)
+        return ts, kind, pin, value
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def records(self, kinds=None):
+        """Returns a list of the records, sorted on time.  If 'kinds' is given, only
+        records of those kinds are included.
+        """
+        recs = [rec for rec in self if kinds is None or rec[1] in kinds]
+        # a stable sort keeps records with the same time in the order captured
+        recs.sort(key=lambda rec: rec[0])
+        return recs
+
+    def sorted_records(self, kinds=None, window=4096):
+        """Like records(), but a generator that holds at most 'window' records in
+        memory, so files larger than the memory can be read.  Records are only out
+        of order by a few records (see the module docstring), so sorting within a
+        sliding window of records puts them in time order.
+        """
+        heap = []
+        for i, rec in enumerate(self):
+            if kinds is None or rec[1] in kinds:
+                # the index keeps records with the same time in the order captured
+                heapq.heappush(heap, (rec[0], i, rec))
+                if len(heap) > window:
+                    yield heapq.heappop(heap)[2]
+        while heap:
+            yield heapq.heappop(heap)[2]
+
+    def close(self):
+        self.mm.close()
+        self.fin.close()
+
+
+def writer_from_settings(settings):
+    """Returns a CaptureWriter, not yet started, for the file named in the
+    CAPTURE_PATH setting of the Mini-Monitor 'settings' module, or None if
+    capturing is not turned on.
+    """
+    path = getattr(settings, 'CAPTURE_PATH', None)
+    if not path:
+        return None
+    # the capture stops when the file reaches this many megabytes
+    max_mb = getattr(settings, 'CAPTURE_MAX_MB', 100)
+    # number of capture files kept, one from each run of the script
+    keep_files = getattr(settings, 'CAPTURE_KEEP', 5)
+    return CaptureWriter(path, max_bytes=int(max_mb * 1000000), keep_files=keep_files)
+
+
+if __name__ == '__main__':
+
+    # Prints a summary and the first records of the capture file given on the command line
+    import sys
+
+    reader = CaptureReader(sys.argv[1])
+    n = len(reader)
+    print('%d records' % n)
+    if n:
+        print('%.3f seconds, starting %s' % (reader[-1][0] - reader[0][0],
+                                            time.ctime(reader[0][0] + reader.wall_offset)))
+        for kind, name in sorted(kind_names.items()):
+            print('%-12s %d' % (name, sum(1 for rec in reader if rec[1] == kind)))
+        for ts, kind, pin, value in reader.records()[:20]:
+            print('%.4f  %-12s %2d  %d' % (ts, kind_names.get(kind, kind), pin, value))
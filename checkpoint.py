@@ -0,0 +1,157 @@
+"""
+Periodically saves counter values to a file so they can be restored when a
+sensor script is restarted by its supervisor.
+
+The file has two fixed-size slots that are written alternately.  Each slot
+holds a sequence number, the length and a CRC32 of its contents, so if the
+power fails part way through a write, the other slot still holds the
+previous good checkpoint.  Writes happen in a separate thread, and only
+after a number of pulses or a time interval, to limit wear on the SD card.
+The thread sleeps in select() on a pipe that tick() writes to, for the
+reason given in scheduler.py.
+"""
+import os
+import errno
+import fcntl
+import json
+import select
+import struct
+import threading
+import time
+import zlib
+import clock
+
+MAGIC = b'CKPT'
+
+# Header of each slot: magic, sequence number, length of contents, CRC32 of contents
+HEADER = struct.Struct('<4sQII')
+
+
+class Checkpoint(threading.Thread):
+
+    def __init__(self, path, get_state, pulses=100, interval=300.0, slot_size=4096):
+        """'path' is the checkpoint file.
+        'get_state' is a function returning a dictionary of values to save; it must be
+            convertible to JSON.
+        'pulses' is the number of tick() calls that cause a save.
+        'interval' is the maximum number of seconds between saves, if the state has
+            changed.
+        'slot_size' is the size in bytes of each of the two slots in the file.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.get_state = get_state
+        self.pulses = pulses
+        self.interval = interval
+        self.slot_size = slot_size
+        self.seq = 0            # sequence number of the last checkpoint read or written
+        self.ticks = 0          # number of tick() calls since the last save
+        self.last_state = None
+        self.lock = threading.Lock()    # save() runs in this thread and at exit
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def load(self):
+        """Returns the dictionary held in the newest valid slot, or None if there
+        isn't one.  Call this before starting the thread.
+        """
+        try:
+            with open(self.path, 'rb') as fin:
+                contents = fin.read()
+        except EnvironmentError:
+            return None
+
+        best = None
+        for slot in range(2):
+            record = contents[slot * self.slot_size:(slot + 1) * self.slot_size]
+            if len(record) < HEADER.size:
+                continue
+            magic, seq, length, crc = HEADER.unpack_from(record)
+            data = record[HEADER.size:HEADER.size + length]
+            if magic != MAGIC or len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+                continue
+            if best is None or seq > best[0]:
+                best = (seq, data)
+        if best is None:
+            return None
+        self.seq = best[0]
+        self.last_state = json.loads(best[1].decode('utf-8'))
+        return self.last_state
+
+    def tick(self):
+        """Call when a pulse is counted.  Never blocks.
+        """
+        self.ticks += 1
+        if self.ticks == self.pulses:
+            try:
+                os.write(self.wake_w, b'x')
+            except OSError:
+                # the pipe is full, so the thread has wake-ups waiting already
+                pass
+
+    def run(self):
+        while True:
+            # sleep until 'pulses' ticks or 'interval' seconds since the last save
+            deadline = clock.monotonic() + self.interval
+            while True:
+                delay = deadline - clock.monotonic()
+                if delay <= 0.0:
+                    break
+                try:
+                    readable, _, _ = select.select([self.wake_r], [], [], delay)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    os.read(self.wake_r, 4096)
+                    break
+            self.ticks = 0
+            self.save()
+
+    def save(self):
+        """Saves the current state into the older slot, if it has changed.  Safe to
+        call from another thread, e.g. the main thread at exit.
+        """
+        with self.lock:
+            self._save()
+
+    def _save(self):
+        state = self.get_state()
+        if state == self.last_state:
+            return
+        data = json.dumps(state).encode('utf-8')
+        if HEADER.size + len(data) > self.slot_size:
+            raise ValueError('Checkpoint state is larger than the slot size.')
+        seq = self.seq + 1
+        record = HEADER.pack(MAGIC, seq, len(data), zlib.crc32(data) & 0xffffffff) + data
+        try:
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.lseek(fd, (seq % 2) * self.slot_size, os.SEEK_SET)
+                os.write(fd, record)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except EnvironmentError:
+            # can't write the checkpoint; counting is more important, so carry on.
+            return
+        self.seq = seq
+        self.last_state = state
+
+
+if __name__=='__main__':
+
+    # Test routine and usage example
+    counts = {'pulse': 0}
+    cp = Checkpoint('/tmp/checkpoint_test', lambda: dict(counts), pulses=10, interval=1.0)
+    print('restored: %s' % cp.load())
+    cp.start()
+    for i in range(25):
+        counts['pulse'] += 1
+        cp.tick()
+        time.sleep(0.1)
+    time.sleep(1.5)
+    print('saved: %s' % Checkpoint('/tmp/checkpoint_test', None).load())
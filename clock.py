@@ -0,0 +1,31 @@
+"""
+Clock used by the sensor modules for measuring intervals.  Python 3 provides
+time.monotonic(); on Python 2 the same Linux clock is read through ctypes.
+Unlike time.time(), this clock does not jump when NTP sets the system time,
+which happens often on a Pi since it has no real-time clock.
+"""
+import time
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    import ctypes
+    import ctypes.util
+
+    CLOCK_MONOTONIC = 1
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        """Returns the value of the monotonic clock in seconds.
+        """
+        t = timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime failed')
+        return t.tv_sec + t.tv_nsec * 1e-9
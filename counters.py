@@ -0,0 +1,117 @@
+"""
+Counters that are added to by one thread, such as the InputChange call back
+or the A/D sampling thread, and read by others: the main thread posting the
+readings and the checkpoint thread saving them.
+
+The counters are held in one preallocated array of doubles, indexed on
+channel number.  A double holds whole numbers exactly up to 2**53, so the
+counters are kept wide and never roll over here; the ROLLOVER and
+HEAT_ROLLOVER wraps that Mini-Monitor expects are applied only when the
+readings are posted.
+
+Several counters that change together, like the pulse and heat counts of a
+BTU meter, are read consistently through a version number, as a seqlock
+does: the writer makes the version odd while it updates and even again when
+done, and a reader copies the array and retries if the version was odd or
+changed during the copy.  Adding to a counter takes no lock, so the call
+back that counts a pulse is never held up by a reader.  There must be only
+one writer.
+"""
+from array import array
+
+
+class CounterRegistry:
+
+    def __init__(self, names):
+        """Holds one counter for each item in the list 'names', starting at zero.
+        Counters can be referred to by their channel number, their position in
+        'names', which is faster, or by name through index().
+        """
+        self.names = list(names)
+        self.indexes = dict((name, ix) for ix, name in enumerate(self.names))
+        self.values = array('d', [0.0] * len(self.names))
+        self.version = 0
+
+    def index(self, name):
+        """Returns the channel number of the counter called 'name'.
+        """
+        return self.indexes[name]
+
+    def add(self, ix, val=1):
+        """Adds 'val' to counter number 'ix'.
+        """
+        self.version += 1
+        self.values[ix] += val
+        self.version += 1
+
+    def add_pair(self, ix1, val1, ix2, val2):
+        """Adds 'val1' to counter number 'ix1' and 'val2' to counter number 'ix2',
+        so that no snapshot holds one change without the other.
+        """
+        self.version += 1
+        self.values[ix1] += val1
+        self.values[ix2] += val2
+        self.version += 1
+
+    def set(self, ix, val):
+        """Sets counter number 'ix' to 'val', e.g. when restoring from a checkpoint.
+        """
+        self.version += 1
+        self.values[ix] = val
+        self.version += 1
+
+    def snapshot(self):
+        """Returns a list of the values of all of the counters, in channel order,
+        as they were at one moment.
+        """
+        while True:
+            version = self.version
+            if version % 2 == 0:
+                values = self.values.tolist()
+                if self.version == version:
+                    return values
+
+    def items(self):
+        """Returns a list of (name, value) pairs of a snapshot of the counters.
+        """
+        return list(zip(self.names, self.snapshot()))
+
+    def value(self, ix):
+        """Returns the value of counter number 'ix'.
+        """
+        return self.values[ix]
+
+
+def wrap(val, rollover):
+    """Returns the counter value 'val' wrapped to the range 0 up to 'rollover', for
+    posting.  Whole numbers are returned as integers.
+    """
+    val = val % rollover
+    if val == int(val) and isinstance(rollover, int):
+        return int(val)
+    return val
+
+
+if __name__ == '__main__':
+
+    # Test routine, checking that snapshots of two counters that always change
+    # together are never torn while another thread adds to them.
+    import threading
+
+    reg = CounterRegistry(['pulse', 'heat'])
+    PULSE, HEAT = reg.index('pulse'), reg.index('heat')
+
+    def writer():
+        while True:
+            reg.add_pair(PULSE, 1, HEAT, 2.5)
+
+    t = threading.Thread(target=writer)
+    t.daemon = True
+    t.start()
+    torn = 0
+    for i in range(200000):
+        pulse, heat = reg.snapshot()
+        if heat != pulse * 2.5:
+            torn += 1
+    print('%d snapshots torn, %d pulses counted' % (torn, reg.value(PULSE)))
+    print('posted as %s, %s' % (wrap(reg.value(PULSE), 1000000), wrap(reg.value(HEAT), 1000000.0)))
@@ -0,0 +1,156 @@
+"""
+A minimal in-process MQTT 3.1.1 broker, used to exercise MQTTposter without
+a real broker.  It accepts connections, acknowledges QoS 1 publishes and
+records every message it receives; it does not forward messages to
+subscribers.  The broker can drop its client connections or refuse new ones
+to imitate a broker that is intermittently available.
+"""
+import socket
+import threading
+import time
+
+
+class FakeBroker(threading.Thread):
+
+    def __init__(self, port=0, host='127.0.0.1', ack_delay=0.0):
+        """'port' is the port to listen on; 0 picks a free port, which is then
+        available in the 'port' attribute.
+        'ack_delay' is the number of seconds to wait before acknowledging each
+        QoS 1 publish, to imitate a slow link.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.host = host
+        self.port = self.sock.getsockname()[1]
+        self.ack_delay = ack_delay
+        self.messages = []       # (topic, payload) of each message received, in order
+        self.connects = 0        # number of connections accepted
+        self.refuse = False      # if True, new connections are closed immediately
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                return        # listening socket was closed
+            if self.refuse:
+                conn.close()
+                continue
+            with self.lock:
+                self.clients.append(conn)
+                self.connects += 1
+            handler = threading.Thread(target=self.handle, args=(conn,))
+            handler.daemon = True
+            handler.start()
+
+    def handle(self, conn):
+        """Processes the packets sent on one client connection.
+        """
+        try:
+            while True:
+                header = recv_exact(conn, 1)[0]
+                length = 0
+                shift = 0
+                while True:
+                    b = recv_exact(conn, 1)[0]
+                    length += (b & 0x7F) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = recv_exact(conn, length)
+                packet_type = header >> 4
+
+                if packet_type == 1:          # CONNECT
+                    conn.sendall(bytearray([0x20, 2, 0, 0]))
+                elif packet_type == 3:        # PUBLISH
+                    qos = (header >> 1) & 3
+                    topic_len = (body[0] << 8) + body[1]
+                    topic = body[2:2 + topic_len].decode('utf-8')
+                    pos = 2 + topic_len
+                    if qos:
+                        pid = body[pos:pos + 2]
+                        pos += 2
+                    with self.lock:
+                        self.messages.append((topic, bytes(body[pos:])))
+                    if qos:
+                        if self.ack_delay:
+                            time.sleep(self.ack_delay)
+                        conn.sendall(bytearray([0x40, 2]) + pid)
+                elif packet_type == 12:       # PINGREQ
+                    conn.sendall(bytearray([0xD0, 0]))
+                elif packet_type == 14:       # DISCONNECT
+                    break
+        except (socket.error, EOFError):
+            pass
+        finally:
+            conn.close()
+            with self.lock:
+                if conn in self.clients:
+                    self.clients.remove(conn)
+
+    def drop_clients(self):
+        """Closes all client connections, as happens when the broker restarts.
+        """
+        with self.lock:
+            clients = list(self.clients)
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        """Stops listening and drops all clients.
+        """
+        self.sock.close()
+        self.drop_clients()
+
+
+def recv_exact(conn, n):
+    """Returns exactly 'n' bytes read from socket 'conn' as a bytearray.
+    Raises EOFError if the connection closes first.
+    """
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise EOFError
+        buf.extend(chunk)
+    return buf
+
+
+if __name__=='__main__':
+
+    # Test routine: deliver messages through an MQTTposter while the broker
+    # refuses connections and drops clients part way through.
+    import mqtt_poster
+
+    broker = FakeBroker(ack_delay=0.01)
+    broker.start()
+    for persistent in (False, True):
+        del broker.messages[:]
+        broker.connects = 0
+        poster = mqtt_poster.MQTTposter(port=broker.port, persistent=persistent)
+        poster.start()
+        broker.refuse = True
+        for i in range(200):
+            poster.publish('test/topic', 'msg %d' % i)
+        time.sleep(1.5)
+        broker.refuse = False
+        start = time.time()
+        # drop the connection part way through the messages, so the persistent
+        # poster has to reconnect and resend the ones in flight
+        while len(broker.messages) < 100 and time.time() - start < 60:
+            time.sleep(0.01)
+        broker.drop_clients()
+        while len(set(broker.messages)) < 200 and time.time() - start < 60:
+            time.sleep(0.1)
+        received = set(payload for topic, payload in broker.messages)
+        print('persistent=%s: %d of 200 delivered, %d received in total, %d connections, %.1f s' % \
+            (persistent, len(received), len(broker.messages), broker.connects, time.time() - start))
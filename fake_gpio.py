@@ -0,0 +1,100 @@
+"""
+Stand-in for the RPi.GPIO module, so that code that reads input pins can be
+exercised on a machine that is not a Raspberry Pi.  An instance of FakeGPIO
+can be passed wherever a 'gpio' module is accepted, e.g. the 'gpio' parameter
+of the input_change classes.  Pin levels are set by calling 'set_input()',
+which also fires any edge callbacks registered with 'add_event_detect()', in
+the same way the real module does from its event thread.
+"""
+import threading
+
+
+class FakeGPIO(object):
+
+    # Constants with the same names and values as the RPi.GPIO module
+    LOW = 0
+    HIGH = 1
+    OUT = 0
+    IN = 1
+    BOARD = 10
+    BCM = 11
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, levels=None):
+        """'levels' is an optional dictionary, keyed on pin number, of the
+        starting level (0 or 1) of input pins.  Pins not present take on
+        the level given by their pull-up/down setting when they are set up.
+        """
+        self.mode = None
+        self.levels = dict(levels or {})   # current level of each pin
+        self.outputs = {}                  # last value written to each output pin
+        self.callbacks = {}                # pin -> (edge, list of callback functions)
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=PUD_OFF, initial=None):
+        if direction == self.IN:
+            if pin not in self.levels:
+                self.levels[pin] = 1 if pull_up_down == self.PUD_UP else 0
+        else:
+            self.outputs[pin] = initial or 0
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def input_levels(self):
+        """Returns the levels of all pins as a bitmask where bit N is pin N, like a
+        read of the GPIO level register.
+        """
+        levels = 0
+        for pin, level in list(self.levels.items()):
+            if level:
+                levels |= 1 << pin
+        return levels
+
+    def output(self, pin, value):
+        self.outputs[pin] = int(bool(value))
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.callbacks[pin] = (edge, [callback] if callback else [])
+
+    def add_event_callback(self, pin, callback):
+        with self.lock:
+            self.callbacks[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.callbacks.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        with self.lock:
+            if pin is None:
+                self.callbacks.clear()
+            else:
+                self.callbacks.pop(pin, None)
+
+    def set_input(self, pin, level):
+        """Sets the level of input 'pin' to 'level' (0/1 or False/True) and
+        calls any edge callbacks that the change triggers.
+        """
+        level = int(bool(level))
+        if self.levels.get(pin, 0) == level:
+            return
+        self.levels[pin] = level
+        with self.lock:
+            edge, funcs = self.callbacks.get(pin, (None, []))
+            funcs = list(funcs)
+        if edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level):
+            for func in funcs:
+                func(pin)
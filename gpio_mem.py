@@ -0,0 +1,47 @@
+"""
+Reads the level of every GPIO pin at once from the GPIO level register of
+the Broadcom SoC used in the Raspberry Pi 1 - 4.  The register is reached
+through the '/dev/gpiomem' device, which does not require root access.
+One read of the register returns the state of BCM pins 0 - 31, which
+includes every pin on the 40-pin header, so checking many pulse inputs costs
+no more than checking one.
+"""
+import os
+import mmap
+import ctypes
+
+# Byte offset of the GPLEV0 (pin level, pins 0 - 31) register in the GPIO block
+GPLEV0 = 0x34
+
+# The Pi 5 moved its GPIO to the RP1 chip, which has a different register layout.
+UNSUPPORTED_SOCS = ('bcm2712',)
+
+
+class GpioMem(object):
+
+    def __init__(self, path='/dev/gpiomem'):
+        """Maps the GPIO register block.  Raises an EnvironmentError if the
+        device is not available or the SoC has an unsupported register layout.
+        """
+        try:
+            with open('/proc/device-tree/compatible', 'rb') as fin:
+                compatible = fin.read().decode('ascii', 'replace')
+        except EnvironmentError:
+            compatible = ''
+        for soc in UNSUPPORTED_SOCS:
+            if soc in compatible:
+                raise EnvironmentError('GPIO level register not supported on %s' % soc)
+
+        fd = os.open(path, os.O_RDWR | os.O_SYNC)
+        try:
+            self.mem = mmap.mmap(fd, 4096, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        # a ctypes view of the register, so each read is a single 32-bit load
+        self.lev0 = ctypes.c_uint32.from_buffer(self.mem, GPLEV0)
+
+    def levels(self):
+        """Returns a bitmask of the levels of BCM pins 0 - 31; bit N is pin N.
+        """
+        return self.lev0.value
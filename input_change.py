@@ -1,15 +1,36 @@
 #!/usr/bin/python
+from __future__ import print_function
+import os
+import errno
+import fcntl
+import select
 import threading
 import time
-import RPi.GPIO as GPIO
+import collections
+from array import array
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Not running on a Pi.  A stand-in GPIO module, such as a fake_gpio.FakeGPIO
+    # object, must be passed to the classes below.
+    GPIO = None
+import gpio_mem
+import clock
+from metrics import READ_GAP_BOUNDS_MS
 
 class InputChange(threading.Thread):
 
-    def __init__(self, pins, call_back, pull_up=False, read_gap=3.0, buffer_len=8, debug_pin=None):
+    def __init__(self, pins, call_back, pull_up=False, read_gap=3.0, buffer_len=8, debug_pin=None,
+                 gpio=None, bulk_read=True, timestamps=False, dispatch=False, queue_len=256,
+                 capture=None, idle_gap=None, idle_after=2.0, metrics=None):
         """Class to detect changes in a set of input pins.  Each pin is debounced by looking
         for a stable set of readings of the new state to occur.  After 'buffer_len' readings
         of the new state, spaced 'read_gap' milliseconds apart, a transition is deemed to 
         have occurred.
+        The pins are read into one bitmask per pass, and a pin is only examined further
+        if it differs from its current state or is part way through a transition, where a
+        counter of consecutive new-state readings is kept.  So, an idle pass costs the same
+        no matter how many pins are watched or how long 'buffer_len' is.
         Constructor parameters are:
             pins              list of pin numbers (BCM) to detect transitions on
             call_back         function to call when a transition occurs.  The pin number, 
@@ -19,13 +40,40 @@ class InputChange(threading.Thread):
             read_gap          number of milliseconds between reads of the input pins
             buffer_len        number of stable reads required before a transition is deemed
             debug_pin         pin number to toggle at every point a set of input pin reads occur
+            gpio              module used to access the pins; defaults to RPi.GPIO.  Pass a
+                                  fake_gpio.FakeGPIO object to run without a Pi.
+            bulk_read         if True, read all of the pins with one access to the GPIO level
+                                  register (see gpio_mem.py) when it is available.  Otherwise,
+                                  pins are read one at a time.
+            timestamps        if True, a third parameter is passed to 'call_back': the time,
+                                  from clock.monotonic(), at which the transition was deemed.
+            dispatch          if True, 'call_back' is run in a separate thread (see
+                                  CallbackDispatcher), so a slow call back does not delay
+                                  the reading of the pins.  Transitions wait in a queue of
+                                  'queue_len' entries; the 'dispatcher' attribute holds
+                                  counts of queue overflows and the worst call back latency.
+            capture           if not None, a capture.CaptureWriter that records each change
+                                  in the raw pin levels and each transition.
+            idle_gap          if not None, the number of milliseconds between reads when idle.
+                                  After 'idle_after' seconds with no pin differing from its
+                                  state, the pins are read every 'idle_gap' ms instead of every
+                                  'read_gap' ms, saving CPU wake-ups.  The first read that finds
+                                  a pin changed returns to reading every 'read_gap' ms.
+            metrics           if not None, a metrics.Metrics object that records the actual
+                                  gap between reads, how late the thread wakes for each read,
+                                  and how long the call back takes, all in milliseconds.
+        Reads are scheduled on fixed deadlines 'read_gap' ms apart, so the time spent reading
+        does not lengthen the gap.  A new level is sure to be detected if it is held for
+        min_level_time() ms: 'buffer_len' * 'read_gap' when reading at full speed, and
+        'idle_gap' + ('buffer_len' - 1) * 'read_gap' for the first change after an idle
+        period (e.g. 50 + 7 * 3 = 71 ms), plus any delay in waking the thread.
         With read_gap=3 ms and buffer_len=8 and a no-bounce signal, this worked accurately at 15 Hz,
         but limiting its use to 10 Hz would be better due to following calculation:
-        With read_gap=3 ms, actual read gap is closer
-        to 3.3 ms.  Then occasional long sleeps can be 16 ms. With one long sleep in the buffer,
-        total stable time needs to be: 3.3 ms * 7 + 16 ms = 39 ms.  One cycle has two stable
-        states, so total readable period is 39 ms * 2 = 78 ms, or a frequency of 12.8 Hz.  Thus
-        10 Hz is a good limit.
+        Occasional long sleeps can be 16 ms. With one long sleep in the buffer,
+        total stable time needs to be: 3 ms * 7 + 16 ms = 37 ms.  One cycle has two stable
+        states, so total readable period is 37 ms * 2 = 74 ms, or a frequency of 13.5 Hz.  Thus
+        10 Hz is a good limit.  With idle reading, the first pulse after an idle period must
+        also satisfy the idle minimum above.
         """
 
         # run constructor of base class
@@ -41,51 +89,423 @@ class InputChange(threading.Thread):
         self.read_gap = read_gap           # milliseconds of gap between readings of input
         self.buffer_len = buffer_len       # number of readings required to declare new state
         self.debug_pin = debug_pin         # pin to toggle at each read. If None, no toggle
+        self.gpio = gpio or GPIO           # module used to access the pins
+        self.bulk_read = bulk_read         # if True, read all pins in one register access
+        self.timestamps = timestamps       # if True, pass the transition time to call_back
 
-        # Set up GPIO module and input pins
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setwarnings(False)
-        for pin in self.pins:
-            if pull_up:
-                GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            else:
-                GPIO.setup(pin, GPIO.IN)
+        self.capture = capture             # records pin levels and transitions, if not None
+        self.idle_gap = idle_gap           # milliseconds between reads when idle; None to not idle
+        self.idle_after = idle_after       # seconds without changes before idling
+        self.idle = False                  # True while reading at the idle rate
+        self.metrics = metrics             # records timing of the reads, if not None
+
+        # thread that runs call_back, if dispatching
+        self.dispatcher = CallbackDispatcher(call_back, queue_len, timestamps, metrics) if dispatch else None
 
+        setup_pins(self.gpio, self.pins, pull_up)
         if debug_pin:                            # this works cuz there is no zero pin.
-            GPIO.setup(debug_pin, GPIO.OUT)
+            self.gpio.setup(debug_pin, self.gpio.OUT)
+
+    def level_reader(self):
+        """Returns a function that reads all of the watched pins, returning a bitmask
+        where bit N holds the level of pin N.
+        """
+        gpio = self.gpio
+        if hasattr(gpio, 'input_levels'):
+            # the GPIO module can read all the pins itself
+            return gpio.input_levels
+        if self.bulk_read and gpio is GPIO and max(self.pins) < 32:
+            try:
+                return gpio_mem.GpioMem().levels
+            except EnvironmentError:
+                pass
+
+        pin_bits = [(pin, 1 << pin) for pin in self.pins]
+        def read_levels():
+            levels = 0
+            for pin, bit in pin_bits:
+                if gpio.input(pin):
+                    levels |= bit
+            return levels
+        return read_levels
+
+    def min_level_time(self, idle=False):
+        """Returns the number of milliseconds a new pin level must be held to be sure
+        of being detected, not counting delays in waking the thread.  If 'idle' is
+        True, the time for the first change after an idle period is returned.
+        """
+        first_read = self.idle_gap if idle and self.idle_gap else self.read_gap
+        return first_read + (self.buffer_len - 1) * self.read_gap
+
+    def is_alive(self):
+        """True if the thread, and the call back dispatcher if there is one, are running.
+        """
+        return threading.Thread.is_alive(self) and (self.dispatcher is None or self.dispatcher.is_alive())
+
+    # the Python 2 name, which Python 3.9 removed from threading.Thread
+    isAlive = is_alive
 
     def run(self):
 
-        # these dictionaries are keyed on pin number
-        cur_state = {}
-        state_reads = {}
-        for pin in self.pins:
-            # initialize both current and buffer to current pin state
-            cur_state[pin] = GPIO.input(pin)
-            state_reads[pin] = [cur_state[pin]] * self.buffer_len
+        if self.dispatcher:
+            self.dispatcher.start()
+
+        read_levels = self.level_reader()
+        pin_from_bit = dict((1 << pin, pin) for pin in self.pins)
+        mask = sum(pin_from_bit.keys())     # bits of the watched pins
+
+        # bitmask holding the current state of each pin
+        cur_state = read_levels() & mask
+
+        # number of consecutive readings of the new state for pins that are in
+        # the middle of a transition, keyed on the pin's bit.
+        new_reads = {}
+
         debug_state = False
 
-        ix = 0
+        capture = self.capture
+        if capture:
+            capture.levels(clock.monotonic(), cur_state)
+        last_levels = cur_state
+
+        gap = self.read_gap / 1000.0
+        idle_gap = self.idle_gap / 1000.0 if self.idle_gap else None
+        last_change = next_read = prev_read = clock.monotonic()
+
+        metrics = self.metrics
+        if metrics:
+            gap_hist = metrics.histogram('read_gap_ms', READ_GAP_BOUNDS_MS)
+            late_hist = metrics.histogram('oversleep_ms')
+            call_back_hist = metrics.histogram('callback_ms')
 
         while True:
 
-            for pin in self.pins:
+            levels = read_levels() & mask
+            if capture and levels != last_levels:
+                capture.levels(clock.monotonic(), levels)
+                last_levels = levels
 
-                state_reads[pin][ix] = GPIO.input(pin)
+            diff = (levels ^ cur_state) & mask
+            now = clock.monotonic()
+            if metrics:
+                gap_hist.add((now - prev_read) * 1000.0)
+                prev_read = now
 
-                if sum(state_reads[pin]) == (not cur_state[pin]) * self.buffer_len:
-                    # a state change occurred; record it and call
-                    # the callback function.
-                    cur_state[pin] = not cur_state[pin]
-                    self.call_back(pin, cur_state[pin])
+            if diff or new_reads:
 
-            ix = (ix + 1) % self.buffer_len
+                last_change = now
+                if self.idle:
+                    # a pin changed while idle; read at full speed from now
+                    self.idle = False
+                    next_read = now
+
+                # pins that fell back to their current state start over
+                for bit in list(new_reads):
+                    if not diff & bit:
+                        del new_reads[bit]
+
+                while diff:
+                    bit = diff & -diff      # lowest pin that differs from its state
+                    diff ^= bit
+                    ct = new_reads.get(bit, 0) + 1
+                    if ct >= self.buffer_len:
+                        # a state change occurred; record it and call
+                        # the callback function.
+                        new_reads.pop(bit, None)
+                        cur_state ^= bit
+                        pin, state, ts = pin_from_bit[bit], bool(cur_state & bit), clock.monotonic()
+                        if capture:
+                            capture.transition(ts, pin, state)
+                        if self.dispatcher:
+                            self.dispatcher.put(pin, state, ts)
+                        elif self.timestamps:
+                            self.call_back(pin, state, ts)
+                        else:
+                            self.call_back(pin, state)
+                        if metrics and not self.dispatcher:
+                            call_back_hist.add((clock.monotonic() - ts) * 1000.0)
+                    else:
+                        new_reads[bit] = ct
 
             if self.debug_pin:
                 debug_state = not debug_state
-                GPIO.output(self.debug_pin, debug_state)
+                self.gpio.output(self.debug_pin, debug_state)
+
+            if idle_gap and not self.idle and now - last_change >= self.idle_after:
+                self.idle = True
+
+            # Sleep until the next read's deadline.  If the thread was held up for more
+            # than a gap, start the deadlines over instead of reading in a burst.
+            next_read += idle_gap if self.idle else gap
+            delay = next_read - clock.monotonic()
+            if delay > 0.0:
+                time.sleep(delay)
+                if metrics:
+                    late_hist.add((clock.monotonic() - next_read) * 1000.0)
+            elif delay < -gap:
+                next_read = clock.monotonic()
+
+
+class EdgeInputChange(threading.Thread):
+
+    def __init__(self, pins, call_back, pull_up=False, debounce=10.0, gpio=None, timestamps=False,
+                 capture=None, metrics=None):
+        """Class to detect changes in a set of input pins by waiting on edge events
+        from the kernel instead of polling the pins.  The thread uses no CPU between
+        edges, so it can count much faster pulse trains than InputChange.  Each edge
+        is time-stamped and the pin level read when the event arrives; a new level is
+        accepted once it has been held for 'debounce' milliseconds without another
+        edge.  Because the debounce decision is made from the edge timestamps, a late
+        wake-up of this thread does not cause a pulse to be lost.
+        Constructor parameters are:
+            pins              list of pin numbers (BCM) to detect transitions on
+            call_back         function to call when a transition occurs.  The pin number,
+                                  and the new pin state,True or False, are passed as
+                                  parameters to the function.
+            pull_up           if True, turn on the internal Raspberry Pi pullup for the pins
+            debounce          number of milliseconds a level must be stable to be accepted
+            gpio              module used to access the pins; defaults to RPi.GPIO.  It must
+                                  provide 'add_event_detect()'.  Pass a fake_gpio.FakeGPIO
+                                  object to run without a Pi.
+            timestamps        if True, a third parameter is passed to 'call_back': the time,
+                                  from clock.monotonic(), of the edge that started the new level.
+            capture           if not None, a capture.CaptureWriter that records each edge
+                                  event and each transition.
+            metrics           if not None, a metrics.Metrics object that records how long
+                                  the call back takes, in milliseconds.
+        The shorter portion of a pulse must be longer than 'debounce'; with the default of
+        10 ms, square waves up to about 40 Hz are counted.
+        """
+
+        # run constructor of base class
+        threading.Thread.__init__(self)
+        self.daemon = True     # Python should exit if only this thread is left
+
+        try:
+            len(pins)
+            self.pins = pins               # pin numbers (BCM) to detect pulses on
+        except:
+            self.pins = [pins]             # assume that one pin number was passed; convert to list
+        self.call_back = call_back         # function to call when pulse occurs
+        self.debounce = debounce / 1000.0  # seconds a level must be held to be accepted
+        self.gpio = gpio or GPIO           # module used to access the pins
+        self.timestamps = timestamps       # if True, pass the edge time to call_back
+        self.capture = capture             # records edges and transitions, if not None
+        self.call_back_hist = metrics.histogram('callback_ms') if metrics else None
+
+        # holds (pin, level, timestamp) tuples for each edge, filled by the GPIO
+        # module's event thread, which also writes to the pipe to wake this thread.
+        # The thread sleeps in select() on the pipe, for the reason given in
+        # scheduler.py.
+        self.events = collections.deque()
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        setup_pins(self.gpio, self.pins, pull_up)
+
+    def _edge(self, pin):
+        """Called from the GPIO module's event thread at each edge. Keep it short.
+        """
+        event = (pin, self.gpio.input(pin), clock.monotonic())
+        self.events.append(event)
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError:
+            # the pipe is full, so the thread has wake-ups waiting already
+            pass
+        if self.capture:
+            self.capture.edge(event[2], pin, event[1])
+
+    def run(self):
+
+        # these dictionaries are keyed on pin number
+        cur_state = {}
+        pending = {}      # (level, timestamp) of the last edge not yet accepted
+        for pin in self.pins:
+            cur_state[pin] = bool(self.gpio.input(pin))
+            self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self._edge)
+
+        def accept(pin, level, ts):
+            if level != cur_state[pin]:
+                cur_state[pin] = level
+                if self.capture:
+                    self.capture.transition(ts, pin, level)
+                start = clock.monotonic()
+                if self.timestamps:
+                    self.call_back(pin, level, ts)
+                else:
+                    self.call_back(pin, level)
+                if self.call_back_hist:
+                    self.call_back_hist.add((clock.monotonic() - start) * 1000.0)
+
+        while True:
+
+            # wait for the next edge, or until the oldest pending level is settled
+            if pending:
+                timeout = max(0.0, min(ts for _, ts in pending.values()) + self.debounce
+                                   - clock.monotonic())
+            else:
+                timeout = None
+            if not self.events:
+                try:
+                    select.select([self.wake_r], [], [], timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+            # empty the pipe before taking the edges, so an edge that arrives after
+            # this leaves a wake-up behind
+            try:
+                os.read(self.wake_r, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            while self.events:
+                pin, level, ts = self.events.popleft()
+                if pin in pending:
+                    prev_level, prev_ts = pending[pin]
+                    if ts - prev_ts >= self.debounce:
+                        # previous level was held long enough
+                        accept(pin, prev_level, prev_ts)
+                pending[pin] = (bool(level), ts)
+
+            # accept any levels that have been stable for the debounce time
+            now = clock.monotonic()
+            for pin, (level, ts) in list(pending.items()):
+                if now - ts >= self.debounce:
+                    del pending[pin]
+                    accept(pin, level, ts)
+
+
+class CallbackDispatcher(threading.Thread):
+
+    def __init__(self, call_back, queue_len=256, timestamps=False, metrics=None):
+        """Runs the call back of an InputChange in a thread of its own.  The sampling
+        thread puts each transition in a fixed-size ring buffer with 'put()', which
+        never blocks and allocates nothing, and this thread calls 'call_back' for each
+        one, in order.  A call back that sleeps or does file I/O then delays only the
+        transitions behind it, not the reading of the pins.
+            call_back         function called with (pin, state), or (pin, state, ts) if
+                                  'timestamps' is True, where 'ts' is the clock.monotonic()
+                                  time of the transition.
+            queue_len         number of transitions that can wait for 'call_back'.  When
+                                  the queue is full, new transitions are dropped and counted
+                                  in 'overflows'.
+            metrics           if not None, a metrics.Metrics object that records how long
+                                  the call back takes and the number of overflows.
+        The 'max_latency' attribute holds the longest time, in seconds, from a transition
+        to the return of its call back.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.call_back = call_back
+        self.queue_len = queue_len
+        self.timestamps = timestamps
+
+        # ring buffer of transitions.  Only the sampling thread changes 'put_count' and
+        # only this thread changes 'get_count', so no lock is needed.
+        self.pins = array('i', [0] * queue_len)
+        self.states = array('b', [0] * queue_len)
+        self.times = array('d', [0.0] * queue_len)
+        self.put_count = 0
+        self.get_count = 0
+        self.ready = threading.Event()
+
+        self.overflows = 0          # number of transitions dropped because the queue was full
+        self.max_latency = 0.0      # seconds from a transition to the end of its call back
+
+        self.call_back_hist = None
+        if metrics:
+            self.call_back_hist = metrics.histogram('callback_ms')
+            metrics.gauge('dispatch_overflows', lambda: self.overflows)
+
+    def put(self, pin, state, ts):
+        """Queues a transition of 'pin' to 'state' that occurred at time 'ts'.
+        """
+        if self.put_count - self.get_count >= self.queue_len:
+            self.overflows += 1
+            return
+        ix = self.put_count % self.queue_len
+        self.pins[ix] = pin
+        self.states[ix] = state
+        self.times[ix] = ts
+        self.put_count += 1
+        self.ready.set()
+
+    def run(self):
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            while self.get_count < self.put_count:
+                ix = self.get_count % self.queue_len
+                pin, state, ts = self.pins[ix], bool(self.states[ix]), self.times[ix]
+                self.get_count += 1
+                start = clock.monotonic()
+                if self.timestamps:
+                    self.call_back(pin, state, ts)
+                else:
+                    self.call_back(pin, state)
+                end = clock.monotonic()
+                if self.call_back_hist:
+                    self.call_back_hist.add((end - start) * 1000.0)
+                latency = end - ts
+                if latency > self.max_latency:
+                    self.max_latency = latency
+
+
+def setup_pins(gpio, pins, pull_up):
+    """Sets up the 'gpio' module and makes 'pins' inputs, with the internal
+    pullup turned on if 'pull_up' is True.
+    """
+    gpio.setmode(gpio.BCM)
+    gpio.setwarnings(False)
+    for pin in pins:
+        if pull_up:
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+        else:
+            gpio.setup(pin, gpio.IN)
+
+
+def detector_from_settings(settings, pins, call_back, edge_detect=False, pull_up=False,
+                           debug_pin=None, capture=None, metrics=None):
+    """Returns the detector, not yet started, that the sensor scripts use to watch
+    'pins', chosen by the Mini-Monitor 'settings' module: an rt_sampler.RTInputChange
+    if the RT_SAMPLER setting is True, else an EdgeInputChange if 'edge_detect' (the
+    script's own edge detection setting) is True, else an InputChange.  'call_back'
+    is passed the pin number, the new state and the time of each transition.  The
+    other parameters are passed to the detector.
+    The sampling process of an RTInputChange is started here, so call this before
+    the script starts any other thread (see RTInputChange.start_sampling()).
+    """
+    # milliseconds between reads of the pins when they have not changed for a while,
+    # to save CPU wake-ups at sites with slow pulses; None reads at full speed always.
+    # See InputChange for the shortest pulse that is sure to be counted.
+    idle_gap = getattr(settings, 'INPUT_IDLE_GAP', None)
+
+    # flag to run the pin sampling in a process of its own, so the other threads of
+    # the script don't delay the pin reads (see rt_sampler.py).  The process can be
+    # given a SCHED_FIFO priority (1 - 99) and the number of a CPU to run on.
+    if getattr(settings, 'RT_SAMPLER', False):
+        # rt_sampler imports this module, so it is imported here
+        import rt_sampler
+        rt_priority = getattr(settings, 'RT_PRIORITY', None)
+        rt_cpu = getattr(settings, 'RT_CPU', None)
+        # the InputChange or EdgeInputChange runs in the sampling process
+        detector_args = {} if edge_detect else {'debug_pin': debug_pin, 'idle_gap': idle_gap}
+        detector = rt_sampler.RTInputChange(pins, call_back, rt_priority, rt_cpu, edge_detect,
+                                            pull_up=pull_up, timestamps=True, capture=capture,
+                                            metrics=metrics, **detector_args)
+        detector.start_sampling()
+        return detector
+    elif edge_detect:
+        return EdgeInputChange(pins, call_back, pull_up=pull_up, timestamps=True,
+                               capture=capture, metrics=metrics)
+    else:
+        return InputChange(pins, call_back, pull_up=pull_up, debug_pin=debug_pin,
+                           timestamps=True, capture=capture, idle_gap=idle_gap,
+                           metrics=metrics)
 
-            time.sleep(self.read_gap / 1000.0)
 
 if __name__=='__main__':
 
@@ -102,4 +522,4 @@ if __name__=='__main__':
 
     while True:
         time.sleep(10)
-        print ct, pchg.isAlive()
+        print(ct, pchg.is_alive())
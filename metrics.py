@@ -0,0 +1,186 @@
+"""
+Measurements of how well a sensor script is keeping up: the actual gap
+between pin reads, how late the reading thread wakes, how long call backs
+and A/D scans take, the depth of the MQTT queue, and publish latency and
+retries.  The components record into a Metrics object passed to them, and
+the script posts a summary to the metrics topic every few minutes.
+
+Recording a value is a bucket search in a short list plus a few additions,
+so it can be left on in production.  No locks are taken when recording; a
+value recorded while a summary is being taken may be lost, which does not
+matter for statistics like these.
+"""
+from __future__ import division, print_function
+import bisect
+
+# Topic the metrics are posted to
+TOPIC = 'metrics/sensors'
+
+# Default upper bounds of histogram buckets, in milliseconds
+BOUNDS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# Bucket bounds suited to the gap between pin reads, in milliseconds
+READ_GAP_BOUNDS_MS = (1, 2, 3, 4, 5, 7, 10, 15, 20, 50, 100)
+
+
+class Histogram:
+
+    def __init__(self, bounds=BOUNDS_MS):
+        """Counts values in buckets with the upper bounds in the sorted sequence
+        'bounds'; values above the last bound go in an overflow bucket.  The count,
+        mean and maximum are kept as well.
+        """
+        self.bounds = list(bounds)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, val):
+        self.counts[bisect.bisect_left(self.bounds, val)] += 1
+        self.count += 1
+        self.total += val
+        if self.max is None or val > self.max:
+            self.max = val
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket holding the 'pct' percentile value,
+        or the maximum if it is in the overflow bucket.  None if there are no values.
+        """
+        if not self.count:
+            return None
+        target = pct / 100.0 * self.count
+        running = 0
+        for bound, ct in zip(self.bounds, self.counts):
+            running += ct
+            if running >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def stats(self, reset=True):
+        """Returns a list of (name, value) statistics: count, mean, max, p50, p99,
+        and the count in each bucket, named 'le_<bound>' and 'over'.
+        """
+        result = [('count', self.count)]
+        if self.count:
+            result += [('mean', round(self.total / self.count, 3)), ('max', round(self.max, 3)),
+                       ('p50', round(self.percentile(50), 3)), ('p99', round(self.percentile(99), 3))]
+        result += [('le_%g' % bound, ct) for bound, ct in zip(self.bounds, self.counts)]
+        result.append(('over', self.counts[-1]))
+        if reset:
+            self.reset()
+        return result
+
+
+class Counter:
+
+    def __init__(self):
+        """A count of events, such as retries.  Posted as the count since the last post.
+        """
+        self.count = 0
+
+    def add(self, n=1):
+        self.count += n
+
+    def stats(self, reset=True):
+        result = [('', self.count)]
+        if reset:
+            self.count = 0
+        return result
+
+
+class Gauge:
+
+    def __init__(self, func):
+        """A value read when the metrics are posted, by calling 'func()'.
+        """
+        self.func = func
+
+    def stats(self, reset=True):
+        return [('', self.func())]
+
+
+class Metrics:
+
+    def __init__(self, name):
+        """Holds the metrics of one script.  'name' is used in the sensor IDs of the
+        posted values, so it should differ between scripts running on one logger.
+        """
+        self.name = name
+        self.items = []        # (metric name, metric) in the order created
+        self.by_name = {}
+
+    def _get(self, name, make):
+        if name not in self.by_name:
+            self.by_name[name] = make()
+            self.items.append((name, self.by_name[name]))
+        return self.by_name[name]
+
+    def histogram(self, name, bounds=BOUNDS_MS):
+        """Returns the Histogram called 'name', making it if needed.
+        """
+        return self._get(name, lambda: Histogram(bounds))
+
+    def counter(self, name):
+        """Returns the Counter called 'name', making it if needed.
+        """
+        return self._get(name, Counter)
+
+    def gauge(self, name, func):
+        """Adds a Gauge called 'name' that reads its value from 'func()'.
+        """
+        return self._get(name, lambda: Gauge(func))
+
+    def snapshot(self, reset=True):
+        """Returns a list of (name, value) pairs for all of the metrics.  If 'reset'
+        is True, the histograms and counters start over.
+        """
+        result = []
+        for name, metric in self.items:
+            for stat, val in metric.stats(reset):
+                result.append(('%s_%s' % (name, stat) if stat else name, val))
+        return result
+
+    def post(self, poster, ts, logger_id):
+        """Posts the metrics to 'poster', time-stamped with the Unix time 'ts', and
+        starts the histograms and counters over.  The sensor IDs are
+        '<logger_id>_<name>_<metric>'.
+        """
+        ts = int(ts)
+        lines = ['%s\t%s_%s_%s\t%s' % (ts, logger_id, self.name, stat, val)
+                 for stat, val in self.snapshot() if val is not None]
+        poster.publish(TOPIC, '\n'.join(lines) + '\n')
+
+
+def metrics_from_settings(settings, name):
+    """Returns a Metrics object called 'name' and the posting interval in seconds if
+    the METRICS_INTERVAL setting of the Mini-Monitor 'settings' module is present,
+    otherwise (None, None).
+    """
+    interval = getattr(settings, 'METRICS_INTERVAL', None)
+    if not interval:
+        return None, None
+    return Metrics(name), interval
+
+
+if __name__ == '__main__':
+
+    # Test routine and usage example
+    import random
+
+    class PrintPoster:
+        def publish(self, topic, payload):
+            print(topic)
+            print(payload)
+
+    m = Metrics('demo')
+    gap = m.histogram('read_gap_ms', READ_GAP_BOUNDS_MS)
+    retries = m.counter('retries')
+    m.gauge('queue', lambda: 3)
+    for i in range(1000):
+        gap.add(random.gauss(3.1, 0.3))
+    retries.add(2)
+    m.post(PrintPoster(), 1500000000, 'test')
@@ -1,8 +1,17 @@
 import threading
 import time
-import Queue
+try:
+    import Queue
+except ImportError:
+    # Python 3
+    import queue as Queue
 import socket
+import collections
 import paho.mqtt.publish as publish
+import paho.mqtt.client as mqtt
+import spool
+import clock
+import payload_codec
 
 class MQTTposter(threading.Thread):
     """Class that runs in a separate thread and publishes to an MQTT broker.
@@ -10,20 +19,54 @@ class MQTTposter(threading.Thread):
     the broker is intermittently available.  Using the 'loop_start()' method on a Client
     object doesn't seem to deliver the messages that were published while the broker was
     unavailable.
+    In the default mode, a new connection is made for each message.  In persistent
+    mode, one connection is kept open and several QoS 1 messages are kept in flight
+    at once, which drains a backlog much faster over a slow link.  Reliability is kept
+    by tracking the unacknowledged messages here, rather than in the Client object,
+    and resending them on a fresh connection if the broker goes away.
+    If a spool directory is given, messages are queued on disk (see spool.py) instead
+    of in memory, so they survive a restart of the script.
     """
 
-    def __init__(self, host='localhost', port=1883):
+    def __init__(self, host='localhost', port=1883, persistent=False, max_inflight=20, keepalive=60,
+                 spool_dir=None, metrics=None):
         """'host' is the hostname to publish to.
-        'port' is the port on the host to publish to."""
+        'port' is the port on the host to publish to.
+        'persistent' if True, keep one connection open and pipeline publishes.
+        'max_inflight' is the maximum number of unacknowledged messages in persistent mode.
+        'keepalive' is the MQTT keepalive in seconds used in persistent mode.
+        'spool_dir' if not None, the directory used to queue messages on disk.
+        'metrics' if not None, a metrics.Metrics object that records the queue depth,
+            the publish latency (milliseconds from the first try to success, or to the
+            broker's acknowledgement in persistent mode) and the number of retries."""
         threading.Thread.__init__(self)
         self.daemon = True    # exit if main thread is gone
         self.host = host
         self.port = port
-        self.q = Queue.Queue()
+        self.persistent = persistent
+        self.max_inflight = max_inflight
+        self.keepalive = keepalive
+        if spool_dir:
+            self.q = spool.Spool(spool_dir)
+        else:
+            self.q = Queue.Queue()
+
+        self.latency_hist = None
+        self.retries = None
+        if metrics:
+            self.latency_hist = metrics.histogram('mqtt_latency_ms')
+            self.retries = metrics.counter('mqtt_retries')
+            if spool_dir:
+                metrics.gauge('mqtt_spool_bytes', self.q.size_bytes)
+            else:
+                metrics.gauge('mqtt_queue', self.q.qsize)
 
     def run(self):
         """Processes (publishes) any items in the Queue.
         """
+        if self.persistent:
+            self.run_persistent()
+
         while True:
             try:
                 topic, payload = self.q.get(block=True)   # block until item is available
@@ -32,11 +75,14 @@ class MQTTposter(threading.Thread):
                 continue
 
             retry_wait = 1  # seconds
+            start = clock.monotonic()
             while True:    # try to publish until successful
                 try:
                     publish.single(topic, payload=payload, qos=1, hostname=self.host, port=self.port)
                 except socket.error:
                     # couldn't connect to MQTT broker, try again after short wait
+                    if self.retries:
+                        self.retries.add()
                     time.sleep(retry_wait)
                     retry_wait = min(30, retry_wait * 2)
                     continue
@@ -44,10 +90,170 @@ class MQTTposter(threading.Thread):
                     # some other error occurred. Ignore this message and go on to next
                     break
                 # successfully published, so go on to next item.
+                if self.latency_hist:
+                    self.latency_hist.add((clock.monotonic() - start) * 1000.0)
                 break
-        
+            self.q.task_done()
+
+    def run_persistent(self):
+        """Publishes the items in the Queue over one long-lived connection, with up
+        to 'max_inflight' messages awaiting acknowledgement.  Never returns.
+        """
+        window = InflightWindow(self.q, self.max_inflight, self.latency_hist, self.retries)
+        acked = []                             # message IDs acknowledged during loop()
+        client = None
+        retry_wait = 1  # seconds
+
+        while True:
+
+            if client is None:
+                # A new Client is made for each connection, so messages it has not
+                # delivered are not also resent by the Client itself.
+                client = mqtt.Client()
+                client.max_inflight_messages_set(self.max_inflight)
+                client.on_publish = lambda c, userdata, mid: acked.append(mid)
+                try:
+                    client.connect(self.host, self.port, self.keepalive)
+                except socket.error:
+                    # couldn't connect to MQTT broker, try again after short wait
+                    client = None
+                    if self.retries:
+                        self.retries.add()
+                    time.sleep(retry_wait)
+                    retry_wait = min(30, retry_wait * 2)
+                    continue
+                # send the messages not acknowledged on the old connection again
+                window.reconnected()
+
+            # Fill the window of in-flight messages.  Only block when there is
+            # nothing to wait for from the broker, and wake up often enough to keep
+            # the connection alive.
+            window.fill(client, None if window.entries else self.keepalive / 2.0)
+
+            # send and receive network traffic, collecting acknowledgements
+            rc = client.loop(timeout=0.1 if window.entries else 0.0)
+            if acked:
+                # the broker is accepting messages, so reset the wait used after failures
+                retry_wait = 1
+            window.acknowledge(acked)
+            del acked[:]
+
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                # connection was lost; start over with a new one
+                try:
+                    client.disconnect()
+                except:
+                    pass
+                client = None
+                time.sleep(retry_wait)
+                retry_wait = min(30, retry_wait * 2)
+
     def publish(self, topic, payload):
         """Put a message in the queue to publish.
         'topic' is the topic of the message and 'payload' is the payload.
         """
         self.q.put((topic, payload))
+
+    def publish_readings(self, topic, ts, readings, trailing_newline=False):
+        """Put a message of readings in the queue to publish, in the Mini-Monitor text
+        format.  'readings' is a list of (sensor ID, value) pairs, all time-stamped with
+        the Unix time 'ts'.  If 'trailing_newline' is True, the last line of the text
+        ends with a newline too.
+        """
+        self.publish(topic, payload_codec.text_payload(ts, readings, trailing_newline))
+
+
+class InflightWindow:
+
+    def __init__(self, q, max_inflight, latency_hist=None, retries=None):
+        """Keeps track of the QoS 1 messages published over one persistent connection
+        and not yet marked done in the queue 'q', a Queue.Queue or spool.Spool, for
+        MQTTposter and aio_runtime.AsyncMQTTPoster.  Up to 'max_inflight' messages
+        are held.  Messages are marked done in the order they were queued, which is
+        what a disk spool needs to track its delivered position, so a message the
+        broker has acknowledged is held until those before it are acknowledged too.
+        After a new connection, only the messages that were not acknowledged are
+        published again.  'latency_hist' and 'retries' if not None, are the metrics
+        histogram of the milliseconds to each acknowledgement and the counter of
+        messages sent again.
+        """
+        self.q = q
+        self.max_inflight = max_inflight
+        self.latency_hist = latency_hist
+        self.retries = retries
+        # entry number -> [(topic, payload), acked flag, send time], in queue order
+        self.entries = collections.OrderedDict()
+        self.mids = {}                      # message ID -> entry number
+        self.resend = collections.deque()   # numbers of the entries to publish again
+        self.next_n = 0                     # number of the next entry
+
+    def reconnected(self):
+        """Call when a new connection is made: the messages that were not acknowledged
+        on the old one are published again, in their original order.
+        """
+        self.mids.clear()
+        self.resend = collections.deque(n for n, entry in self.entries.items() if not entry[1])
+        if self.retries:
+            self.retries.add(len(self.resend))
+
+    def fill(self, client, timeout=None):
+        """Publishes with the paho Client 'client' the messages to send again, then
+        messages from the queue until the window is full.  If 'timeout' is not None,
+        waits up to that many seconds for a message to be queued.
+        """
+        while self.resend:
+            if not self._publish(client, self.resend[0]):
+                return
+            self.resend.popleft()
+        while len(self.entries) < self.max_inflight:
+            try:
+                item = self.q.get(block=timeout is not None, timeout=timeout)
+            except Queue.Empty:
+                return
+            timeout = None
+            n = self.next_n
+            self.next_n += 1
+            self.entries[n] = [item, False, None]
+            if not self._publish(client, n):
+                self.resend.append(n)
+                return
+
+    def _publish(self, client, n):
+        """Publishes entry 'n' with 'client'.  Returns False if the Client can't
+        take it now.
+        """
+        entry = self.entries[n]
+        try:
+            topic, payload = entry[0]
+            info = client.publish(topic, payload=payload, qos=1)
+        except Exception:
+            # Bad item format or payload; skip it.  It is held as acknowledged, so
+            # it is marked done in its place in the queue order and never sent again.
+            entry[1] = True
+            self._release()
+            return True
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        entry[2] = clock.monotonic()
+        self.mids[info.mid] = n
+        return True
+
+    def acknowledge(self, mids):
+        """Records the broker's acknowledgements of the message IDs in 'mids', and
+        marks done in the queue the messages that are ready.
+        """
+        for mid in mids:
+            n = self.mids.pop(mid, None)
+            if n is None:
+                continue
+            entry = self.entries[n]
+            entry[1] = True
+            if self.latency_hist:
+                self.latency_hist.add((clock.monotonic() - entry[2]) * 1000.0)
+        self._release()
+
+    def _release(self):
+        # mark done the acknowledged messages at the head of the window
+        while self.entries and next(iter(self.entries.values()))[1]:
+            self.entries.popitem(last=False)
+            self.q.task_done()
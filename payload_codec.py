@@ -0,0 +1,267 @@
+"""
+Payloads of the reading messages.  By default readings are posted the way
+Mini-Monitor expects them: one text message per sensor each log interval,
+with a line of '<Unix time>\t<sensor ID>\t<value>' for each reading.  The BTU
+meter's messages end every line, the last too, with a newline, and the pulse
+counter's don't end the last line; each keeps the bytes its script always sent.
+
+Over a metered cellular link, each message and each byte costs.  A
+PackedPoster instead collects the readings of several log periods, from all
+of the sensors of a script, and posts them as one struct-packed message,
+compressed with zlib, to PACKED_TOPIC.  The decode() and text_payloads()
+functions here turn a packed message back into readings, or into the text
+messages that would have been posted, on the collector side; this module
+only needs the Python standard library, 2 or 3.
+
+A packed message is:
+
+    header:   2s   magic, 'PR'
+              B    format version, 1
+              B    flags: 1 if the body is zlib compressed
+    body:     H    number of strings, then for each string:
+                       B    length in bytes, followed by the UTF-8 bytes
+              H    number of groups, then for each group:
+                       H    index of the topic in the strings
+                       I    Unix time of the readings
+                       H    number of readings, then for each reading:
+                           H    index of the sensor ID in the strings
+                           B    kind of value: VAL_FLOAT, VAL_INT or VAL_NONE
+                           d    value
+
+The strings are the topics and sensor IDs used in the message, each held once.
+"""
+from __future__ import division, print_function
+import struct
+import zlib
+
+# Topic packed messages are posted to
+PACKED_TOPIC = 'readings/packed'
+
+# Topic of the BTU meter readings, whose text messages have a trailing newline
+BTU_TOPIC = 'readings/final/btu_meter'
+
+MAGIC = b'PR'
+VERSION = 1
+FLAG_ZLIB = 1
+
+HEADER = struct.Struct('<2sBB')
+COUNT = struct.Struct('<H')
+GROUP = struct.Struct('<HIH')
+READING = struct.Struct('<HBd')
+
+# Kinds of reading value
+VAL_FLOAT = 0
+VAL_INT = 1
+VAL_NONE = 2
+
+
+def text_payload(ts, readings, trailing_newline=False):
+    """Returns the Mini-Monitor text payload of the (sensor ID, value) pairs in
+    'readings', all time-stamped with the Unix time 'ts', one reading per line.
+    If 'trailing_newline' is True, the last line also ends with a newline.
+    """
+    ts = int(ts)
+    text = '\n'.join(['%s\t%s\t%s' % (ts, sensor_id, val) for sensor_id, val in readings])
+    return text + '\n' if trailing_newline else text
+
+
+def encode(groups, compress=True):
+    """Returns the packed message holding 'groups', a list of (topic, Unix time,
+    readings) where 'readings' is a list of (sensor ID, value) pairs.  Values must
+    be numbers or None.  If 'compress' is True, the body is zlib compressed.
+    """
+    strings = []
+    index = {}
+    def str_ix(s):
+        if s not in index:
+            index[s] = len(strings)
+            strings.append(s)
+        return index[s]
+
+    parts = []
+    for topic, ts, readings in groups:
+        parts.append(GROUP.pack(str_ix(topic), int(ts), len(readings)))
+        for sensor_id, val in readings:
+            if val is None:
+                kind, val = VAL_NONE, 0.0
+            elif isinstance(val, float):
+                kind = VAL_FLOAT
+            else:
+                kind = VAL_INT
+            parts.append(READING.pack(str_ix(sensor_id), kind, val))
+
+    head = [COUNT.pack(len(strings))]
+    for s in strings:
+        b = s.encode('utf-8')
+        head.append(struct.pack('<B', len(b)) + b)
+    head.append(COUNT.pack(len(groups)))
+    body = b''.join(head + parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body, 9)
+        flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, VERSION, flags) + body
+
+
+def decode(payload):
+    """Returns the list of (topic, Unix time, readings) groups in the packed
+    message 'payload', where 'readings' is a list of (sensor ID, value) pairs.
+    Raises ValueError if 'payload' is not a packed message.
+    """
+    if len(payload) < HEADER.size:
+        raise ValueError('Payload too short for a packed message.')
+    magic, version, flags = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a packed message, or an unknown version.')
+    body = payload[HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+
+    pos = 0
+    n, = COUNT.unpack_from(body, pos)
+    pos += COUNT.size
+    strings = []
+    for _ in range(n):
+        length = bytearray(body[pos:pos + 1])[0]
+        strings.append(body[pos + 1:pos + 1 + length].decode('utf-8'))
+        pos += 1 + length
+    n_groups, = COUNT.unpack_from(body, pos)
+    pos += COUNT.size
+
+    groups = []
+    for _ in range(n_groups):
+        topic_ix, ts, n = GROUP.unpack_from(body, pos)
+        pos += GROUP.size
+        readings = []
+        for _ in range(n):
+            id_ix, kind, val = READING.unpack_from(body, pos)
+            pos += READING.size
+            if kind == VAL_NONE:
+                val = None
+            elif kind == VAL_INT:
+                val = int(val)
+            readings.append((strings[id_ix], val))
+        groups.append((strings[topic_ix], ts, readings))
+    return groups
+
+
+def text_payloads(payload, newline_topics=(BTU_TOPIC,)):
+    """Returns a list of the (topic, text payload) messages that the packed
+    message 'payload' stands for, for passing on to Mini-Monitor consumers.  The
+    messages to the topics in 'newline_topics' end their last line with a newline.
+    """
+    return [(topic, text_payload(ts, readings, topic in newline_topics))
+            for topic, ts, readings in decode(payload)]
+
+
+class PackedPoster:
+
+    def __init__(self, poster, batch=1, compress=True, topic=PACKED_TOPIC):
+        """Stands in for 'poster', an mqtt_poster.MQTTposter, when sensors post their
+        readings, and posts the readings of every 'batch' log periods as one packed
+        message to 'topic'.  If 'compress' is True, the message is zlib compressed.
+        Messages that are not readings are passed on to 'poster' unchanged.
+        A log period is the readings with one time stamp, from any of the sensors.
+        The sensors post one after another, so a batch is posted when the first
+        readings past it arrive, one log interval late, or by flush().
+        """
+        self.poster = poster
+        self.batch = batch
+        self.compress = compress
+        self.topic = topic
+        self.groups = []        # (topic, Unix time, readings) not yet posted
+        self.times = set()      # Unix times of the held log periods
+
+    def publish(self, topic, payload):
+        self.poster.publish(topic, payload)
+
+    def publish_readings(self, topic, ts, readings, trailing_newline=False):
+        """Holds the (sensor ID, value) pairs in 'readings', time-stamped with the
+        Unix time 'ts'.  'trailing_newline' is not used, as a packed message only
+        holds the readings; see text_payloads().
+        """
+        ts = int(ts)
+        if ts not in self.times and len(self.times) >= self.batch:
+            self.flush()
+        self.groups.append((topic, ts, list(readings)))
+        self.times.add(ts)
+
+    def flush(self):
+        """Posts the held readings, if there are any.  Call before the script exits.
+        """
+        if self.groups:
+            self.poster.publish(self.topic, encode(self.groups, self.compress))
+        self.groups = []
+        self.times = set()
+
+
+def poster_from_settings(settings, poster):
+    """Returns the poster that sensors should post their readings to: 'poster'
+    itself if the PAYLOAD_FORMAT setting of the Mini-Monitor 'settings' module is
+    absent or 'text', or a PackedPoster around it if it is 'packed'.
+    """
+    payload_format = getattr(settings, 'PAYLOAD_FORMAT', 'text')
+    if payload_format == 'text':
+        return poster
+    if payload_format == 'packed':
+        return PackedPoster(poster,
+                            # number of log periods posted in each message
+                            getattr(settings, 'PAYLOAD_BATCH', 1),
+                            # flag to zlib compress the messages
+                            getattr(settings, 'PAYLOAD_COMPRESS', True))
+    raise ValueError('Unknown PAYLOAD_FORMAT: %s' % payload_format)
+
+
+if __name__ == '__main__':
+
+    # Test routine and usage example.  With an argument, decodes the packed
+    # message in that file.
+    import sys
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as fin:
+            for topic, text in text_payloads(fin.read()):
+                print(topic)
+                print(text)
+        sys.exit()
+
+    class CollectPoster:
+        def __init__(self):
+            self.messages = []
+        def publish(self, topic, payload):
+            self.messages.append((topic, payload))
+
+    # The text messages must be byte for byte those the pulse counter and BTU meter
+    # scripts have always posted, made here the way those scripts made them.
+    ts = 1500000000.7
+    pulse = [('test_16_pulse', 1000), ('test_17_pulse', 52)]
+    baseline_pulse = '\n'.join(['%s\t%s\t%s' % (int(ts), sensor_id, ct) for sensor_id, ct in pulse])
+    btu = [('test_13_heat', 994.25), ('test_13_pulse', 4200), ('test_13_thot', 131.2),
+           ('test_13_tcold', 118.9)]
+    baseline_btu = ''
+    for sensor_id, val in btu:
+        baseline_btu += '%s\t%s\t%s\n' % (int(ts), sensor_id, val)
+    assert text_payload(ts, pulse) == baseline_pulse
+    assert text_payload(ts, btu, trailing_newline=True) == baseline_btu
+    groups = [('readings/final/pulse_counter_multi', ts, pulse), (BTU_TOPIC, ts, btu)]
+    assert [text for topic, text in text_payloads(encode(groups))] == [baseline_pulse, baseline_btu]
+    print('Text payloads match the baseline scripts.')
+
+    collected = CollectPoster()
+    packer = PackedPoster(collected, batch=6)
+    text_len = 0
+    for period in range(6):
+        ts = 1500000000 + period * 600
+        pulse = [('test_16_pulse', 1000 + period * 37), ('test_17_pulse', 52 + period)]
+        btu = [('test_13_heat', 994.25 + period), ('test_13_pulse', 4200 + period * 11),
+               ('test_13_thot', 131.2), ('test_13_tcold', 118.9)]
+        text_len += len(text_payload(ts, pulse)) + len(text_payload(ts, btu, True))
+        packer.publish_readings('readings/final/pulse_counter_multi', ts, pulse)
+        packer.publish_readings(BTU_TOPIC, ts, btu, True)
+    packer.flush()
+    topic, payload = collected.messages[0]
+    print('%d text messages, %d bytes; %d packed message, %d bytes' %
+          (12, text_len, len(collected.messages), len(payload)))
+    for topic, text in text_payloads(payload)[:2]:
+        print(topic)
+        print(text)
@@ -9,11 +9,12 @@ posts to the mini-monitor MQTT broker.
 This script should be started by a supervisor capable of restarting
 the script if an error occurs.
 """
-import time
+from __future__ import print_function
 import sys
 import argparse
 import input_change
 import mqtt_poster
+import scheduler
 
 # GPIO Pins (BCM numbering) used by the pulse counter
 PIN_IN = 16     # the pulse input in
@@ -46,8 +47,12 @@ log_interval = getattr(settings, 'PULSE_LOG_INTERVAL', 10 * 60)
 # flag to determine if both transitions are counted
 count_both = getattr(settings, 'PULSE_BOTH_EDGES', False)
 
+# The scheduler runs the posting of the count and watches the worker threads.
+sched = scheduler.Scheduler()
+
 # start up the object that posts to the MQTT broker
 poster = mqtt_poster.MQTTposter()
+sched.watch(poster)
 poster.start()
 
 pulse_count = 0
@@ -64,22 +69,20 @@ def chg_detected(pin_num, new_state):
 # Start up the Input Pin Change Detector
 # I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
 chg_detect = input_change.InputChange(PIN_IN, chg_detected, pull_up=False, debug_pin=debug_pin)
+sched.watch(chg_detect)
 chg_detect.start()
 
-# determine time to log count
-next_log_ts = time.time() + log_interval
-
-while True:
-
-    if not chg_detect.isAlive() or not poster.isAlive():
-        # an important thread is not running.  Exit with an error.
-        sys.exit(1)
+def post_count(ts):
+    """Posts the count, time-stamped with the Unix time 'ts'.
+    """
+    poster.publish('readings/final/pulse_counter_1ch', '%s\t%s\t%s' % (int(ts), sensor_id, pulse_count))
+    if args.debug:
+        print(pulse_count)
 
-    ts = time.time()
-    if ts > next_log_ts:
-        poster.publish('readings/final/pulse_counter_1ch', '%s\t%s\t%s' % (int(ts), sensor_id, pulse_count))
-        if args.debug:
-            print pulse_count
-        next_log_ts += log_interval
+# Post on the wall clock multiples of the log interval, e.g. on the 10 minute marks.
+sched.every(log_interval, post_count)
 
-    time.sleep(0.2)
+# Sleep until a post is due or a worker thread stops.  If an important thread
+# stops, exit with an error.
+sched.run()
+sys.exit(1)
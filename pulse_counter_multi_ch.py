@@ -1,23 +1,26 @@
 #!/usr/bin/python
 """Script to implement a multi channel pulse counter that
-posts to the mini-monitor MQTT broker.
+posts to the mini-monitor MQTT broker.  The counting logic is in the
+PulseCounter class in 'sensors.py'.
 
 This script should be started by a supervisor capable of restarting
 the script if an error occurs.
 """
-import time
+from __future__ import print_function
 import sys
 import argparse
 import input_change
 import mqtt_poster
+import payload_codec
+import sensors
+import capture
+import scheduler
+import metrics
 
 # GPIO Pins (BCM numbering) used by the pulse counter
 PIN_IN_DEFAULTS = [16, 17]     # the pulse input pins to use if no values in settings file
 PIN_DEBUG = 5   # an output pin used for debugging
 
-# Count at which counter rolls to zero
-ROLLOVER = 1000000
-
 # process command line arguments
 parser = argparse.ArgumentParser(description='Single Channel Pulse Counter Script.')
 parser.add_argument("-d", "--debug", help="turn on Debug pin", action="store_true")
@@ -36,50 +39,83 @@ import settings
 # get list of input pins
 pin_in_list =  getattr(settings, 'PULSE_INPUT_PINS', PIN_IN_DEFAULTS)
 
-# get logging interval in seconds
-log_interval = getattr(settings, 'PULSE_LOG_INTERVAL', 10 * 60)
+# flag to determine if pins are watched with kernel edge events instead of polling.
+# Edge detection allows higher pulse rates.
+edge_detect = getattr(settings, 'PULSE_EDGE_DETECT', False)
 
-# flag to determine if both transitions are counted
-count_both = getattr(settings, 'PULSE_BOTH_EDGES', False)
+# flag to determine if the MQTT poster keeps one connection open to the broker
+# instead of connecting for each message.
+mqtt_persistent = getattr(settings, 'MQTT_PERSISTENT', False)
 
-# start up the object that posts to the MQTT broker
-poster = mqtt_poster.MQTTposter()
-poster.start()
+# directory to queue MQTT messages in, so they survive a restart of this
+# script.  If None, messages are queued in memory.
+mqtt_spool_dir = getattr(settings, 'MQTT_SPOOL_DIR', None)
 
-# Track pulse counts in a dictionary indexed on pin number
-pulse_count = dict(zip(pin_in_list, [0] * len(pin_in_list)))
+# If the CAPTURE_PATH setting is present, the raw pin levels, transitions and
+# A/D counts are recorded to that file, for study with 'replay.py'.
+capture_writer = capture.writer_from_settings(settings)
 
-def chg_detected(pin_num, new_state):
-    """This is called when the pulse input pin changes state.
-    """
-    global pulse_count
+# If the METRICS_INTERVAL setting is present, timing measurements of this script
+# are posted to the metrics topic every METRICS_INTERVAL seconds.
+run_metrics, metrics_interval = metrics.metrics_from_settings(settings, 'pulse_counter')
 
-    if new_state == False or count_both:
-        pulse_count[pin_num] += 1
-        pulse_count[pin_num] = pulse_count[pin_num] % ROLLOVER
+def chg_detected(pin_num, new_state, ts):
+    """This is called when any of watched input pins change state.
+    """
+    counter.chg_detected(pin_num, new_state, ts)
 
-# Start up the Input Pin Change Detector
+# Make the Input Pin Change Detector, before any other thread is started, as with
+# RT_SAMPLER set it forks the sampling process here.  The INPUT_IDLE_GAP and
+# RT_SAMPLER settings also pick the detector (see input_change.detector_from_settings).
 # I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
-chg_detect = input_change.InputChange(pin_in_list, chg_detected, pull_up=False, debug_pin=debug_pin)
-chg_detect.start()
+chg_detect = input_change.detector_from_settings(settings, pin_in_list, chg_detected, edge_detect,
+                                                 debug_pin=debug_pin, capture=capture_writer,
+                                                 metrics=run_metrics)
 
-# determine time to log count
-next_log_ts = time.time() + log_interval
+# The scheduler runs the posting of readings and watches the worker threads.
+sched = scheduler.Scheduler()
 
-while True:
+# start up the object that posts to the MQTT broker
+poster = mqtt_poster.MQTTposter(persistent=mqtt_persistent, spool_dir=mqtt_spool_dir,
+                                metrics=run_metrics)
+sched.watch(poster)
+poster.start()
 
-    if not chg_detect.isAlive() or not poster.isAlive():
-        # an important thread is not running.  Exit with an error.
-        sys.exit(1)
+# Readings go out as Mini-Monitor text messages, or batched into packed messages
+# if the PAYLOAD_FORMAT setting is 'packed' (see payload_codec.py).
+readings_poster = payload_codec.poster_from_settings(settings, poster)
 
-    ts = time.time()
-    if ts > next_log_ts:
-        lines = []
-        for pin_num, ct in pulse_count.items():
-            lines.append('%s\t%s\t%s' % (int(ts), '%s_%2d_pulse' % (settings.LOGGER_ID, pin_num), ct))
-        poster.publish('readings/final/pulse_counter_multi', '\n'.join(lines))
-        if args.debug:
-            print pulse_count
-        next_log_ts += log_interval
+# make the pulse counter; its other settings come from the settings file.
+counter = sensors.pulse_counter_from_settings(settings, pin_in_list)
 
-    time.sleep(0.2)
+# Start up the Input Pin Change Detector
+sched.watch(chg_detect)
+chg_detect.start()
+
+# The capture file is written by a thread of its own.
+if capture_writer:
+    capture_writer.start()
+
+def post_counts(ts):
+    """Posts the counts, time-stamped with the Unix time 'ts'.
+    """
+    counter.post(readings_poster, ts)
+    if args.debug:
+        print(counter.debug_info())
+
+# Post on the wall clock multiples of the log interval, e.g. on the 10 minute marks.
+sched.every(counter.log_interval, post_counts)
+
+# Post the timing measurements, if turned on.
+if run_metrics:
+    sched.every(metrics_interval, lambda ts: run_metrics.post(poster, ts, settings.LOGGER_ID))
+
+# Sleep until a post is due or a worker thread stops.  If an important thread
+# stops, save the counts and exit with an error.
+sched.run()
+counter.save()
+if readings_poster is not poster:
+    readings_poster.flush()
+if capture_writer:
+    capture_writer.close()
+sys.exit(1)
@@ -0,0 +1,85 @@
+"""
+Records the time of each pulse on a channel and keeps statistics about the
+intervals between pulses, so a pulse counter can report flow rates as well
+as counts.  Memory use is fixed no matter how many pulses arrive: the pulse
+times are held in a ring buffer, and the interval statistics are updated as
+each pulse is recorded, so producing them at log time takes constant time.
+"""
+from __future__ import division
+import threading
+from array import array
+
+
+class PulseTimes:
+
+    def __init__(self, size=256):
+        """'size' is the number of most recent pulse times kept in the ring buffer.
+        """
+        self.size = size
+        self.times = array('d', [0.0] * size)   # ring buffer of pulse times
+        self.total = 0             # number of pulses ever recorded
+        self.last = None           # time of the most recent pulse
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Starts a new statistics period.  The gap from the last pulse of the prior
+        period to the first pulse of the new one counts in the new period.
+        """
+        self.start = self.last     # time of the pulse the period's intervals start from
+        self.intervals = 0
+        self.min_gap = None
+        self.max_gap = None
+
+    def record(self, ts):
+        """Records a pulse occurring at time 'ts' (seconds, from clock.monotonic()).
+        """
+        with self.lock:
+            self.times[self.total % self.size] = ts
+            self.total += 1
+            if self.last is not None:
+                gap = ts - self.last
+                if self.intervals:
+                    if gap < self.min_gap:
+                        self.min_gap = gap
+                    if gap > self.max_gap:
+                        self.max_gap = gap
+                else:
+                    self.min_gap = self.max_gap = gap
+                self.intervals += 1
+            else:
+                self.start = ts
+            self.last = ts
+
+    def recent(self, n=None):
+        """Returns an array of the last 'n' pulse times, oldest first.  If 'n' is None,
+        all of the times held in the ring buffer are returned.
+        """
+        with self.lock:
+            n = min(n or self.size, self.size, self.total)
+            end = self.total % self.size
+            if n <= end:
+                return self.times[end - n:end]
+            return self.times[self.size - (n - end):] + self.times[:end]
+
+    def stats(self, reset=True):
+        """Returns a dictionary of statistics about the pulse intervals in the current
+        period, or None if there were no intervals.  The keys are 'intervals' (number of
+        intervals), 'int_mean', 'int_min' and 'int_max' (interval lengths in seconds)
+        and 'rate_max' (peak pulse rate in pulses per second).  If 'reset' is True, a new
+        period is started.
+        """
+        with self.lock:
+            if self.intervals:
+                result = {
+                    'intervals': self.intervals,
+                    'int_mean': (self.last - self.start) / self.intervals,
+                    'int_min': self.min_gap,
+                    'int_max': self.max_gap,
+                    'rate_max': 1.0 / self.min_gap if self.min_gap > 0.0 else 0.0,
+                }
+            else:
+                result = None
+            if reset:
+                self.reset()
+            return result
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+"""Replays a capture file (see 'capture.py') through the Pulse Counter and BTU
+Meter logic in 'sensors.py', as fast as the machine allows, and prints the
+readings the sensors would have posted.  It runs on any machine with Python;
+no GPIO pins, A/D converter or MQTT broker are needed.
+
+The sensors are configured from a Mini-Monitor settings file, by default the
+one in /boot/pi_logger; use --settings to give the directory of another, e.g.
+a copy of the settings from the site where the capture was made.  The counts
+are not saved to the checkpoint files.
+
+The sensors are fed the pin transitions that were captured.  To try another
+debounce time on the raw pin levels instead, use --debounce.  A/D scans are
+averaged in groups of BTU_OVERSAMPLE scans, as adc_sampler.ADCSampler does.
+
+Usage:
+    replay.py CAPTURE_FILE [--sensors pulse btu] [--settings DIR] [--debounce MS]
+"""
+from __future__ import print_function
+import sys
+import argparse
+import capture
+import payload_codec
+import sensors
+from adc_sampler import ADC_CHANNELS
+
+
+class ReplayADC:
+    """Stand-in for an MCP3008 A/D converter, returning the counts set by the
+    replay instead of reading the chip.
+    """
+
+    def __init__(self):
+        self.counts = [0.0] * ADC_CHANNELS
+
+    def read_adc(self, ch):
+        return self.counts[ch]
+
+
+class PrintPoster:
+    """Stand-in for mqtt_poster.MQTTposter that prints the messages.
+    """
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.count = 0
+
+    def publish(self, topic, payload):
+        self.count += 1
+        self.out.write(payload if payload.endswith('\n') else payload + '\n')
+
+    def publish_readings(self, topic, ts, readings, trailing_newline=False):
+        self.publish(topic, payload_codec.text_payload(ts, readings, trailing_newline))
+
+
+def debounce_transitions(records, debounce):
+    """Finds the pin transitions in the raw LEVELS and EDGE records of a capture,
+    accepting a new level once it has been held for 'debounce' seconds, as
+    input_change.EdgeInputChange does.  'records' must be sorted on time.  Returns
+    a list of TRANSITION records, time-stamped with the start of the new level.
+    """
+    cur_state = {}     # accepted level of each pin
+    pending = {}       # (level, time) of the latest raw change of each pin
+    last_levels = None
+    transitions = []
+
+    def raw_change(pin, level, ts):
+        if pin in pending:
+            prev_level, prev_ts = pending[pin]
+            if ts - prev_ts >= debounce:
+                accept(pin, prev_level, prev_ts)
+        pending[pin] = (level, ts)
+
+    def accept(pin, level, ts):
+        if cur_state.get(pin) != level:
+            if pin in cur_state:
+                transitions.append((ts, capture.TRANSITION, pin, int(level)))
+            cur_state[pin] = level
+
+    for ts, kind, pin, value in records:
+        if kind == capture.LEVELS:
+            if last_levels is None:
+                # the first record of a polled capture holds the starting levels
+                changed = 0
+                for bit in range(32):
+                    cur_state[bit] = bool(value & (1 << bit))
+            else:
+                changed = value ^ last_levels
+            last_levels = value
+            bit = 0
+            while changed:
+                if changed & 1:
+                    raw_change(bit, bool(value & (1 << bit)), ts)
+                changed >>= 1
+                bit += 1
+        elif kind == capture.EDGE:
+            if pin not in cur_state and pin not in pending:
+                # starting level is unknown; the edge must have left the other level
+                cur_state[pin] = not value
+            raw_change(pin, bool(value), ts)
+
+    # levels that were still held at the end of the capture
+    for pin, (level, ts) in pending.items():
+        if records[-1][0] - ts >= debounce:
+            accept(pin, level, ts)
+
+    transitions.sort(key=lambda rec: rec[0])
+    return transitions
+
+
+def replay(reader, sensor_list, adc=None, oversample=1, debounce=None, poster=None, debug=False):
+    """Feeds the records of the capture.CaptureReader 'reader' to the sensors in
+    'sensor_list', posting readings to 'poster' at each sensor's log interval.
+    'adc' is the ReplayADC the BTU Meters read; A/D scans are averaged in groups
+    of 'oversample' scans before the meters sample them.
+    'debounce' if not None, is the debounce time in seconds used to find the pin
+    transitions from the raw pin levels, instead of using the captured transitions.
+    Returns the number of transitions fed to the sensors.
+    """
+    if not len(reader):
+        return 0
+    if debounce is None:
+        # streamed, so captures larger than the memory can be replayed
+        events = reader.sorted_records([capture.TRANSITION, capture.ADC])
+    else:
+        records = reader.records()
+        events = [rec for rec in records if rec[1] == capture.ADC]
+        events += debounce_transitions(records, debounce)
+        events.sort(key=lambda rec: rec[0])
+
+    pin_call_backs = {}
+    for sensor in sensor_list:
+        for pin in sensor.pins:
+            pin_call_backs[pin] = sensor.chg_detected
+    meters = [sensor for sensor in sensor_list if hasattr(sensor, 'sample')]
+
+    start = reader[0][0]
+    next_log_ts = [start + sensor.log_interval for sensor in sensor_list]
+
+    def post_due(ts):
+        for i, sensor in enumerate(sensor_list):
+            while ts > next_log_ts[i]:
+                if poster:
+                    sensor.post(poster, next_log_ts[i] + reader.wall_offset, next_log_ts[i])
+                if debug:
+                    print(sensor.debug_info())
+                next_log_ts[i] += sensor.log_interval
+
+    transition_count = 0
+    sums = [0.0] * ADC_CHANNELS
+    scan_ts = None          # time of the scan being collected
+    scans = 0               # number of scans in the current group
+    group_start = None
+
+    def sample_group():
+        # the meters sample the average of the scans in the group
+        for ch in range(ADC_CHANNELS):
+            adc.counts[ch] = sums[ch] / scans
+            sums[ch] = 0.0
+        sample_ts = (group_start + scan_ts) / 2.0
+        for meter in meters:
+            meter.sample(sample_ts)
+
+    ts = start
+    for ts, kind, pin, value in events:
+        post_due(ts)
+        if kind == capture.TRANSITION:
+            if pin in pin_call_backs:
+                pin_call_backs[pin](pin, bool(value), ts)
+                transition_count += 1
+        elif kind == capture.ADC and adc:
+            if ts != scan_ts:
+                # all of the channels of a scan share one time
+                if scan_ts is not None:
+                    scans += 1
+                    if scans == oversample:
+                        sample_group()
+                        scans = 0
+                if scans == 0:
+                    group_start = ts
+                scan_ts = ts
+            sums[pin] += value
+    if scan_ts is not None:
+        # the last scan, and the group it ends, which may be short
+        scans += 1
+        sample_group()
+    post_due(ts)
+    return transition_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a sensor capture file.')
+    parser.add_argument('capture_file', help='file written by a sensor script with CAPTURE_PATH set')
+    parser.add_argument('--sensors', nargs='+', default=['pulse', 'btu'],
+                        help='types of sensors to replay: pulse, btu')
+    parser.add_argument('--settings', default='/boot/pi_logger',
+                        help='directory holding the settings.py file')
+    parser.add_argument('--debounce', type=float, default=None,
+                        help='milliseconds of debounce to apply to the raw pin levels')
+    parser.add_argument('-d', '--debug', help='print the sensor debug info at each post',
+                        action='store_true')
+    args = parser.parse_args()
+
+    sys.path.insert(0, args.settings)
+    import settings
+
+    reader = capture.CaptureReader(args.capture_file)
+
+    sensor_list = []
+    if 'pulse' in args.sensors:
+        sensor_list.append(sensors.pulse_counter_from_settings(settings, checkpoint_path=None))
+    adc = None
+    if 'btu' in args.sensors:
+        # start the meters' filters at the counts of the first captured scan
+        first_adc = ReplayADC()
+        first_ts = None
+        for ts, kind, ch, value in reader.sorted_records([capture.ADC]):
+            if first_ts is not None and ts != first_ts:
+                break
+            first_ts = ts
+            first_adc.counts[ch] = value
+        # no meters if the capture holds no A/D data
+        if first_ts is not None:
+            adc = first_adc
+            sensor_list.extend(sensors.btu_meters_from_settings(settings, adc.read_adc,
+                                                                checkpoint_path=None))
+
+    debounce = args.debounce / 1000.0 if args.debounce is not None else None
+    poster = PrintPoster()
+    n = replay(reader, sensor_list, adc, getattr(settings, 'BTU_OVERSAMPLE', 5), debounce,
+               poster, args.debug)
+    print('%d records, %d transitions, %d posts' % (len(reader), n, poster.count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+"""Recomputes the heat totals of the BTU Meter from archived data, after a
+wrong calibration (CALIBRATE_ADJ_HOT / CALIBRATE_ADJ_COLD), minimum delta-T
+(BTU_MIN_DELTA_T) or thermistor type or coefficients is found.  Each input
+file is one of:
+
+    an archive of the text readings posted to 'readings/final/btu_meter', lines
+        of '<Unix time>\t<sensor ID>\t<value>'.  Lines of other sensors are
+        passed through unchanged.
+    a capture file (see 'capture.py'), which is replayed through the BTU Meter
+        logic with the new settings, as 'replay.py' does.
+
+For each input file, a file of the same name is written to --out-dir holding
+the readings with the hot and cold temperatures and the heat totals
+recomputed.  The files are streamed, so they can be larger than the memory,
+and they are spread over all of the CPU cores.
+
+The archived readings only hold the temperatures at the post times and the
+heat added over each log interval, which is the delta-T summed over the
+interval's pulses.  The new heat of an interval is its old average delta-T per
+pulse, changed by the difference between the new and old delta-Ts of the
+interval's temperatures (the average of the two posts).  This is exact for a
+change of calibration; for a change of thermistor, and for the minimum
+delta-T, which is applied to the interval's average delta-T rather than to
+each pulse, it is an estimate.  Replay captures where they exist to get
+exact totals.
+
+Usage example, correcting a hot calibration of 0.5 deg F that should have been 1.2:
+    reprocess_btu.py archive/*.txt --old-cal-hot 0.5 --cal-hot 1.2 --out-dir fixed
+"""
+from __future__ import print_function, division
+import os
+import sys
+import argparse
+import multiprocessing
+import capture
+import replay
+import sensors
+import thermistor
+from sensors import PULSE_ROLLOVER, HEAT_ROLLOVER
+
+# Name used in thermistor.coeff for coefficients given with --coeff
+CUSTOM_THERMISTOR = 'reprocess'
+
+# The site's settings module, used to replay captures; loaded in each worker
+# process by init_worker().
+site_settings = None
+
+# Thermistor set up the way the BTU meter uses it (see sensors.btu_meter_from_settings)
+APPLIED_V = 1023.0
+DIVIDER_R = 4990.0
+
+
+class SettingsOverride:
+    """Stands in for a Mini-Monitor settings module, returning the values in the
+    'overrides' dictionary in place of those of the 'settings' module.
+    """
+
+    def __init__(self, settings, overrides):
+        self.settings = settings
+        self.overrides = overrides
+
+    def __getattr__(self, name):
+        if name in self.overrides:
+            return self.overrides[name]
+        return getattr(self.settings, name)
+
+
+class TempConverter:
+    """Converts a temperature reading made with one thermistor type and
+    calibration to the reading another would have given.
+    """
+
+    def __init__(self, old_therm, old_cal, new_therm, new_cal):
+        self.old_cal = old_cal
+        self.new_cal = new_cal
+        self.same_therm = old_therm.coeff == new_therm.coeff
+        self.old_therm = old_therm
+        self.new_therm = new_therm
+
+    def convert(self, temp):
+        temp -= self.old_cal
+        if not self.same_therm:
+            temp = self.new_therm.TfromR(self.old_therm.RfromT(temp))
+        return temp + self.new_cal
+
+
+class ReadingsReprocessor:
+
+    def __init__(self, hot, cold, old_min_delta_T, min_delta_T):
+        """Recomputes the readings of the BTU meters in an archive of text readings.
+        'hot' and 'cold' are TempConverter objects for the hot and cold temperatures.
+        'old_min_delta_T' and 'min_delta_T' are the minimum delta-Ts used when the
+        readings were made and to be used now.
+        """
+        self.hot = hot
+        self.cold = cold
+        self.old_min_delta_T = old_min_delta_T
+        self.min_delta_T = min_delta_T
+        self.meters = {}        # state of each meter, keyed on its base sensor ID
+        self.intervals = 0
+        self.old_heat = 0.0     # heat added over all intervals, old and new
+        self.new_heat = 0.0
+
+    def process(self, fin, fout):
+        """Reads the text readings from the file 'fin' and writes the recomputed
+        readings to the file 'fout', in the same order.
+        """
+        post_ts = None
+        post_lines = []     # lines of the current post time: text, or (base ID, reading, value)
+        for line in fin:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) != 3:
+                fout.write(line)
+                continue
+            ts, sensor_id, val = fields
+            if ts != post_ts:
+                # the readings posted at one time are on consecutive lines
+                self.finish_post(post_ts, post_lines, fout)
+                post_ts, post_lines = ts, []
+            if '_btu_' in sensor_id:
+                base_id, reading = sensor_id.rsplit('_btu_', 1)
+                post_lines.append((base_id, reading, val))
+            else:
+                post_lines.append(line)
+        self.finish_post(post_ts, post_lines, fout)
+
+    def finish_post(self, ts, post_lines, fout):
+        """Recomputes the readings of the meters posted at time 'ts' and writes
+        'post_lines', the lines posted at that time.
+        """
+        values = {}         # readings of each meter, keyed on base sensor ID
+        for item in post_lines:
+            if not isinstance(item, str):
+                base_id, reading, val = item
+                try:
+                    values.setdefault(base_id, {})[reading] = float(val)
+                except ValueError:
+                    pass
+        new_values = {}
+        for base_id, meter_values in values.items():
+            if all(name in meter_values for name in ('heat', 'pulse', 'thot', 'tcold')):
+                meter = self.meters.setdefault(base_id, {'prev': None})
+                new_values[base_id] = self.recompute(meter, meter_values)
+        for item in post_lines:
+            if isinstance(item, str):
+                fout.write(item)
+            else:
+                base_id, reading, val = item
+                val = new_values.get(base_id, {}).get(reading, val)
+                fout.write('%s\t%s_btu_%s\t%s\n' % (ts, base_id, reading, val))
+
+    def recompute(self, meter, values):
+        """Returns a dictionary of the new heat, thot and tcold of a post, and of
+        the interval summaries if the post has them (see BTU_AGGREGATE), given a
+        dictionary of its old 'values'.
+        """
+        thot = self.hot.convert(values['thot'])
+        tcold = self.cold.convert(values['tcold'])
+        result = {'thot': thot, 'tcold': tcold}
+        for stat in ('min', 'mean', 'max'):
+            for name, converter in (('thot', self.hot), ('tcold', self.cold)):
+                key = '%s_%s' % (name, stat)
+                if key in values:
+                    result[key] = converter.convert(values[key])
+        prev = meter['prev']
+        if prev is None:
+            # the totals carry on from the first post
+            heat = values['heat']
+        else:
+            pulses = (values['pulse'] - prev['pulse']) % PULSE_ROLLOVER
+            old_heat = (values['heat'] - prev['heat']) % HEAT_ROLLOVER
+            if old_heat > HEAT_ROLLOVER / 2:
+                # the heat went down, e.g. a loop that is cooling
+                old_heat -= HEAT_ROLLOVER
+            new_heat = 0.0
+            if pulses:
+                old_dT = (values['thot'] + prev['thot'] - values['tcold'] - prev['tcold']) / 2.0
+                new_dT = (thot + prev['new_thot'] - tcold - prev['new_tcold']) / 2.0
+                if old_heat == 0.0 and self.old_min_delta_T:
+                    # the pulses were all below the old minimum delta-T, so the
+                    # temperatures are all there is to go on
+                    delta_T = new_dT
+                else:
+                    delta_T = old_heat / pulses + new_dT - old_dT
+                if abs(delta_T) >= self.min_delta_T:
+                    new_heat = delta_T * pulses
+            self.intervals += 1
+            self.old_heat += old_heat
+            self.new_heat += new_heat
+            heat = (prev['new_heat'] + new_heat) % HEAT_ROLLOVER
+            if 'heat_total' in values:
+                result['heat_total'] = new_heat
+            if 'heat_max' in values and old_heat:
+                result['heat_max'] = values['heat_max'] * new_heat / old_heat
+        result['heat'] = heat
+        meter['prev'] = dict(values, new_thot=thot, new_tcold=tcold, new_heat=heat)
+        return result
+
+
+def make_thermistor(name):
+    return thermistor.Thermistor(name, appliedV=APPLIED_V, dividerR=DIVIDER_R)
+
+
+def reprocess_file(job):
+    """Reprocesses one input file; 'job' is (input path, output path, options
+    dictionary).  Returns a one line summary.  Runs in a worker process.
+    """
+    path, out_path, opts = job
+    if opts['coeff']:
+        thermistor.coeff[CUSTOM_THERMISTOR] = tuple(opts['coeff'])
+
+    with open(path, 'rb') as fin:
+        is_capture = fin.read(len(capture.MAGIC)) == capture.MAGIC
+
+    if is_capture:
+        # replay with the new settings; per-loop calibrations in BTU_LOOPS are
+        # dropped so the new calibration applies to every loop
+        loops = [loop[:3] for loop in sensors.btu_loops_from_settings(site_settings)]
+        settings = SettingsOverride(site_settings, {
+            'BTU_LOOPS': loops,
+            'CALIBRATE_ADJ_HOT': opts['cal_hot'],
+            'CALIBRATE_ADJ_COLD': opts['cal_cold'],
+            'BTU_MIN_DELTA_T': opts['min_delta_T'],
+            'BTU_THERMISTOR': opts['thermistor'],
+        })
+        reader = capture.CaptureReader(path)
+        adc = replay.ReplayADC()
+        first_ts = None
+        for ts, kind, ch, value in reader.sorted_records([capture.ADC]):
+            # start the meters' filters at the counts of the first captured scan
+            if first_ts is not None and ts != first_ts:
+                break
+            first_ts = ts
+            adc.counts[ch] = value
+        meters = sensors.btu_meters_from_settings(settings, adc.read_adc, checkpoint_path=None)
+        with open(out_path, 'w') as fout:
+            poster = replay.PrintPoster(fout)
+            replay.replay(reader, meters, adc, getattr(settings, 'BTU_OVERSAMPLE', 5), poster=poster)
+        reader.close()
+        return '%s: capture of %d records, %d posts' % (path, len(reader), poster.count)
+
+    hot = TempConverter(make_thermistor(opts['old_thermistor']), opts['old_cal_hot'],
+                        make_thermistor(opts['thermistor']), opts['cal_hot'])
+    cold = TempConverter(make_thermistor(opts['old_thermistor']), opts['old_cal_cold'],
+                         make_thermistor(opts['thermistor']), opts['cal_cold'])
+    proc = ReadingsReprocessor(hot, cold, opts['old_min_delta_T'], opts['min_delta_T'])
+    with open(path) as fin, open(out_path, 'w') as fout:
+        proc.process(fin, fout)
+    return '%s: %d meters, %d intervals, heat %.1f -> %.1f' % (path, len(proc.meters), proc.intervals,
+                                                              proc.old_heat, proc.new_heat)
+
+
+def init_worker(settings_dir):
+    """Loads the settings module in 'settings_dir', if there is one.  Modules can't
+    be passed to the worker processes, so each one imports the settings itself.
+    """
+    global site_settings
+    if os.path.exists(os.path.join(settings_dir, 'settings.py')):
+        sys.path.insert(0, settings_dir)
+        import settings
+        site_settings = settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recomputes BTU meter heat totals from archived data.')
+    parser.add_argument('files', nargs='+', help='text reading archives or capture files')
+    parser.add_argument('--out-dir', required=True, help='directory the recomputed files are written to')
+    parser.add_argument('--old-cal-hot', type=float, default=0.0,
+                        help='hot calibration in the archived readings, deg F')
+    parser.add_argument('--old-cal-cold', type=float, default=0.0,
+                        help='cold calibration in the archived readings, deg F')
+    parser.add_argument('--cal-hot', type=float, help='new hot calibration; default is the old one')
+    parser.add_argument('--cal-cold', type=float, help='new cold calibration; default is the old one')
+    parser.add_argument('--old-min-delta-t', type=float, default=0.0,
+                        help='minimum delta-T in the archived readings, deg F')
+    parser.add_argument('--min-delta-t', type=float, help='new minimum delta-T; default is the old one')
+    parser.add_argument('--old-thermistor', default='BAPI 10K-3',
+                        help='thermistor type in the archived readings, a key of thermistor.coeff')
+    parser.add_argument('--thermistor', help='new thermistor type; default is the old one')
+    parser.add_argument('--coeff', type=float, nargs=3, metavar='C',
+                        help='new Steinhart-Hart coefficients, in place of --thermistor')
+    parser.add_argument('--settings', default='/boot/pi_logger',
+                        help='directory holding the settings.py file, used to replay captures')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    args = parser.parse_args()
+
+    if args.coeff:
+        thermistor.coeff[CUSTOM_THERMISTOR] = tuple(args.coeff)
+        args.thermistor = CUSTOM_THERMISTOR
+    for name in (args.old_thermistor, args.thermistor):
+        if name and name not in thermistor.coeff:
+            parser.error('Unknown thermistor type: %s' % name)
+
+    opts = {
+        'old_cal_hot': args.old_cal_hot,
+        'old_cal_cold': args.old_cal_cold,
+        'cal_hot': args.old_cal_hot if args.cal_hot is None else args.cal_hot,
+        'cal_cold': args.old_cal_cold if args.cal_cold is None else args.cal_cold,
+        'old_min_delta_T': args.old_min_delta_t,
+        'min_delta_T': args.old_min_delta_t if args.min_delta_t is None else args.min_delta_t,
+        'old_thermistor': args.old_thermistor,
+        'thermistor': args.thermistor or args.old_thermistor,
+        'coeff': args.coeff,
+    }
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    have_settings = os.path.exists(os.path.join(args.settings, 'settings.py'))
+    jobs = []
+    for path in args.files:
+        with open(path, 'rb') as fin:
+            if fin.read(len(capture.MAGIC)) == capture.MAGIC and not have_settings:
+                parser.error('A settings file is needed to replay %s; see --settings.' % path)
+        jobs.append((path, os.path.join(args.out_dir, os.path.basename(path)), opts))
+
+    pool = multiprocessing.Pool(args.workers, init_worker, (args.settings,))
+    for summary in pool.imap_unordered(reprocess_file, jobs):
+        print(summary)
+    pool.close()
+    pool.join()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Runs the input pin sampling of a sensor script in a process of its own.  In
+one process, the InputChange thread shares the Python GIL with the MQTT
+poster, the main thread and the temperature conversions, and its reads are
+late whenever those are busy.  In its own process the sampling thread only
+competes with the other processes for a CPU, and that process can be given
+real-time (SCHED_FIFO) priority and a CPU core of its own on a multi-core Pi.
+
+The sampling process passes the pin transitions back through a block of
+shared memory, made with mmap before the process is started:
+
+    header:    I    number of transitions ever written; the ring index of the
+                        next one is this count modulo the ring length
+               I    ring length
+               I    process ID of the sampling process
+               I    unused, zero
+    counters:  II   for each pin 0 - 31: number of falling and rising
+                        transitions, rolling over at 2**32
+    ring:      dII  for each slot: time (clock.monotonic(), which is the same
+                        clock in every process), pin and new state
+
+There is one writer, so no locks are used.  The writer fills a ring slot
+before it advances the count, and the reader checks the count again after
+reading a slot to find out if the slot was overwritten meanwhile; such
+transitions are counted as lost.  The counters are 32 bit so each one is
+written in one store, even on the 32 bit Pis.
+
+After each transition the sampling process writes a byte to a pipe, which
+wakes the reading thread in the script's process.  RTInputChange is that
+thread; it stands in for an InputChange in the sensor scripts.
+"""
+from __future__ import division
+import os
+import sys
+import mmap
+import errno
+import fcntl
+import struct
+import select
+import signal
+import threading
+import ctypes
+import ctypes.util
+import multiprocessing
+import clock
+import input_change
+
+HEADER = struct.Struct('<IIII')
+COUNTERS = struct.Struct('<64I')
+EVENT = struct.Struct('<dII')
+PIN_COUNT = 32
+COUNTERS_OFFSET = HEADER.size
+RING_OFFSET = COUNTERS_OFFSET + COUNTERS.size
+
+# Linux constants not in the os module of Python 2
+SCHED_FIFO = 1
+PR_SET_PDEATHSIG = 1
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+# The sampling process must be forked, as the anonymous shared memory and the
+# pipe can't be passed to a process that is spawned, which is the default in
+# some Python versions.  Python 2 always forks.
+try:
+    _mp = multiprocessing.get_context('fork')
+except AttributeError:
+    _mp = multiprocessing
+
+
+def set_realtime(priority=None, cpu=None):
+    """Gives the calling process SCHED_FIFO scheduling at 'priority' (1 - 99), and
+    runs it only on CPU number 'cpu', for the values that are not None.  Raises
+    OSError if not allowed, e.g. when not running as root.
+    """
+    if cpu is not None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [cpu])
+        else:
+            mask = (ctypes.c_ulong * 16)()      # a 1024 CPU cpu_set_t
+            mask[cpu // (8 * ctypes.sizeof(ctypes.c_ulong))] = 1 << (cpu % (8 * ctypes.sizeof(ctypes.c_ulong)))
+            if _libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, 'sched_setaffinity: %s' % os.strerror(err))
+    if priority is not None:
+        if hasattr(os, 'sched_setscheduler'):
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        else:
+            param = ctypes.c_int(priority)
+            if _libc.sched_setscheduler(0, SCHED_FIFO, ctypes.byref(param)) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, 'sched_setscheduler: %s' % os.strerror(err))
+
+
+class SharedEvents:
+
+    def __init__(self, ring_len=4096):
+        """Block of shared memory holding the transition counters and a ring of the
+        'ring_len' latest transitions (see the module docstring).  Make it before the
+        sampling process is started, so the process shares it.
+        """
+        self.ring_len = ring_len
+        self.mm = mmap.mmap(-1, RING_OFFSET + ring_len * EVENT.size)
+        HEADER.pack_into(self.mm, 0, 0, ring_len, 0, 0)
+        self.count = 0          # writer's count of transitions, kept locally
+
+    def put(self, pin, state, ts):
+        """Adds a transition.  Only called by the sampling process.
+        """
+        EVENT.pack_into(self.mm, RING_OFFSET + (self.count % self.ring_len) * EVENT.size,
+                        ts, pin, int(state))
+        # the counter of the pin and edge; falling edges are at even offsets
+        offset = COUNTERS_OFFSET + (2 * pin + (1 if state else 0)) * 4
+        ct, = struct.unpack_from('<I', self.mm, offset)
+        struct.pack_into('<I', self.mm, offset, (ct + 1) & 0xFFFFFFFF)
+        self.count += 1
+        struct.pack_into('<I', self.mm, 0, self.count & 0xFFFFFFFF)
+
+    def written(self):
+        """Returns the count of transitions written, modulo 2**32.
+        """
+        return struct.unpack_from('<I', self.mm, 0)[0]
+
+    def get(self, i):
+        """Returns transition number 'i' as (pin, state, time), or None if it has been
+        overwritten.
+        """
+        pin_ts, pin, state = EVENT.unpack_from(self.mm, RING_OFFSET + (i % self.ring_len) * EVENT.size)
+        # slot i is reused by transition i + ring_len, which may be part written
+        if (self.written() - i) & 0xFFFFFFFF >= self.ring_len:
+            return None
+        return pin, bool(state), pin_ts
+
+    def counts(self):
+        """Returns a dictionary of (falling, rising) transition counts keyed on pin.
+        The counts roll over at 2**32, so use the difference between two readings.
+        """
+        vals = COUNTERS.unpack_from(self.mm, COUNTERS_OFFSET)
+        return dict((pin, (vals[2 * pin], vals[2 * pin + 1])) for pin in range(PIN_COUNT))
+
+
+def run_sampler(pins, shared, wake_w, priority, cpu, edge_detect, detector_args):
+    """Body of the sampling process: sets its priority, then runs an InputChange,
+    or an EdgeInputChange if 'edge_detect' is True, made with 'detector_args', in
+    this process's main thread.
+    """
+    # stop if the script's process dies, even if it is killed
+    _libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    struct.pack_into('<I', shared.mm, 8, os.getpid())
+    try:
+        set_realtime(priority, cpu)
+    except OSError as e:
+        sys.stderr.write('Sampling process runs without real-time settings: %s\n' % e)
+
+    def chg_detected(pin, state, ts):
+        shared.put(pin, state, ts)
+        try:
+            os.write(wake_w, b'x')
+        except OSError:
+            # the pipe is full, so the reader has wake-ups waiting already
+            pass
+
+    if edge_detect:
+        detector = input_change.EdgeInputChange(pins, chg_detected, timestamps=True, **detector_args)
+    else:
+        detector = input_change.InputChange(pins, chg_detected, timestamps=True, **detector_args)
+    detector.run()
+
+
+class RTInputChange(threading.Thread):
+
+    def __init__(self, pins, call_back, priority=None, cpu=None, edge_detect=False, ring_len=4096,
+                 timestamps=False, capture=None, metrics=None, **detector_args):
+        """Detects changes in a set of input pins in a separate sampling process, and
+        calls 'call_back' for each one from this thread, like an InputChange.
+        'pins', 'call_back' and 'timestamps' are as for input_change.InputChange.
+        'priority' if not None, is the SCHED_FIFO priority (1 - 99) of the sampling
+            process; 'cpu' if not None, is the one CPU it runs on.
+        'edge_detect' if True, an EdgeInputChange is used instead of an InputChange.
+        'ring_len' is the number of transitions held in the shared memory ring.
+        'capture' if not None, a capture.CaptureWriter that records the transitions.
+        'metrics' if not None, a metrics.Metrics object that records the delay from
+            each transition to its call back, and the number of transitions lost.
+        Other keyword arguments, e.g. 'read_gap' or 'idle_gap', are passed to the
+        InputChange or EdgeInputChange.  Capture and metrics are not available
+        in the sampling process.
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.call_back = call_back
+        self.timestamps = timestamps
+        self.capture = capture
+        self.shared = SharedEvents(ring_len)
+        self.lost = 0           # transitions overwritten before they were read
+        self.next_i = 0         # number of the next transition to read
+
+        self.wake_r, wake_w = os.pipe()
+        # the sampling process must never block on the pipe, and drain() must not
+        # block when it has been emptied already
+        for fd in (self.wake_r, wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.process = _mp.Process(target=run_sampler,
+                                   args=(list(pins), self.shared, wake_w, priority, cpu,
+                                         edge_detect, detector_args))
+        self.process.daemon = True
+        self.sampling = False   # True once the sampling process is started
+
+        self.delay_hist = None
+        if metrics:
+            self.delay_hist = metrics.histogram('rt_delay_ms')
+            metrics.gauge('rt_lost', lambda: self.lost)
+
+    def start_sampling(self):
+        """Starts the sampling process, if it has not been started.  The process is
+        forked, so start it before the script starts any other thread: a copy of a
+        process with other threads running can deadlock on a lock one of them held.
+        """
+        if not self.sampling:
+            self.process.start()
+            self.sampling = True
+
+    def start(self):
+        """Starts the sampling process, if start_sampling() hasn't, and this thread.
+        """
+        self.start_sampling()
+        threading.Thread.start(self)
+
+    def is_alive(self):
+        """True if this thread and the sampling process are running.
+        """
+        return threading.Thread.is_alive(self) and self.process.is_alive()
+
+    isAlive = is_alive
+
+    def counts(self):
+        """Returns a dictionary of the (falling, rising) transition counts of each pin,
+        read from the shared memory.  See SharedEvents.counts().
+        """
+        return self.shared.counts()
+
+    def drain(self):
+        """Empties the wake-up pipe and calls the call back for each transition
+        written since the last call.  run() calls this each time the sampling process
+        wakes it; a script on an asyncio event loop can call it from a reader of the
+        'wake_r' pipe instead of starting this thread.
+        """
+        try:
+            os.read(self.wake_r, 4096)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        written = self.shared.written()
+        while self.next_i != written:
+            event = self.shared.get(self.next_i)
+            if event is None:
+                # overwritten; skip to the oldest transition still in the ring
+                skip_to = (written - self.shared.ring_len + 1) & 0xFFFFFFFF
+                self.lost += (skip_to - self.next_i) & 0xFFFFFFFF
+                self.next_i = skip_to
+                continue
+            pin, state, ts = event
+            if self.capture:
+                self.capture.transition(ts, pin, state)
+            if self.delay_hist:
+                self.delay_hist.add((clock.monotonic() - ts) * 1000.0)
+            if self.timestamps:
+                self.call_back(pin, state, ts)
+            else:
+                self.call_back(pin, state)
+            self.next_i = (self.next_i + 1) & 0xFFFFFFFF
+
+    def run(self):
+        while True:
+            try:
+                select.select([self.wake_r], [], [], 1.0)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not self.process.is_alive():
+                # the sampling process stopped, so this thread stops too
+                return
+            self.drain()
+
+if __name__ == '__main__':
+
+    # Test routine and usage example, with two simulated pins carrying 20 Hz
+    # square waves for 3 seconds.  Pin levels in a simulated GPIO module can't be
+    # set from this process, so the signal is computed from the clock.
+    import time
+    from bench_input_change import SignalGPIO
+
+    def chg(pin, state, ts):
+        delays.append(clock.monotonic() - ts)
+
+    delays = []
+    start = clock.monotonic() + 1.0
+    gpio = SignalGPIO([16, 17], 20.0, 0.5, 0.0, start, start + 3.0)
+    detector = RTInputChange([16, 17], chg, priority=None, cpu=0, timestamps=True, gpio=gpio)
+    detector.start()
+    time.sleep(4.5)
+    delays.sort()
+    print('%d transitions, median delay %.2f ms, lost %d' % (len(delays), delays[len(delays) // 2] * 1000.0,
+                                                              detector.lost))
+    print('Counts (falling, rising): %s %s' % (detector.counts()[16], detector.counts()[17]))
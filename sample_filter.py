@@ -0,0 +1,159 @@
+"""
+Filters that smooth a stream of readings, such as the A/D counts from a
+thermistor.  Readings are added by one thread and the filtered value can be
+read at any time from another; both operations take constant time no matter
+how long the filter window is.  History keeps timestamped values so a
+quantity can be found at the moment an event occurred.
+"""
+from __future__ import division
+import threading
+from array import array
+
+
+class MedianOf:
+
+    def __init__(self, n, initial=0.0):
+        """Returns the median of the last 'n' readings, which rejects spikes that
+        last less than half of 'n' readings.  'n' should be small and odd, e.g. 3 or 5.
+        'initial' is the value the reading history starts out filled with.
+        """
+        self.n = n
+        self.buf = array('d', [initial] * n)
+        self.ix = 0
+
+    def add(self, val):
+        """Adds the reading 'val' and returns the median of the recent readings.
+        """
+        self.buf[self.ix] = val
+        self.ix = (self.ix + 1) % self.n
+        return sorted(self.buf)[self.n // 2]
+
+
+class RunningAverage:
+
+    def __init__(self, size, initial=0.0, median=1):
+        """Average of the last 'size' readings.  The readings are held in a ring
+        buffer and a running sum is kept, so the average is available without
+        summing the buffer.
+        'initial' is the value the buffer starts out filled with.
+        'median' if larger than 1, each reading is first passed through a MedianOf
+            filter of that length to reject spikes.
+        """
+        self.size = size
+        self.buf = array('d', [initial] * size)
+        self.total = initial * size
+        self.ix = 0
+        self.median = MedianOf(median, initial) if median > 1 else None
+        self.lock = threading.Lock()
+
+    def add(self, val):
+        """Adds a new reading, replacing the oldest one.
+        """
+        if self.median:
+            val = self.median.add(val)
+        with self.lock:
+            self.total += val - self.buf[self.ix]
+            self.buf[self.ix] = val
+            self.ix += 1
+            if self.ix == self.size:
+                self.ix = 0
+                # Once per pass through the buffer, recompute the sum so rounding
+                # error can't accumulate when readings are not whole numbers.
+                self.total = sum(self.buf)
+
+    def value(self):
+        """Returns the average of the readings in the buffer.
+        """
+        with self.lock:
+            return self.total / self.size
+
+
+class ExponentialAverage:
+
+    def __init__(self, size, initial=0.0, median=1):
+        """Exponential moving average with a smoothing factor of 2 / ('size' + 1),
+        which has the same average age of readings as a RunningAverage of
+        'size' readings but needs no buffer.
+        'initial' is the starting value of the average.
+        'median' if larger than 1, each reading is first passed through a MedianOf
+            filter of that length to reject spikes.
+        """
+        self.alpha = 2.0 / (size + 1)
+        self.avg = float(initial)
+        self.median = MedianOf(median, initial) if median > 1 else None
+
+    def add(self, val):
+        """Adds a new reading to the average.
+        """
+        if self.median:
+            val = self.median.add(val)
+        # a single assignment of a float, so readers always see a whole value
+        self.avg += self.alpha * (val - self.avg)
+
+    def value(self):
+        """Returns the current value of the average.
+        """
+        return self.avg
+
+
+# Filter classes that can be selected by name
+filter_types = {
+    'average': RunningAverage,
+    'ema': ExponentialAverage,
+}
+
+def make_filter(kind, size, initial=0.0, median=1):
+    """Returns a filter of the type named 'kind' (a key in 'filter_types').
+    The other parameters are passed to the filter's constructor.
+    """
+    return filter_types[kind](size, initial, median)
+
+
+class History:
+
+    def __init__(self, size=100):
+        """Holds the last 'size' (time, value) samples of a quantity in a ring buffer,
+        so its value at a moment between samples can be found by interpolation.
+        Samples must be added in time order.
+        """
+        self.size = size
+        self.times = array('d', [0.0] * size)
+        self.values = array('d', [0.0] * size)
+        self.count = 0          # number of samples ever added
+
+    def add(self, ts, val):
+        """Adds the sample 'val' taken at time 'ts'.
+        """
+        ix = self.count % self.size
+        self.times[ix] = ts
+        self.values[ix] = val
+        self.count += 1
+
+    def latest_time(self):
+        """Returns the time of the newest sample, or None if there are no samples.
+        """
+        if self.count:
+            return self.times[(self.count - 1) % self.size]
+        return None
+
+    def at(self, ts):
+        """Returns the value at time 'ts', interpolated between the samples on either
+        side of it.  Times older than the oldest sample get the oldest value, and times
+        newer than the newest sample get the newest value.  Returns None if there are
+        no samples.  The search starts at the newest sample, so it is quick for recent times.
+        """
+        if not self.count:
+            return None
+        newest = self.count - 1
+        oldest = max(0, self.count - self.size)
+        i = newest
+        while i > oldest and self.times[i % self.size] > ts:
+            i -= 1
+        ix = i % self.size
+        t0 = self.times[ix]
+        if i == newest or ts <= t0:
+            return self.values[ix]
+        ix1 = (i + 1) % self.size
+        t1 = self.times[ix1]
+        v0 = self.values[ix]
+        return v0 + (self.values[ix1] - v0) * (ts - t0) / (t1 - t0)
@@ -0,0 +1,129 @@
+"""
+Runs the periodic jobs of a sensor script's main thread, such as posting
+readings, and watches the script's worker threads.  The main thread sleeps
+until the next job is due or a watched thread stops, instead of waking every
+fraction of a second to compare the time to the next log time and poll
+'isAlive()' on each thread.
+
+Jobs are held in a heap ordered on their due time from clock.monotonic().
+A job can be aligned to the wall clock, so that a 10 minute log interval
+posts on the 10 minute marks of the hour; alignment is recomputed from the
+Unix time at each run, so a step of the system clock (common on a Pi, which
+has no real-time clock) just moves the job to the next boundary.
+
+The sleeping is done with select() on a pipe, which a stopping thread writes
+to.  Python 2's Event.wait() with a timeout polls every few milliseconds, so
+it is not used.
+"""
+import os
+import time
+import heapq
+import select
+import clock
+
+
+def next_boundary(interval):
+    """Returns the monotonic time of the next multiple of 'interval' in Unix time.
+    """
+    now = time.time()
+    boundary = (int(now / interval) + 1) * interval
+    return clock.monotonic() + boundary - now
+
+
+def boundary_after(ts, interval):
+    """Returns the monotonic time of the boundary following the one at Unix time
+    'ts', just run.  A wake-up a little before the boundary, or a step back of the
+    wall clock, would make next_boundary() return the boundary just run, posting
+    it twice; next_boundary() is only used if the following boundary has passed.
+    """
+    now = time.time()
+    if ts + interval > now:
+        return clock.monotonic() + ts + interval - now
+    return next_boundary(interval)
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.jobs = []              # heap of [due time, sequence number, job]
+        self.seq = 0                # breaks ties between jobs due at the same time
+        self.stopped = []           # watched threads that have stopped
+        self.wake_r, self.wake_w = os.pipe()
+
+    def every(self, interval, func, align=True):
+        """Calls 'func(ts)' every 'interval' seconds from run().  If 'align' is True,
+        the calls happen when the Unix time is a multiple of 'interval', and 'ts' is
+        that Unix time; otherwise the first call is 'interval' seconds from now, and
+        'ts' is the Unix time of the call.
+        """
+        job = {'interval': interval, 'func': func, 'align': align}
+        if align:
+            due = next_boundary(interval)
+        else:
+            due = clock.monotonic() + interval
+        self._push(due, job)
+
+    def _push(self, due, job):
+        self.seq += 1
+        heapq.heappush(self.jobs, [due, self.seq, job])
+
+    def watch(self, thread):
+        """Makes run() return if 'thread' stops, for any reason.  Must be called
+        before the thread is started.
+        """
+        target = thread.run
+        def run():
+            try:
+                target()
+            finally:
+                self.stopped.append(thread)
+                os.write(self.wake_w, b'x')
+        thread.run = run
+
+    def run(self):
+        """Runs the jobs as they come due.  Returns the first watched thread that
+        stops, which normally means the script should exit.
+        """
+        while not self.stopped:
+            delay = self.jobs[0][0] - clock.monotonic() if self.jobs else None
+            if delay is None or delay > 0.0:
+                # sleep until the next job is due, or a watched thread stops
+                readable, _, _ = select.select([self.wake_r], [], [], delay)
+                if readable:
+                    continue
+            due, _, job = heapq.heappop(self.jobs)
+            if job['align']:
+                # Unix time of the boundary this run is for
+                ts = round(time.time() / job['interval']) * job['interval']
+                job['func'](ts)
+                self._push(boundary_after(ts, job['interval']), job)
+            else:
+                job['func'](time.time())
+                due += job['interval']
+                now = clock.monotonic()
+                if due < now:
+                    # the job took longer than its interval; skip the missed runs
+                    due = now
+                self._push(due, job)
+        return self.stopped[0]
+
+
+if __name__ == '__main__':
+
+    # Test routine and usage example
+    import threading
+
+    def show(ts):
+        print('%s  %.3f' % (time.strftime('%H:%M:%S', time.localtime(ts)), time.time()))
+
+    def short_lived():
+        time.sleep(7.5)
+
+    sched = Scheduler()
+    sched.every(2, show)
+    sched.every(0.7, lambda ts: None, align=False)
+    worker = threading.Thread(target=short_lived)
+    worker.daemon = True
+    sched.watch(worker)
+    worker.start()
+    print('%s stopped' % sched.run().name)
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+"""Script that hosts the same sensors as 'sensor_daemon.py', configured by
+the same settings and posting with the same topics and payloads, but runs
+them as coroutines on one asyncio event loop under Python 3, instead of in
+a set of threads (see aio_runtime.py).  Watching edge events, sampling the
+A/D channels, posting the readings and publishing to the MQTT broker all
+happen on the loop.  Polling the input pins stays off the loop, in a thread,
+or in a process of its own if RT_SAMPLER is set.
+
+MQTT messages are always published over one persistent connection, so the
+MQTT_PERSISTENT setting is not used.
+
+This script should be started by a supervisor capable of restarting
+the script if an error occurs.
+
+This script must be run with sudo because it writes to the /var/local
+directory.
+"""
+import sys
+import asyncio
+import argparse
+import input_change
+import aio_runtime
+import payload_codec
+import sensors
+import capture
+import metrics
+
+# GPIO Pins (BCM numbering) used by the sensors.  The BTU meter pins and A/D
+# channels are given by the BTU_LOOPS setting (see sensors.btu_loops_from_settings).
+PIN_IN_DEFAULTS = [16, 17]     # the pulse input pins to use if no values in settings file
+PIN_DEBUG = 5                  # an output pin used for debugging
+
+# process command line arguments
+parser = argparse.ArgumentParser(description='Multi-Sensor Daemon on an asyncio event loop.')
+parser.add_argument("-d", "--debug", help="turn on Debug pin", action="store_true")
+args = parser.parse_args()
+
+# set the debug pin if requested
+debug_pin = PIN_DEBUG if args.debug else None
+
+# Access some settings in the Mini-Monitor settings file
+# The settings file is installed in the FAT boot partition of the Pi SD card,
+# so that it can be easily configured from the PC that creates the SD card.
+# Include that directory in the Path so the settings file can be found.
+sys.path.insert(0, '/boot/pi_logger')
+import settings
+
+# the types of sensors to host
+sensor_types = getattr(settings, 'DAEMON_SENSORS', ['pulse'])
+
+# flag to determine if pins are watched with kernel edge events instead of polling.
+# The edge events are handled on the event loop.
+edge_detect = getattr(settings, 'DAEMON_EDGE_DETECT', False)
+
+# flag to run the pin sampling in a process of its own (see
+# input_change.detector_from_settings).
+rt_sampling = getattr(settings, 'RT_SAMPLER', False)
+
+# directory to queue MQTT messages in, so they survive a restart of this
+# script.  If None, messages are queued in memory.
+mqtt_spool_dir = getattr(settings, 'MQTT_SPOOL_DIR', None)
+
+# If the CAPTURE_PATH setting is present, the raw pin levels, transitions and
+# A/D counts are recorded to that file, for study with 'replay.py'.
+capture_writer = capture.writer_from_settings(settings)
+
+# If the METRICS_INTERVAL setting is present, timing measurements of this script
+# are posted to the metrics topic every METRICS_INTERVAL seconds.
+run_metrics, metrics_interval = metrics.metrics_from_settings(settings, 'sensor_async')
+
+# the sensors, the MQTT poster and the poster the readings go to, made in main()
+sensor_list = []
+poster = readings_poster = None
+
+
+async def main():
+    """Starts the sensors and the jobs of the script, and returns when any of
+    them stops.
+    """
+    global poster, readings_poster
+    loop = asyncio.get_running_loop()
+    jobs = []
+
+    # the call back function for each pin, filled in once the sensors are made
+    pin_call_backs = {}
+
+    def chg_detected(pin_num, new_state, ts):
+        """This is called on the event loop when any of watched input pins change
+        state.  Passes the change to the sensor using the pin.
+        """
+        pin_call_backs[pin_num](pin_num, new_state, ts)
+
+    # Watch all of the pins with one Input Pin Change Detector.  It is made before
+    # any other thread is started, as with RT_SAMPLER set it forks the sampling
+    # process, where the InputChange or EdgeInputChange runs.
+    # I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
+    pins = sensors.pins_from_settings(settings, sensor_types,
+                                      getattr(settings, 'PULSE_INPUT_PINS', PIN_IN_DEFAULTS))
+    if rt_sampling:
+        chg_detect = input_change.detector_from_settings(settings, pins, chg_detected, edge_detect,
+                                                         debug_pin=debug_pin, capture=capture_writer,
+                                                         metrics=run_metrics)
+        jobs.append(aio_runtime.run_rt_sampler(chg_detect))
+    elif edge_detect:
+        source = aio_runtime.EdgeSource(pins, chg_detected, pull_up=False, timestamps=True,
+                                        capture=capture_writer, metrics=run_metrics)
+        jobs.append(source.run())
+    else:
+        # the pins are polled in a thread, which passes the changes to the loop
+        dispatcher = aio_runtime.LoopDispatcher(chg_detected, loop)
+        jobs.append(dispatcher.run())
+        chg_detect = input_change.detector_from_settings(settings, pins, dispatcher.put,
+                                                         debug_pin=debug_pin, capture=capture_writer,
+                                                         metrics=run_metrics)
+        jobs.append(aio_runtime.watch(chg_detect, loop))
+        chg_detect.start()
+
+    # The capture file is written by a thread of its own.
+    if capture_writer:
+        capture_writer.start()
+
+    # start up the object that posts to the MQTT broker
+    poster = aio_runtime.AsyncMQTTPoster(spool_dir=mqtt_spool_dir, metrics=run_metrics)
+    jobs.append(poster.run())
+
+    # Readings go out as Mini-Monitor text messages, or batched into packed messages
+    # if the PAYLOAD_FORMAT setting is 'packed' (see payload_codec.py).
+    readings_poster = payload_codec.poster_from_settings(settings, poster)
+
+    # make the sensors
+    if 'pulse' in sensor_types:
+        sensor_list.append(sensors.pulse_counter_from_settings(
+            settings, getattr(settings, 'PULSE_INPUT_PINS', PIN_IN_DEFAULTS)))
+    if 'btu' in sensor_types:
+        # Import SPI library (for hardware SPI), and set up a scanner that reads
+        # the MCP3008 channels of all the BTU loops in one batch.
+        import Adafruit_GPIO.SPI as SPI
+        import adc_scanner
+        SPI_PORT   = 0
+        SPI_DEVICE = 0
+        loops = sensors.btu_loops_from_settings(settings)
+        channels = [ch for loop_chs in loops for ch in loop_chs[1:3]]
+        scanner = adc_scanner.MCP3008Scanner(channels, SPI_PORT, SPI_DEVICE,
+                                             spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE, max_speed_hz=1000000),
+                                             capture=capture_writer)
+        # The A/D channels are sampled at a steady rate by a coroutine, which
+        # passes each temperature sample to the meters.
+        sampler = sensors.btu_sampler_from_settings(settings, scanner, run_metrics)
+        meters = sensors.btu_meters_from_settings(settings, sampler.read_adc)
+        sampler.call_backs = [meter.sample for meter in meters]
+        jobs.append(aio_runtime.run_adc_sampler(sampler))
+        sensor_list.extend(meters)
+
+    # Find the call back function for each pin
+    for sensor in sensor_list:
+        for pin in sensor.pins:
+            if pin in pin_call_backs:
+                raise ValueError('Pin %s is used by more than one sensor.' % pin)
+            pin_call_backs[pin] = sensor.chg_detected
+
+    def poster_for(sensor):
+        """Returns a function that posts the readings of 'sensor' at the Unix time
+        passed to it.
+        """
+        def post(ts):
+            sensor.post(readings_poster, ts)
+            if args.debug:
+                print(sensor.debug_info())
+        return post
+
+    # Post each sensor's readings on the wall clock multiples of its log interval,
+    # e.g. on the 10 minute marks.
+    for sensor in sensor_list:
+        jobs.append(aio_runtime.every(sensor.log_interval, poster_for(sensor)))
+
+    # Post the timing measurements, if turned on.
+    if run_metrics:
+        jobs.append(aio_runtime.every(metrics_interval,
+                                      lambda ts: run_metrics.post(poster, ts, settings.LOGGER_ID)))
+
+    # None of the jobs return unless something is wrong.
+    stopped, _ = await asyncio.wait([asyncio.ensure_future(job) for job in jobs],
+                                    return_when=asyncio.FIRST_COMPLETED)
+    aio_runtime.print_stopped(stopped)
+
+
+# If an important job stops, save the counts and exit with an error.
+try:
+    asyncio.run(main())
+finally:
+    for sensor in sensor_list:
+        sensor.save()
+    if readings_poster is not poster:
+        readings_poster.flush()
+    if capture_writer:
+        capture_writer.close()
+sys.exit(1)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+"""Script that hosts Pulse Counter channels and BTU Meters in one process,
+so they share one pin sampling thread, one MQTT connection and one main
+loop, instead of running 'pulse_counter_multi_ch.py' and 'btu_meter.py'
+side by side.  The readings are posted with the same topics and sensor IDs
+as those scripts.
+
+The sensors to host are listed in the DAEMON_SENSORS setting, e.g.
+['pulse', 'btu'].  Each sensor is configured by the same settings the
+single-sensor scripts use.  DAEMON_EDGE_DETECT selects kernel edge
+detection instead of polling for all of the pins.
+
+This script should be started by a supervisor capable of restarting
+the script if an error occurs.
+
+This script must be run with sudo because it writes to the /var/local 
+directory.
+"""
+from __future__ import print_function
+import sys
+import argparse
+import input_change
+import mqtt_poster
+import payload_codec
+import sensors
+import capture
+import scheduler
+import metrics
+
+# GPIO Pins (BCM numbering) used by the sensors.  The BTU meter pins and A/D
+# channels are given by the BTU_LOOPS setting (see sensors.btu_loops_from_settings).
+PIN_IN_DEFAULTS = [16, 17]     # the pulse input pins to use if no values in settings file
+PIN_DEBUG = 5                  # an output pin used for debugging
+
+# process command line arguments
+parser = argparse.ArgumentParser(description='Multi-Sensor Daemon.')
+parser.add_argument("-d", "--debug", help="turn on Debug pin", action="store_true")
+args = parser.parse_args()
+
+# set the debug pin if requested
+debug_pin = PIN_DEBUG if args.debug else None
+
+# Access some settings in the Mini-Monitor settings file
+# The settings file is installed in the FAT boot partition of the Pi SD card,
+# so that it can be easily configured from the PC that creates the SD card.  
+# Include that directory in the Path so the settings file can be found.
+sys.path.insert(0, '/boot/pi_logger')
+import settings
+
+# the types of sensors to host
+sensor_types = getattr(settings, 'DAEMON_SENSORS', ['pulse'])
+
+# flag to determine if pins are watched with kernel edge events instead of polling.
+edge_detect = getattr(settings, 'DAEMON_EDGE_DETECT', False)
+
+# flag to determine if the MQTT poster keeps one connection open to the broker
+# instead of connecting for each message.
+mqtt_persistent = getattr(settings, 'MQTT_PERSISTENT', False)
+
+# directory to queue MQTT messages in, so they survive a restart of this
+# script.  If None, messages are queued in memory.
+mqtt_spool_dir = getattr(settings, 'MQTT_SPOOL_DIR', None)
+
+# If the CAPTURE_PATH setting is present, the raw pin levels, transitions and
+# A/D counts are recorded to that file, for study with 'replay.py'.
+capture_writer = capture.writer_from_settings(settings)
+
+# If the METRICS_INTERVAL setting is present, timing measurements of this script
+# are posted to the metrics topic every METRICS_INTERVAL seconds.
+run_metrics, metrics_interval = metrics.metrics_from_settings(settings, 'sensor_daemon')
+
+def chg_detected(pin_num, new_state, ts):
+    """This is called when any of watched input pins change state.  Passes
+    the change to the sensor using the pin.
+    """
+    pin_call_backs[pin_num](pin_num, new_state, ts)
+
+# Make one Input Pin Change Detector for all of the pins, before any other thread
+# is started, as with RT_SAMPLER set it forks the sampling process here.  The
+# INPUT_IDLE_GAP and RT_SAMPLER settings also pick the detector (see
+# input_change.detector_from_settings).
+# I have a 10 K pull-up on the board and a 0.01 uF cap to ground.
+pins = sensors.pins_from_settings(settings, sensor_types,
+                                  getattr(settings, 'PULSE_INPUT_PINS', PIN_IN_DEFAULTS))
+chg_detect = input_change.detector_from_settings(settings, pins, chg_detected, edge_detect,
+                                                 debug_pin=debug_pin, capture=capture_writer,
+                                                 metrics=run_metrics)
+
+# The scheduler runs the posting of readings and watches the worker threads.
+sched = scheduler.Scheduler()
+
+# start up the object that posts to the MQTT broker
+poster = mqtt_poster.MQTTposter(persistent=mqtt_persistent, spool_dir=mqtt_spool_dir,
+                                metrics=run_metrics)
+sched.watch(poster)
+poster.start()
+
+# Readings go out as Mini-Monitor text messages, or batched into packed messages
+# if the PAYLOAD_FORMAT setting is 'packed' (see payload_codec.py).
+readings_poster = payload_codec.poster_from_settings(settings, poster)
+
+# make the sensors
+sensor_list = []
+if 'pulse' in sensor_types:
+    sensor_list.append(sensors.pulse_counter_from_settings(
+        settings, getattr(settings, 'PULSE_INPUT_PINS', PIN_IN_DEFAULTS)))
+if 'btu' in sensor_types:
+    # Import SPI library (for hardware SPI), and set up a scanner that reads
+    # the MCP3008 channels of all the BTU loops in one batch.
+    import Adafruit_GPIO.SPI as SPI
+    import adc_scanner
+    SPI_PORT   = 0
+    SPI_DEVICE = 0
+    loops = sensors.btu_loops_from_settings(settings)
+    channels = [ch for loop in loops for ch in loop[1:3]]
+    scanner = adc_scanner.MCP3008Scanner(channels, SPI_PORT, SPI_DEVICE,
+                                         spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE, max_speed_hz=1000000),
+                                         capture=capture_writer)
+    # The A/D channels are sampled at a steady rate in a thread of their own,
+    # which passes each temperature sample to the meters.
+    sampler = sensors.btu_sampler_from_settings(settings, scanner, run_metrics)
+    meters = sensors.btu_meters_from_settings(settings, sampler.read_adc)
+    sampler.call_backs = [meter.sample for meter in meters]
+    sched.watch(sampler)
+    sampler.start()
+    sensor_list.extend(meters)
+
+# Find the call back function for each pin
+pin_call_backs = {}
+for sensor in sensor_list:
+    for pin in sensor.pins:
+        if pin in pin_call_backs:
+            raise ValueError('Pin %s is used by more than one sensor.' % pin)
+        pin_call_backs[pin] = sensor.chg_detected
+
+# Start up the Input Pin Change Detector
+sched.watch(chg_detect)
+chg_detect.start()
+
+# The capture file is written by a thread of its own.
+if capture_writer:
+    capture_writer.start()
+
+def poster_for(sensor):
+    """Returns a function that posts the readings of 'sensor' at the Unix time
+    passed to it.
+    """
+    def post(ts):
+        sensor.post(readings_poster, ts)
+        if args.debug:
+            print(sensor.debug_info())
+    return post
+
+# Post each sensor's readings on the wall clock multiples of its log interval,
+# e.g. on the 10 minute marks.
+for sensor in sensor_list:
+    sched.every(sensor.log_interval, poster_for(sensor))
+
+# Post the timing measurements, if turned on.
+if run_metrics:
+    sched.every(metrics_interval, lambda ts: run_metrics.post(poster, ts, settings.LOGGER_ID))
+
+# The BTU meters are sampled by their own thread, so the main thread sleeps until
+# a post is due or a worker thread stops.  If an important thread stops, save the
+# counts and exit with an error.
+sched.run()
+for sensor in sensor_list:
+    sensor.save()
+if readings_poster is not poster:
+    readings_poster.flush()
+if capture_writer:
+    capture_writer.close()
+sys.exit(1)
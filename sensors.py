@@ -0,0 +1,441 @@
+"""
+Sensor classes holding the counting and reporting logic of the Pulse Counter
+and the BTU Meter, so that the logic can be shared by the single-sensor
+scripts and by 'sensor_daemon.py', which hosts several sensors in one process.
+
+Each sensor has:
+    pins              list of input pins (BCM) it needs watched
+    chg_detected()    the InputChange call back for those pins, called with
+                          (pin, new_state, ts) where 'ts' is from clock.monotonic()
+    post()            posts the current readings to an MQTTposter, or to a
+                          payload_codec.PackedPoster standing in for one, with
+                          (poster, ts, now) where 'ts' is the Unix time of the
+                          post and 'now', if given, the clock.monotonic() time
+                          of the end of the log period, which replay.py passes
+    log_interval      seconds between posts
+    save()            saves the counters to the checkpoint file, if there is one
+
+The BTU Meter also has sample(), which takes a temperature sample and does the
+heat counting that should not be done in the InputChange thread.  It is called
+by an adc_sampler.ADCSampler after each sample of the A/D channels.
+"""
+import json
+import collections
+import adc_sampler
+import aggregator
+import checkpoint
+import clock
+import counters
+import pulse_stats
+import sample_filter
+import thermistor
+
+# Count at which the posted pulse counts roll to zero.  The counts are kept
+# without rolling over (see counters.py); the rollover is applied when posting.
+ROLLOVER = 1000000
+PULSE_ROLLOVER = ROLLOVER
+
+# Value at which the heat count rolls over.  This is a sum of the delta-Ts
+# that are present when pulses occur.
+HEAT_ROLLOVER = 1000000.0
+
+# Default paths of the files where counters are saved, so they can be restored
+# when the process restarts.
+PATH_PULSE_CHECKPOINT = '/var/local/pulse_counter_counts'
+PATH_BTU_CHECKPOINT = '/var/local/btu_meter_counts'
+
+
+class PulseCounter:
+
+    topic = 'readings/final/pulse_counter_multi'
+
+    def __init__(self, logger_id, pins, log_interval=600, count_both=False, rate_stats=False,
+                 checkpoint_path=None, checkpoint_pulses=100, checkpoint_interval=300):
+        """Counts pulses on a set of input pins.
+        'logger_id' is the Mini-Monitor logger ID used to build the sensor IDs.
+        'pins' is the list of pulse input pins (BCM).
+        'log_interval' is the number of seconds between posts of the counts.
+        'count_both' if True, both transitions of the input are counted.
+        'rate_stats' if True, pulse interval statistics are posted with the counts.
+        'checkpoint_path' if not None, the file used to save and restore the counts,
+            which is done every 'checkpoint_pulses' pulses or 'checkpoint_interval' seconds.
+        """
+        self.logger_id = logger_id
+        self.pins = list(pins)
+        self.log_interval = log_interval
+        self.count_both = count_both
+        self.rate_stats = rate_stats
+
+        # Track pulse counts in a counter registry, one channel per pin
+        self.counts = counters.CounterRegistry(self.pins)
+        self.pin_ix = dict((pin_num, ix) for ix, pin_num in enumerate(self.pins))
+
+        # Record the time of each pulse to produce interval statistics
+        self.pulse_times = dict((pin_num, pulse_stats.PulseTimes()) for pin_num in self.pins)
+
+        # Restore the pulse counts from the checkpoint file, if present.  JSON keys
+        # are strings, so the pin numbers are converted.
+        self.counts_saver = None
+        if checkpoint_path:
+            self.counts_saver = checkpoint.Checkpoint(checkpoint_path, self.counter_state,
+                                                      checkpoint_pulses, checkpoint_interval)
+            for pin_num, ct in (self.counts_saver.load() or {}).items():
+                if int(pin_num) in self.pin_ix:
+                    self.counts.set(self.pin_ix[int(pin_num)], ct)
+            self.counts_saver.start()
+
+    def counter_state(self):
+        return dict((str(pin_num), int(ct)) for pin_num, ct in self.counts.items())
+
+    def save(self):
+        if self.counts_saver:
+            self.counts_saver.save()
+
+    def chg_detected(self, pin_num, new_state, ts):
+        """This is called when a pulse input pin changes state.  'ts' is the
+        time of the change.
+        """
+        if new_state == False or self.count_both:
+            self.counts.add(self.pin_ix[pin_num])
+            self.pulse_times[pin_num].record(ts)
+            if self.counts_saver:
+                self.counts_saver.tick()
+
+    def post(self, poster, ts, now=None):
+        """Posts the counts to 'poster', time-stamped with the Unix time 'ts'.  'now'
+        is not needed by the counts.
+        """
+        readings = []
+        for pin_num, ct in self.counts.items():
+            sensor_id = '%s_%2d_pulse' % (self.logger_id, pin_num)
+            readings.append((sensor_id, counters.wrap(ct, ROLLOVER)))
+            # statistics are reset each log period even if not posted
+            stats = self.pulse_times[pin_num].stats()
+            if self.rate_stats and stats:
+                for stat in ('int_mean', 'int_min', 'int_max', 'rate_max'):
+                    readings.append(('%s_%s' % (sensor_id, stat), stats[stat]))
+        poster.publish_readings(self.topic, ts, readings)
+
+    def debug_info(self):
+        return dict((pin_num, counters.wrap(ct, ROLLOVER)) for pin_num, ct in self.counts.items())
+
+
+class BTUMeter:
+
+    topic = 'readings/final/btu_meter'
+    series_topic = 'readings/series/btu_meter'
+
+    def __init__(self, logger_id, pin, read_adc, ch_hot, ch_cold, therm, log_interval=600,
+                 calibrate_hot=0.0, calibrate_cold=0.0, min_delta_T=0.0, count_both=False,
+                 temp_filter='average', temp_len=100, temp_median=1,
+                 checkpoint_path=None, checkpoint_pulses=100, checkpoint_interval=300,
+                 aggregate=None, bucket_width=1.0):
+        """A BTU meter that uses a pulse output flow meter and two thermistors to
+        measure hydronic heat flow.
+        'logger_id' is the Mini-Monitor logger ID used to build the sensor IDs.
+        'pin' is the flow meter pulse input pin (BCM).
+        'read_adc' is a function that returns the A/D count of an MCP3008 channel.
+        'ch_hot' and 'ch_cold' are the A/D channels of the hot and cold thermistors.
+        'therm' is a thermistor.Thermistor object used to convert A/D counts.
+        'log_interval' is the number of seconds between posts of the readings.
+        'calibrate_hot' and 'calibrate_cold' are added to the temperature readings.
+        'min_delta_T' is the minimum delta-T (deg F) required to tally energy flow.
+        'count_both' if True, both transitions of the flow input are counted.
+        'temp_filter', 'temp_len' and 'temp_median' set up the filters that average
+            the A/D readings; see sample_filter.make_filter().
+        'checkpoint_path' if not None, the file used to save and restore the counts,
+            which is done every 'checkpoint_pulses' pulses or 'checkpoint_interval' seconds.
+        'aggregate' if 'summary', each post also holds the pulse and heat totals, their
+            largest 'bucket_width' second totals, and the min, mean and max of the
+            temperatures over the log interval.  If 'series', the 'bucket_width' second
+            buckets are also posted to 'series_topic' as JSON.  None to post neither.
+        """
+        self.pin = pin
+        self.pins = [pin]
+        self.base_sensor_id = '%s_%2d_btu' % (logger_id, pin)
+        self.read_adc = read_adc
+        self.ch_hot = ch_hot
+        self.ch_cold = ch_cold
+        self.therm = therm
+        self.log_interval = log_interval
+        self.calibrate_hot = calibrate_hot
+        self.calibrate_cold = calibrate_cold
+        self.min_delta_T = min_delta_T
+        self.count_both = count_both
+
+        # Initialize pulse count and heat count, restoring them from the checkpoint
+        # file if it is present.  They are kept in a counter registry, so the two
+        # are always read as a consistent pair.
+        self.counts = counters.CounterRegistry(['pulse', 'heat'])
+        self.pulse_ix = self.counts.index('pulse')
+        self.heat_ix = self.counts.index('heat')
+        self.counts_saver = None
+        if checkpoint_path:
+            self.counts_saver = checkpoint.Checkpoint(checkpoint_path, self.counter_state,
+                                                      checkpoint_pulses, checkpoint_interval)
+            saved = self.counts_saver.load() or {}
+            self.counts.set(self.pulse_ix, saved.get('pulse', 0))
+            self.counts.set(self.heat_ix, saved.get('heat', 0.0))
+            self.counts_saver.start()
+
+        # Initialize filters to hold hot and cold thermistor A/D readings.
+        # These filters are used to calculate a current reading that is
+        # an average of recent readings.  The raw A/D counts are stored
+        # in the filter to elimnate the CPU time needed to convert each into
+        # a temperature.  Variation between the readings is small, so the
+        # non-linearity of the count-->temperature function is not important.
+        self.ad_hot = sample_filter.make_filter(temp_filter, temp_len, read_adc(ch_hot), temp_median)
+        self.ad_cold = sample_filter.make_filter(temp_filter, temp_len, read_adc(ch_cold), temp_median)
+
+        # Recent delta-T values, time-stamped, so the delta-T at the moment of each
+        # flow pulse can be determined.
+        self.delta_T_history = sample_filter.History(100)
+
+        # Times of flow pulses that have not yet been added to the heat count.
+        self.pulse_times = collections.deque()
+
+        # Short time buckets of the readings within a log interval, if they are posted.
+        self.aggregate = aggregate
+        self.aggregator = None
+        if aggregate:
+            self.aggregator = aggregator.Aggregator(sums=['pulse', 'heat'], stats=['thot', 'tcold'],
+                                                    width=bucket_width,
+                                                    size=int(log_interval / bucket_width) + 10)
+            # start of the log interval being summarized; the first sample's time
+            self.period_start = None
+
+    def counter_state(self):
+        pulse, heat = self.counts.snapshot()
+        return {'pulse': int(pulse), 'heat': heat}
+
+    def save(self):
+        if self.counts_saver:
+            self.counts_saver.save()
+
+    def current_temps(self):
+        """Returns the current hot and cold temperatures, averaging the values
+        in the reading filters.  Always applies the calibration value.
+        """
+        thot = self.therm.TfromV(self.ad_hot.value()) + self.calibrate_hot
+        tcold = self.therm.TfromV(self.ad_cold.value()) + self.calibrate_cold
+        return thot, tcold
+
+    def chg_detected(self, pin_num, new_state, ts):
+        """This is called when the flow input pin changes state.  It runs
+        in the Input Change thread, so it only records the time of the pulse;
+        the counting is done in count_pulses().
+        """
+        if new_state == False or self.count_both:
+            self.pulse_times.append(ts)
+
+    def sample(self, ts=None):
+        """Reads temperatures into the filters, records the resulting delta-T
+        and tallies the flow pulses that occurred up to this sample.  When the
+        A/D channels are read through an MCP3008Scanner, scan it first.
+        'ts' is the time the A/D readings were taken (clock.monotonic()); if None,
+        the current time is used.  An adc_sampler.ADCSampler passes it.
+        """
+        self.ad_hot.add(self.read_adc(self.ch_hot))
+        self.ad_cold.add(self.read_adc(self.ch_cold))
+        thot, tcold = self.current_temps()
+        if ts is None:
+            ts = clock.monotonic()
+        self.delta_T_history.add(ts, thot - tcold)
+        if self.aggregator:
+            if self.period_start is None:
+                # the first interval starts at the first sample, or at an earlier
+                # pulse this sample is about to tally
+                self.period_start = min([ts] + list(self.pulse_times)[:1])
+            self.aggregator.sample(ts, 'thot', thot)
+            self.aggregator.sample(ts, 'tcold', tcold)
+        self.count_pulses()
+
+    def count_pulses(self):
+        """Adds the pulses recorded by chg_detected() to the pulse and heat counts,
+        using the delta-T interpolated to the time of each pulse.  Pulses newer
+        than the last delta-T sample are left for the next call.
+        """
+        last_sample_ts = self.delta_T_history.latest_time()
+        while self.pulse_times and self.pulse_times[0] <= last_sample_ts:
+            pulse_ts = self.pulse_times.popleft()
+            delta_T = self.delta_T_history.at(pulse_ts)
+            # enforce minimum delta-T
+            if abs(delta_T) < self.min_delta_T:
+                delta_T = 0.0
+            if self.aggregator:
+                self.aggregator.add(pulse_ts, 'pulse', 1)
+                self.aggregator.add(pulse_ts, 'heat', delta_T)
+
+            self.counts.add_pair(self.pulse_ix, 1, self.heat_ix, delta_T)
+            if self.counts_saver:
+                self.counts_saver.tick()
+
+    def post(self, poster, ts, now=None):
+        """Posts the readings to 'poster', time-stamped with the Unix time 'ts'.
+        'now' is the clock.monotonic() time of the end of the log interval, which
+        ends the interval summarized; None for the current time.
+        """
+        ts = int(ts)
+        thot, tcold = self.current_temps()
+        pulse, heat = self.counts.snapshot()
+        readings = [('heat', counters.wrap(heat, HEAT_ROLLOVER)), ('pulse', counters.wrap(pulse, PULSE_ROLLOVER)),
+                    ('thot', thot), ('tcold', tcold)]
+        if self.aggregator:
+            # summarize the buckets of the log interval that just ended
+            if now is None:
+                now = clock.monotonic()
+            start = now if self.period_start is None else self.period_start
+            readings += self.aggregator.summary(start, now)
+            if self.aggregate == 'series':
+                series = self.aggregator.series(start, now)
+                # convert bucket times to Unix times
+                series['bucket'] = [round(t + ts - now, 3) for t in series['bucket']]
+                for key, vals in series.items():
+                    if key != 'bucket':
+                        series[key] = [None if v is None else round(v, 3) for v in vals]
+                series['sensor_id'] = self.base_sensor_id
+                series['width'] = self.aggregator.width
+                poster.publish(self.series_topic, json.dumps(series, sort_keys=True))
+            self.period_start = now
+        # the BTU meter script has always ended the last line with a newline
+        poster.publish_readings(self.topic, ts,
+                                [('%s_%s' % (self.base_sensor_id, id), val) for id, val in readings],
+                                trailing_newline=True)
+
+    def debug_info(self):
+        pulse, heat = self.counts.snapshot()
+        return (counters.wrap(pulse, PULSE_ROLLOVER), counters.wrap(heat, HEAT_ROLLOVER),
+                self.current_temps())
+
+
+def pulse_counter_from_settings(settings, pins=None, checkpoint_path=PATH_PULSE_CHECKPOINT):
+    """Returns a PulseCounter configured from the Mini-Monitor 'settings' module.
+    'pins' if not None, overrides the PULSE_INPUT_PINS setting.
+    'checkpoint_path' is the file used to save the counts; None to not save them.
+    """
+    return PulseCounter(
+        settings.LOGGER_ID,
+        # list of input pins
+        pins or getattr(settings, 'PULSE_INPUT_PINS', [16, 17]),
+        # logging interval in seconds
+        log_interval=getattr(settings, 'PULSE_LOG_INTERVAL', 10 * 60),
+        # flag to determine if both transitions are counted
+        count_both=getattr(settings, 'PULSE_BOTH_EDGES', False),
+        # flag to determine if pulse interval statistics (mean, min and max interval
+        # in seconds, and peak rate in pulses per second) are posted with the counts.
+        rate_stats=getattr(settings, 'PULSE_RATE_STATS', False),
+        # The counts are saved to a checkpoint file after this many pulses or
+        # seconds, whichever comes first.
+        checkpoint_path=checkpoint_path,
+        checkpoint_pulses=getattr(settings, 'CHECKPOINT_PULSES', 100),
+        checkpoint_interval=getattr(settings, 'CHECKPOINT_INTERVAL', 5 * 60),
+    )
+
+def btu_loops_from_settings(settings):
+    """Returns the list of BTU loops given by the BTU_LOOPS setting.  Each loop is
+    a tuple of (flow pulse pin, hot A/D channel, cold A/D channel, hot calibration,
+    cold calibration); the calibration values are optional in the setting and
+    default to the CALIBRATE_ADJ_HOT and CALIBRATE_ADJ_COLD settings.
+    """
+    loops = []
+    for loop in getattr(settings, 'BTU_LOOPS', [(13, 0, 1)]):
+        loop = tuple(loop) + (getattr(settings, 'CALIBRATE_ADJ_HOT', 0.0),
+                              getattr(settings, 'CALIBRATE_ADJ_COLD', 0.0))[len(loop) - 3:]
+        loops.append(loop)
+    return loops
+
+def pins_from_settings(settings, sensor_types, pulse_pins=None):
+    """Returns the sorted list of the input pins used by the sensors of 'sensor_types',
+    a list holding 'pulse' and 'btu', as the sensors made from the Mini-Monitor
+    'settings' module by the functions here use them.  'pulse_pins' if not None,
+    overrides the PULSE_INPUT_PINS setting.  Lets a script make its pin change
+    detector before the sensors.
+    """
+    pins = []
+    if 'pulse' in sensor_types:
+        pins += pulse_pins or getattr(settings, 'PULSE_INPUT_PINS', [16, 17])
+    if 'btu' in sensor_types:
+        pins += [loop[0] for loop in btu_loops_from_settings(settings)]
+    return sorted(pins)
+
+def btu_meters_from_settings(settings, read_adc, checkpoint_path=PATH_BTU_CHECKPOINT):
+    """Returns a list of BTUMeter objects, one for each loop in the BTU_LOOPS setting.
+    'read_adc' is a function that returns the A/D count of an MCP3008 channel,
+    usually the 'read_adc()' method of an adc_scanner.MCP3008Scanner.
+    'checkpoint_path' is the file used to save the counts; None to not save them.
+    With more than one loop, each loop's checkpoint file has the pin number appended.
+    """
+    loops = btu_loops_from_settings(settings)
+    meters = []
+    for pin, ch_hot, ch_cold, cal_hot, cal_cold in loops:
+        path = checkpoint_path
+        if path and len(loops) > 1:
+            path = '%s_%d' % (path, pin)
+        meters.append(btu_meter_from_settings(settings, read_adc, pin, ch_hot, ch_cold,
+                                              cal_hot, cal_cold, path))
+    return meters
+
+def btu_meter_from_settings(settings, read_adc, pin=13, ch_hot=0, ch_cold=1,
+                            calibrate_hot=None, calibrate_cold=None, checkpoint_path=PATH_BTU_CHECKPOINT):
+    """Returns a BTUMeter configured from the Mini-Monitor 'settings' module.
+    'read_adc' is a function that returns the A/D count of an MCP3008 channel.
+    'pin', 'ch_hot' and 'ch_cold' are the flow input pin and thermistor channels.
+    'calibrate_hot' and 'calibrate_cold', if not None, override the calibration
+    settings, and 'checkpoint_path' is the file used to save the counts.
+    """
+    if calibrate_hot is None:
+        calibrate_hot = getattr(settings, 'CALIBRATE_ADJ_HOT', 0.0)
+    if calibrate_cold is None:
+        calibrate_cold = getattr(settings, 'CALIBRATE_ADJ_COLD', 0.0)
+    # Using a 4.99 K divider resistor and a 10-bit A/D converter with max
+    # value of 1023.  A lookup table is used for the conversion, as it is done
+    # at every sample.  The thermistor type is a key into thermistor.coeff.
+    therm = thermistor.Thermistor(getattr(settings, 'BTU_THERMISTOR', 'BAPI 10K-3'),
+                                  appliedV=1023.0, dividerR=4990.0, lookup=True)
+    return BTUMeter(
+        settings.LOGGER_ID, pin, read_adc, ch_hot, ch_cold, therm,
+        # logging interval in seconds
+        log_interval=getattr(settings, 'BTU_LOG_INTERVAL', 10 * 60),
+        # Calibration values to add to the Hot and Cold Temperature readings
+        calibrate_hot=calibrate_hot,
+        calibrate_cold=calibrate_cold,
+        # the minimum delta-T required to tally energy flow (deg F)
+        min_delta_T=getattr(settings, 'BTU_MIN_DELTA_T', 0.0),
+        # flag to determine if both transitions are counted
+        count_both=getattr(settings, 'BTU_BOTH_EDGES', False),
+        # type of filter used to average temperature readings: 'average' for a
+        # running average of the last 100 readings, or 'ema' for an
+        # exponential moving average.
+        temp_filter=getattr(settings, 'BTU_TEMP_FILTER', 'average'),
+        # number of readings to take the median of before averaging, to reject
+        # noise spikes.  1 disables the median filter.
+        temp_median=getattr(settings, 'BTU_TEMP_MEDIAN', 1),
+        # The counts are saved to a checkpoint file after this many pulses or
+        # seconds, whichever comes first.
+        checkpoint_path=checkpoint_path,
+        checkpoint_pulses=getattr(settings, 'CHECKPOINT_PULSES', 100),
+        checkpoint_interval=getattr(settings, 'CHECKPOINT_INTERVAL', 5 * 60),
+        # 'summary' to also post the totals, peaks and temperature ranges within
+        # each log interval, 'series' to post the whole series of buckets as well,
+        # or None for neither.  The buckets are BTU_BUCKET_SECONDS long.
+        aggregate=getattr(settings, 'BTU_AGGREGATE', None),
+        bucket_width=getattr(settings, 'BTU_BUCKET_SECONDS', 1.0),
+    )
+
+def btu_sampler_from_settings(settings, scanner, metrics=None):
+    """Returns an adc_sampler.ADCSampler, not yet started, that samples the A/D
+    channels of the loops in the BTU_LOOPS setting through the
+    adc_scanner.MCP3008Scanner 'scanner'.  Build the meters with the sampler's
+    'read_adc()' and add their 'sample()' methods to its 'call_backs' list.
+    'metrics' if not None, is a metrics.Metrics object the sampler records into.
+    """
+    channels = [ch for loop in btu_loops_from_settings(settings) for ch in loop[1:3]]
+    return adc_sampler.ADCSampler(
+        scanner.scan, channels,
+        # number of A/D scans per second
+        rate=getattr(settings, 'BTU_SAMPLE_RATE', 100.0),
+        # number of scans averaged into each temperature sample.  With the defaults,
+        # 20 samples per second go to the reading filters.
+        oversample=getattr(settings, 'BTU_OVERSAMPLE', 5),
+        metrics=metrics,
+    )
